@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Benchmark get_states() on a synthetic command sequence with and without the
+maneuver / pitch trace events enabled.
+
+With tracing off (the normal INFO level run) the command loop does no
+formatting work.  With tracing on every event is formatted and written to a
+null stream, which is the cost every run paid before the trace events were
+made lazy, so the ratio of the two is the speedup of a normal run.
+
+Usage: bench_get_states.py [options]::
+
+  # 200 maneuvers, 5 repeats
+  bench_get_states.py --n-manvr 200 --n-repeat 5
+
+  # Save results as JSON
+  bench_get_states.py --outfile get_states_times.json
+"""
+
+import io
+import json
+import time
+import logging
+import argparse
+
+import numpy as np
+from Chandra.Time import DateTime
+
+import chandra_cmd_states as cmd_states
+from chandra_cmd_states import trace
+
+
+def make_cmds(n_manvr, start='2012:001:00:00:00.000', seed=0):
+    """Make a command table with ``n_manvr`` maneuvers, each followed by an
+    obsid change and ACIS power commands, spaced by 6 hours.
+
+    :param n_manvr: number of maneuvers
+    :param start: start date
+    :param seed: random seed for the target attitudes
+    :returns: command table
+    """
+    rng = np.random.RandomState(seed)
+    t0 = DateTime(start).secs
+    time_cmd_sets = []
+    for i in range(n_manvr):
+        t_manvr = t0 + i * 6 * 3600
+        q = rng.normal(size=4)
+        q /= np.sqrt(np.sum(q ** 2))
+        time_cmd_sets.extend([
+            (t_manvr, cmd_states.cmd_set('manvr', *q)),
+            (t_manvr + 3600, cmd_states.cmd_set('obsid', 50000 + i)),
+            (t_manvr + 3700, cmd_states.cmd_set('acis', 'WSPOW0CF3F',
+                                                'WT00216024'))])
+    return cmd_states.generate_cmds_many(time_cmd_sets)
+
+
+def time_get_states(cmds, n_repeat, tracing):
+    """Time get_states() for ``cmds`` ``n_repeat`` times.
+
+    :param cmds: command table
+    :param n_repeat: number of runs
+    :param tracing: enable all trace events (written to a null stream)
+    :returns: list of run times (sec)
+    """
+    handler = logging.StreamHandler(io.StringIO())
+    if tracing:
+        trace.enable('all', handler=handler)
+    else:
+        trace.disable('all')
+    state0 = dict(cmd_states.STATE0)
+    state0['datestart'] = DateTime(DateTime(cmds['date'][0]).secs - 1).date
+
+    times = []
+    try:
+        for _ in range(n_repeat):
+            t0 = time.perf_counter()
+            cmd_states.get_states(dict(state0), cmds)
+            times.append(time.perf_counter() - t0)
+    finally:
+        for subsystem in trace.SUBSYSTEMS:
+            trace.get_logger(subsystem).removeHandler(handler)
+            trace.get_logger(subsystem).propagate = True
+        trace.disable('all')
+    return times
+
+
+def get_options(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark get_states')
+    parser.add_argument('--n-manvr',
+                        type=int,
+                        default=200,
+                        help='Number of maneuvers (default=200)')
+    parser.add_argument('--n-repeat',
+                        type=int,
+                        default=5,
+                        help='Number of runs of each case (default=5)')
+    parser.add_argument('--outfile',
+                        help='Output JSON file (default=print only)')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    opt = get_options(args)
+    cmds = make_cmds(opt.n_manvr)
+
+    results = {'n_manvr': opt.n_manvr,
+               'n_cmds': len(cmds),
+               'n_repeat': opt.n_repeat}
+    for name, tracing in (('trace_off', False), ('trace_on', True)):
+        times = time_get_states(cmds, opt.n_repeat, tracing)
+        results[name] = float(np.median(times))
+        print('{:10s} median={:.3f} s  min={:.3f} s'
+              .format(name, np.median(times), np.min(times)))
+    results['speedup'] = results['trace_on'] / results['trace_off']
+    print('Speedup with tracing off: {:.2f}x ({} maneuvers, {} cmds)'
+          .format(results['speedup'], opt.n_manvr, len(cmds)))
+
+    if opt.outfile:
+        with open(opt.outfile, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Benchmark the time to import chandra_cmd_states modules in a fresh Python
+interpreter, which is the startup cost paid by each get_cmd_states call.
+
+Each import is timed in a new subprocess ``--n-repeat`` times and the median
+is reported along with the heavy state-generation modules that were loaded
+as a side effect.
+
+Usage: bench_import.py [options]::
+
+  # Time the read path used by get_cmd_states
+  bench_import.py --module chandra_cmd_states.get_cmd_states
+
+  # Save results as JSON
+  bench_import.py --outfile import_times.json
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+import numpy as np
+
+# Modules only needed to generate (not read) commanded states
+HEAVY_MODULES = ['Ska.File', 'Ska.DBI', 'Chandra.Maneuver', 'Quaternion',
+                 'Ska.Sun', 'Ska.ParseCM', 'tables']
+
+TIMER_CODE = """
+import sys, time, json
+t0 = time.perf_counter()
+import {module}
+dt = time.perf_counter() - t0
+print(json.dumps({{'time': dt,
+                   'loaded': [x for x in {heavy!r} if x in sys.modules]}}))
+"""
+
+
+def time_import(module, n_repeat=10):
+    """Time importing ``module`` in a fresh interpreter ``n_repeat`` times.
+
+    :param module: module name
+    :param n_repeat: number of subprocess runs
+    :returns: dict of results
+    """
+    env = dict(os.environ, SKA_ALLOW_DISCONTINUED_PACKAGES='1')
+    code = TIMER_CODE.format(module=module, heavy=HEAVY_MODULES)
+    times = []
+    for _ in range(n_repeat):
+        out = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', code],
+                                      env=env)
+        result = json.loads(out.decode().splitlines()[-1])
+        times.append(result['time'])
+
+    return {'module': module,
+            'n_repeat': n_repeat,
+            'median': float(np.median(times)),
+            'min': float(np.min(times)),
+            'max': float(np.max(times)),
+            'heavy_modules_loaded': result['loaded']}
+
+
+def get_options(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark import time')
+    parser.add_argument('--module',
+                        action='append',
+                        help='Module to import (default=chandra_cmd_states and '
+                             'chandra_cmd_states.get_cmd_states)')
+    parser.add_argument('--n-repeat',
+                        type=int,
+                        default=10,
+                        help='Number of fresh interpreter runs (default=10)')
+    parser.add_argument('--outfile',
+                        help='Output JSON file (default=print only)')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    opt = get_options(args)
+    modules = opt.module or ['chandra_cmd_states',
+                             'chandra_cmd_states.get_cmd_states']
+
+    results = [time_import(module, opt.n_repeat) for module in modules]
+    for result in results:
+        print('{module:40s} median={median:.3f} s  min={min:.3f} s  '
+              'heavy modules loaded: {loaded}'
+              .format(loaded=', '.join(result['heavy_modules_loaded']) or 'none',
+                      **result))
+
+    if opt.outfile:
+        with open(opt.outfile, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+    return results
+
+
+if __name__ == '__main__':
+    main()
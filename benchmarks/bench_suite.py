@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Benchmark suite for state generation, command retrieval and state fetching
+on synthetic datasets from ``make_synthetic_db.py``.
+
+Benchmarks:
+
+=================  ===========================================================
+get_cmds           get_cmds_table() for the whole dataset (database + backstop)
+get_states         get_states() from all commands
+update_states_db   update_states_db() after the second half of cmd_states
+                   was deleted (compare + insert)
+reduce_states      reduce_states() on obsid, simpos and pcad_mode
+fetch_states_h5    fetch_states() of all states from the HDF5 mirror
+fetch_states_sql   fetch_states() of all states from the sqlite database
+=================  ===========================================================
+
+Fixtures are ``small`` (3 months), ``medium`` (2 years) and ``mission``
+(20 years) of synthetic data.  They are generated once into ``--data-dir``
+and reused by later runs.
+
+Each benchmark is run ``--n-repeat`` times to get latency percentiles and
+throughput (items per second at the median latency), plus one extra run
+under tracemalloc for the peak memory.  Results are written as JSON to
+``--outfile``.  With ``--baseline`` the median latencies are compared to a
+previous results file and the exit status is 1 if any benchmark is slower by
+more than ``--threshold``.
+
+Usage: bench_suite.py [options]::
+
+  # Make a baseline with the small and medium fixtures
+  bench_suite.py --outfile baseline.json
+
+  # Compare to the baseline allowing 10% slowdown
+  bench_suite.py --baseline baseline.json --threshold 0.1 --outfile new.json
+
+  # Only get_states on the mission-scale fixture
+  bench_suite.py --fixture mission --bench get_states
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import argparse
+import subprocess
+import tempfile
+import tracemalloc
+
+import numpy as np
+
+import chandra_cmd_states as cmd_states
+from chandra_cmd_states import update_cmd_states
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import make_synthetic_db  # noqa: E402
+
+FIXTURES = {'small': 0.25,
+            'medium': 2.0,
+            'mission': 20.0}
+
+BENCHMARKS = ('get_cmds', 'get_states', 'update_states_db', 'reduce_states',
+              'fetch_states_h5', 'fetch_states_sql')
+
+
+def get_dataset(name, data_dir, seed=0):
+    """Get the synthetic dataset for fixture ``name``, making it if needed.
+
+    :param name: fixture name (small|medium|mission)
+    :param data_dir: directory for datasets
+    :param seed: random seed
+    :returns: dataset dict from make_synthetic_db.make_dataset()
+    """
+    outdir = os.path.join(data_dir, '{}_seed{}'.format(name, seed))
+    summary_file = os.path.join(outdir, 'dataset.json')
+    if os.path.exists(summary_file):
+        with open(summary_file) as fh:
+            return json.load(fh)
+
+    print('Making {} dataset in {} ..'.format(name, outdir))
+    dataset = make_synthetic_db.make_dataset(outdir, years=FIXTURES[name],
+                                             seed=seed)
+    with open(summary_file, 'w') as fh:
+        json.dump(dataset, fh, indent=2)
+    return dataset
+
+
+class Case(object):
+    """
+    One benchmark case.  ``setup()`` is called before each run and is not
+    timed, ``run(arg)`` is timed with the value returned by ``setup()`` and
+    returns the number of items processed.
+
+    :param unit: name of the items (e.g. cmds, states, rows)
+    :param run: function to time
+    :param setup: function returning the argument for ``run`` (optional)
+    """
+    def __init__(self, unit, run, setup=None):
+        self.unit = unit
+        self.run = run
+        self.setup = setup or (lambda: None)
+
+
+def get_cases(dataset, tmpdir):
+    """Get the benchmark cases for ``dataset``.
+
+    :param dataset: dataset dict
+    :param tmpdir: directory for scratch database copies
+    :returns: dict of name: Case
+    """
+    import Ska.DBI
+
+    db = Ska.DBI.DBI(dbi='sqlite', server=dataset['db_file'])
+    datestart = dataset['datestart']
+    state0 = dict(cmd_states.STATE0, datestart=datestart)
+    cmds = cmd_states.get_cmds_table(datestart, db=db,
+                                     mp_dir=dataset['mp_dir'])
+    states = cmd_states.get_states(dict(state0), cmds)
+    db_states = db.fetchall('SELECT * FROM cmd_states ORDER BY datestart')
+    date_mid = db_states['datestart'][len(db_states) // 2]
+
+    def run_get_cmds(arg):
+        return len(cmd_states.get_cmds_table(datestart, db=db,
+                                             mp_dir=dataset['mp_dir']))
+
+    def run_get_states(arg):
+        cmd_states.get_states(dict(state0), cmds)
+        return len(cmds)
+
+    def setup_update_states_db():
+        server = os.path.join(tmpdir, 'update.db3')
+        shutil.copy(dataset['db_file'], server)
+        scratch_db = Ska.DBI.DBI(dbi='sqlite', server=server)
+        scratch_db.execute("DELETE FROM cmd_states WHERE datestart >= '{}'"
+                           .format(date_mid))
+        return scratch_db
+
+    def run_update_states_db(scratch_db):
+        update_cmd_states.update_states_db(states, scratch_db, None)
+        scratch_db.conn.close()
+        return len(states)
+
+    def run_reduce_states(arg):
+        cmd_states.reduce_states(db_states, ['obsid', 'simpos', 'pcad_mode'])
+        return len(db_states)
+
+    def run_fetch_states(dbi, server):
+        def run(arg):
+            return len(cmd_states.fetch_states(datestart, '2099:001', dbi=dbi,
+                                               server=server))
+        return run
+
+    cases = {'get_cmds': Case('cmds', run_get_cmds),
+             'get_states': Case('cmds', run_get_states),
+             'update_states_db': Case('states', run_update_states_db,
+                                      setup_update_states_db),
+             'reduce_states': Case('states', run_reduce_states),
+             'fetch_states_sql': Case('rows', run_fetch_states(
+                 'sqlite', dataset['db_file']))}
+    if dataset.get('h5file'):
+        cases['fetch_states_h5'] = Case('rows', run_fetch_states(
+            'hdf5', dataset['h5file']))
+    return cases
+
+
+def time_case(case, n_repeat):
+    """Run benchmark ``case`` ``n_repeat`` times plus once with tracemalloc.
+
+    :param case: Case object
+    :param n_repeat: number of timed runs
+    :returns: dict of results
+    """
+    times = []
+    for _ in range(n_repeat):
+        arg = case.setup()
+        t0 = time.perf_counter()
+        n_items = case.run(arg)
+        times.append(time.perf_counter() - t0)
+
+    arg = case.setup()
+    tracemalloc.start()
+    try:
+        case.run(arg)
+        peak_mem = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    p50, p90, p99 = np.percentile(times, [50, 90, 99])
+    return {'unit': case.unit,
+            'n_items': int(n_items),
+            'n_repeat': n_repeat,
+            'min': float(np.min(times)),
+            'p50': float(p50),
+            'p90': float(p90),
+            'p99': float(p99),
+            'throughput': float(n_items / p50) if p50 > 0 else None,
+            'peak_mem_mb': peak_mem / 1e6}
+
+
+def compare_baseline(results, baseline, threshold):
+    """Compare median latencies in ``results`` to ``baseline``.
+
+    :param results: results dict
+    :param baseline: baseline results dict
+    :param threshold: allowed fractional slowdown
+    :returns: list of (name, ratio, regressed) for benchmarks in both
+    """
+    out = []
+    for name, result in results['results'].items():
+        base = baseline['results'].get(name)
+        if base is None or not base['p50']:
+            continue
+        ratio = result['p50'] / base['p50']
+        out.append((name, ratio, ratio > 1 + threshold))
+    return out
+
+
+def get_meta():
+    """Get metadata about the benchmark environment.
+    """
+    try:
+        git_rev = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        git_rev = None
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'git_rev': git_rev,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform()}
+
+
+def get_options(args=None):
+    parser = argparse.ArgumentParser(description='Run benchmark suite')
+    parser.add_argument('--fixture',
+                        action='append',
+                        choices=sorted(FIXTURES),
+                        help='Fixture to run (default=small and medium)')
+    parser.add_argument('--bench',
+                        action='append',
+                        choices=BENCHMARKS,
+                        help='Benchmark to run (default=all)')
+    parser.add_argument('--n-repeat',
+                        type=int,
+                        default=5,
+                        help='Number of timed runs (default=5)')
+    parser.add_argument('--data-dir',
+                        default='bench_data',
+                        help='Directory for synthetic datasets '
+                        '(default=bench_data)')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='Random seed for datasets (default=0)')
+    parser.add_argument('--outfile',
+                        help='Output JSON results file (default=print only)')
+    parser.add_argument('--baseline',
+                        help='Baseline JSON results file to compare against')
+    parser.add_argument('--threshold',
+                        type=float,
+                        default=0.2,
+                        help='Allowed fractional slowdown of median latency '
+                        'versus baseline (default=0.2)')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    opt = get_options(args)
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    fixtures = opt.fixture or ['small', 'medium']
+    benches = opt.bench or BENCHMARKS
+
+    results = {'meta': get_meta(), 'datasets': {}, 'results': {}}
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for fixture in fixtures:
+            dataset = get_dataset(fixture, opt.data_dir, opt.seed)
+            results['datasets'][fixture] = dict(
+                (key, val) for key, val in dataset.items()
+                if key.startswith('n_'))
+            cases = get_cases(dataset, tmpdir)
+            for bench in benches:
+                if bench not in cases:
+                    continue
+                name = '{}.{}'.format(fixture, bench)
+                result = time_case(cases[bench], opt.n_repeat)
+                results['results'][name] = result
+                print('{:30s} p50={p50:8.3f} s  p90={p90:8.3f} s  '
+                      '{throughput:10.0f} {unit}/s  peak={peak_mem_mb:7.1f} MB'
+                      .format(name, **result))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if opt.outfile:
+        with open(opt.outfile, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+    if opt.baseline:
+        with open(opt.baseline) as fh:
+            baseline = json.load(fh)
+        print('\nComparison to baseline {} (threshold {:.0%})'
+              .format(opt.baseline, opt.threshold))
+        comparison = compare_baseline(results, baseline, opt.threshold)
+        for name, ratio, regressed in comparison:
+            print('{:30s} {:6.2f}x {}'.format(name, ratio,
+                                               'REGRESSION' if regressed
+                                               else 'ok'))
+        if any(regressed for name, ratio, regressed in comparison):
+            sys.exit(1)
+
+    return results
+
+
+if __name__ == '__main__':
+    main()
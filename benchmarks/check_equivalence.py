@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Check that get_states(), reduce_states() and get_states_i_diff() give the
+same output as the frozen reference implementations in
+``chandra_cmd_states.reference``.  Run this after any change to the state
+generation engine.
+
+The checks run on ``--n-random`` randomized command streams and on the
+commands recorded in the synthetic ``--fixture`` datasets of the benchmark
+suite and/or an existing commands database (``--server``).  The states are
+diffed column by column, with the float columns compared within the
+tolerances in ``chandra_cmd_states.equivalence.FLOAT_ATOL`` (override with
+``--atol COL=VALUE``).  The first divergence is printed and the exit status
+is 1.
+
+Usage: check_equivalence.py [options]::
+
+  # 50 random streams plus the small and medium synthetic datasets
+  check_equivalence.py --n-random 50 --fixture small --fixture medium
+
+  # Commands recorded in a database from 2012:001
+  check_equivalence.py --n-random 0 --server cmd_states.db3 --start 2012:001
+"""
+
+import os
+import sys
+import logging
+import argparse
+
+import chandra_cmd_states.equivalence as equivalence
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bench_suite  # noqa: E402
+
+
+def get_options(args=None):
+    parser = argparse.ArgumentParser(
+        description='Check state generation against the reference engine')
+    parser.add_argument('--n-random',
+                        type=int,
+                        default=20,
+                        help='Number of random command streams (default=20)')
+    parser.add_argument('--n-sets',
+                        type=int,
+                        default=200,
+                        help='Command sets per random stream (default=200)')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='Random seed of the first stream (default=0)')
+    parser.add_argument('--fixture',
+                        action='append',
+                        choices=sorted(bench_suite.FIXTURES),
+                        help='Synthetic benchmark dataset to check')
+    parser.add_argument('--data-dir',
+                        default='bench_data',
+                        help='Directory for synthetic datasets '
+                        '(default=bench_data)')
+    parser.add_argument('--server',
+                        help='Commands database to check')
+    parser.add_argument('--dbi',
+                        default='sqlite',
+                        help='Database interface for --server '
+                        '(default=sqlite)')
+    parser.add_argument('--user',
+                        help='Database user for --server')
+    parser.add_argument('--database',
+                        help='Database name for --server')
+    parser.add_argument('--start',
+                        default='2002:010',
+                        help='Start date for --server commands '
+                        '(default=2002:010)')
+    parser.add_argument('--stop',
+                        default='2099:001:00:00:00.000',
+                        help='Stop date for --server commands')
+    parser.add_argument('--mp-dir',
+                        help='Mission planning directory for --server '
+                        'backstop files')
+    parser.add_argument('--atol',
+                        action='append',
+                        default=[],
+                        metavar='COL=VALUE',
+                        help='Absolute tolerance for a float column')
+    parser.add_argument('--loglevel',
+                        type=int,
+                        default=20,
+                        help='Log level (default=20)')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    opt = get_options(args)
+    logging.basicConfig(level=opt.loglevel, format='%(message)s')
+
+    atol = dict(equivalence.FLOAT_ATOL)
+    for col_atol in opt.atol:
+        col, val = col_atol.split('=')
+        atol[col] = float(val)
+
+    divergence = equivalence.check_random(opt.n_random, opt.n_sets, opt.seed,
+                                          atol)
+
+    for fixture in opt.fixture or []:
+        if divergence:
+            break
+        import Ska.DBI
+        dataset = bench_suite.get_dataset(fixture, opt.data_dir, opt.seed)
+        db = Ska.DBI.DBI(dbi='sqlite', server=dataset['db_file'])
+        divergence = equivalence.check_db(db, dataset['datestart'],
+                                          mp_dir=dataset['mp_dir'],
+                                          atol=atol)
+
+    if opt.server and not divergence:
+        import Ska.DBI
+        db = Ska.DBI.DBI(dbi=opt.dbi, server=opt.server, user=opt.user,
+                         database=opt.database)
+        divergence = equivalence.check_db(db, opt.start, opt.stop,
+                                          mp_dir=opt.mp_dir, atol=atol)
+
+    if divergence:
+        print('DIVERGENCE {}'.format(divergence))
+        sys.exit(1)
+    print('All checks match the reference engine')
+
+
+if __name__ == '__main__':
+    main()
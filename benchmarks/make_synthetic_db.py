@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Make a self-consistent synthetic commanded states dataset for offline
+benchmarking and testing, without access to ``$SKA/data/cmd_states`` or the
+SOT MP load products.
+
+The output directory contains:
+
+- ``cmd_states.db3``: sqlite database made from the ``*_def.sql`` table
+  definitions with the load_segments, timelines, cmds, cmd_intpars,
+  cmd_fltpars and cmd_states tables and the timeline_loads view.
+- ``mplogs/<year>/<load>/oflsa/<load>.backstop``: backstop files for the
+  weekly loads, in the layout expected by ``get_cmds(mp_dir=...)``.
+- ``cmd_states.h5``: HDF5 mirror of the cmd_states table.
+
+Each week has a vehicle (SCS 128) load with the maneuvers and dither
+commands and an observing (SCS 131) load with obsid, SIM, grating and ACIS
+commands, plus filler commands that only appear in the backstop files.
+SCS107 and NSM interrupts are added at random with the given yearly rates as
+non-load commands, and the interrupted timelines are stopped as done by
+``interrupt_loads``.  The cmd_states table is made from the database
+commands with ``get_cmds`` and ``get_states``.
+
+The last ``--n-pending`` weeks have timelines and backstop files but no cmds
+or cmd_states rows, like new weekly products that ``update_cmd_states`` has
+not yet processed.  The same ``--seed`` always gives the same dataset.
+
+Usage: make_synthetic_db.py [options]::
+
+  # One year of mission, default seed
+  make_synthetic_db.py --outdir synth_1yr --years 1
+
+  # Mission-scale
+  make_synthetic_db.py --outdir synth_20yr --years 20 --start 2000:001
+"""
+
+import os
+import json
+import sqlite3
+import argparse
+import datetime
+import logging
+
+import numpy as np
+from Chandra.Time import DateTime
+
+import chandra_cmd_states as cmd_states
+
+# Table definitions are in the top level of the source repository
+SQL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SQL_TABLES = ('load_segments', 'timelines', 'timeline_loads',
+              'cmds', 'cmd_intpars', 'cmd_fltpars', 'cmd_states')
+
+VEHICLE_SCS = 128
+OBSERVING_SCS = 131
+
+# (instrument, SIM-Z translation position, probability)
+SIM_POSITIONS = (('ACIS-I', 92904, 0.4),
+                 ('ACIS-S', 75624, 0.4),
+                 ('HRC-I', -50504, 0.1),
+                 ('HRC-S', -99616, 0.1))
+
+ACIS_POWER_CMDS = ('WSPOW0CF3F', 'WSPOW08F3E', 'WSPOW1EC3F', 'WSPOW0002A')
+ACIS_SI_MODES = ('TE_00216', 'TE_0021C', 'CC_00014', 'TE_00B26')
+
+# Commands in backstop files that are not used for commanded states
+FILLER_CMDS = (dict(cmd='ORBPOINT', params=dict(TYPE='EPERIGEE')),
+               dict(cmd='COMMAND_HW', tlmsid='CNOOP', msid='CNOOPLR'),
+               dict(cmd='COMMAND_SW', tlmsid='COACTSX', msid='COACTSX'))
+
+MONTHS = ('JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
+          'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC')
+
+
+def random_attitude(rng):
+    """Random attitude quaternion uniform on the sky with random roll.
+
+    :param rng: numpy RandomState
+    :returns: list of 4 quaternion components
+    """
+    from Quaternion import Quat
+    ra = rng.uniform(0, 360)
+    dec = np.degrees(np.arcsin(rng.uniform(-1, 1)))
+    roll = rng.uniform(0, 360)
+    return Quat([ra, dec, roll]).q.tolist()
+
+
+def observation_cmd_sets(rng, time, obsid):
+    """Make the vehicle and observing command sets for one observation
+    starting at ``time``.
+
+    :param rng: numpy RandomState
+    :param time: start time (sec)
+    :param obsid: obsid
+    :returns: list of (time, cmd_set, scs) and end time of the observation
+    """
+    inst = rng.choice(len(SIM_POSITIONS),
+                      p=[x[2] for x in SIM_POSITIONS])
+    name, simpos, _ = SIM_POSITIONS[inst]
+    duration = rng.uniform(5e3, 6e4)
+    t_science = time + 1800
+
+    sets = [(time, cmd_states.cmd_set('manvr', *random_attitude(rng)),
+             VEHICLE_SCS),
+            (time + 60, cmd_states.cmd_set('obsid', obsid), OBSERVING_SCS),
+            (time + 120, (dict(cmd='SIMTRANS', params=dict(POS=simpos),
+                               dur=1.025),
+                          dict(cmd='SIMFOCUS',
+                               params=dict(POS=int(rng.randint(-600, -460))))),
+             OBSERVING_SCS)]
+
+    grating = rng.choice(['NONE', 'HETG', 'LETG'], p=[0.8, 0.15, 0.05])
+    if grating != 'NONE':
+        sets.append((time + 240, _sw_cmds('4O{}IN'.format(grating[:4])),
+                     OBSERVING_SCS))
+        sets.append((t_science + duration - 600,
+                     _sw_cmds('4O{}RE'.format(grating[:4])), OBSERVING_SCS))
+
+    if name.startswith('ACIS'):
+        si_mode = ACIS_SI_MODES[rng.randint(len(ACIS_SI_MODES))]
+        acis = (dict(cmd='ACISPKT', tlmsid='WSVIDALLDN', dur=1.025),
+                dict(cmd='ACISPKT', tlmsid=ACIS_POWER_CMDS[
+                    rng.randint(len(ACIS_POWER_CMDS))], dur=1.025),
+                dict(cmd='ACISPKT', tlmsid='W{}{}024'.format(si_mode[0],
+                                                             si_mode[3:]),
+                     dur=67.0),
+                dict(cmd='ACISPKT', tlmsid='XTZ0000005'))
+        sets.append((time + 300, acis, OBSERVING_SCS))
+        sets.append((t_science + duration - 300,
+                     (dict(cmd='ACISPKT', tlmsid='AA00000000', dur=10.25),
+                      dict(cmd='ACISPKT', tlmsid='WSPOW00000')),
+                     OBSERVING_SCS))
+
+    if rng.uniform() < 0.05:
+        sets.append((t_science + 60, cmd_states.cmd_set('dith_off'),
+                     VEHICLE_SCS))
+        sets.append((t_science + duration - 60, cmd_states.cmd_set('dith_on'),
+                     VEHICLE_SCS))
+
+    return sets, t_science + duration
+
+
+def _sw_cmds(tlmsid):
+    return (dict(cmd='COMMAND_SW', tlmsid=tlmsid, msid=tlmsid),)
+
+
+def backstop_cmds(time_cmd_sets, t_ref):
+    """Make backstop command dicts (like Ska.ParseCM.read_backstop()) for
+    ``time_cmd_sets``, in time order with step numbers per SCS.
+
+    :param time_cmd_sets: list of (time, cmd_set, scs)
+    :param t_ref: reference time for VCDU counts
+    :returns: list of command dicts
+    """
+    cmds = []
+    for time, cmd_set, scs in time_cmd_sets:
+        for cmd in cmd_set:
+            if 'cmd' in cmd:
+                bs_cmd = dict(cmd, time=time, scs=scs)
+                bs_cmd.pop('dur', None)
+                bs_cmd.setdefault('tlmsid', None)
+                bs_cmd.setdefault('msid', None)
+                cmds.append(bs_cmd)
+            time += cmd.get('dur', 0.0)
+
+    cmds.sort(key=lambda x: (x['time'], x['scs']))
+    dates = DateTime([cmd['time'] for cmd in cmds]).date
+    steps = {}
+    for cmd, date in zip(cmds, dates):
+        steps[cmd['scs']] = steps.get(cmd['scs'], 0) + 1
+        cmd['date'] = str(date)
+        cmd['step'] = steps[cmd['scs']]
+        cmd['vcdu'] = int((cmd['time'] - t_ref) / 0.25625) % 2 ** 24
+        params = {}
+        if cmd['tlmsid']:
+            params['TLMSID'] = cmd['tlmsid']
+        params.update((key, val.item() if isinstance(val, np.generic) else val)
+                      for key, val in cmd.get('params', {}).items())
+        if cmd['msid']:
+            params['MSID'] = cmd['msid']
+        params['SCS'] = cmd['scs']
+        params['STEP'] = cmd['step']
+        cmd['params'] = params
+        cmd['paramstr'] = ', '.join('{}= {!r}'.format(key, val)
+                                    if isinstance(val, float) else
+                                    '{}= {}'.format(key, val)
+                                    for key, val in params.items())
+    return cmds
+
+
+def write_backstop(filename, cmds):
+    """Write backstop ``cmds`` to ``filename``.
+
+    :param filename: backstop file name
+    :param cmds: list of command dicts
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w') as fh:
+        for cmd in cmds:
+            fh.write('{} | {:8d} 0 | {:16s} | {}\n'
+                     .format(cmd['date'], cmd['vcdu'], cmd['cmd'],
+                             cmd['paramstr']))
+
+
+def state_cmds(cmds, tl):
+    """Select commands from backstop ``cmds`` that ``get_cmds`` would store
+    for timeline load ``tl``.
+    """
+    return [cmd for cmd in cmds
+            if tl['datestart'] <= cmd['date'] <= tl['datestop']
+            and cmd['scs'] == tl['scs']
+            and cmd_states.is_state_cmd(cmd)]
+
+
+def insert_timelines(db, tls):
+    """Insert a load segment and timeline into ``db`` for each timeline load
+    dict in ``tls``.  The load segment id is the same as the timeline id.
+    """
+    for tl in tls:
+        db.execute("INSERT INTO load_segments VALUES "
+                   "({id}, '{name}', {year}, '{datestart}', '{datestop}', "
+                   "{scs}, 0)".format(**tl))
+        db.execute("INSERT INTO timelines VALUES "
+                   "({id}, {id}, '{mp_dir}', '{datestart}', '{datestop}', "
+                   "0, 0, 0)".format(**tl))
+
+
+def make_db(filename):
+    """Make an empty sqlite commanded states database ``filename``.
+    """
+    if os.path.exists(filename):
+        os.unlink(filename)
+    conn = sqlite3.connect(filename)
+    for table in SQL_TABLES:
+        with open(os.path.join(SQL_DIR, table + '_def.sql')) as fh:
+            conn.executescript(fh.read())
+    conn.close()
+
+
+def make_dataset(outdir, years=1.0, start='2005:001:00:00:00.000', seed=0,
+                 load_days=7, rate_scs107=3.0, rate_nsm=0.5, n_pending=1,
+                 h5=True):
+    """
+    Make a synthetic commanded states dataset in ``outdir``.
+
+    :param outdir: output directory
+    :param years: years of mission
+    :param start: start date
+    :param seed: random seed
+    :param load_days: length of each weekly load (days)
+    :param rate_scs107: SCS107 interrupts per year
+    :param rate_nsm: NSM interrupts per year
+    :param n_pending: number of final weeks without cmds or cmd_states
+    :param h5: make the HDF5 cmd_states mirror
+
+    :returns: dict of file names and row counts
+    """
+    import Ska.DBI
+
+    rng = np.random.RandomState(seed)
+    os.makedirs(outdir, exist_ok=True)
+    mp_dir = os.path.join(outdir, 'mplogs')
+    db_file = os.path.join(outdir, 'cmd_states.db3')
+    make_db(db_file)
+    db = Ska.DBI.DBI(dbi='sqlite', server=db_file)
+
+    t_start = DateTime(start).secs
+    n_loads = int(np.ceil(years * 365.25 / load_days))
+    load_secs = load_days * 86400.0
+    obsid = 10000
+    time = t_start + 600
+    out = {'n_loads': n_loads, 'n_interrupts': 0, 'backstop_files': []}
+    pending = []
+
+    for i_load in range(n_loads):
+        tl_start = t_start + i_load * load_secs
+        tl_stop = tl_start + load_secs
+        date_start, date_stop = DateTime([tl_start, tl_stop]).date
+        year, doy = int(date_start[:4]), int(date_start[5:8])
+        day = datetime.date(year, 1, 1) + datetime.timedelta(doy - 1)
+        load_name = '{}{:02d}{:02d}'.format(MONTHS[day.month - 1], day.day,
+                                            year % 100)
+        tl_dir = '/{}/{}/oflsa/'.format(year, load_name)
+
+        # Observations in this load, starting after any interrupt gap
+        time = max(time, tl_start + 600)
+        time_cmd_sets = []
+        while True:
+            sets, time_end = observation_cmd_sets(rng, time, obsid)
+            if time_end > tl_stop - 600:
+                break
+            time_cmd_sets.extend(sets)
+            for i_fill in range(rng.randint(2, 6)):
+                time_cmd_sets.append(
+                    (rng.uniform(time, time_end),
+                     (FILLER_CMDS[rng.randint(len(FILLER_CMDS))],),
+                     OBSERVING_SCS))
+            obsid += 1
+            time = time_end
+
+        bs_cmds = backstop_cmds(time_cmd_sets, t_start)
+        bs_file = os.path.join(mp_dir + tl_dir, load_name + '.backstop')
+        write_backstop(bs_file, bs_cmds)
+        out['backstop_files'].append(bs_file)
+
+        # Vehicle and observing load segments and timelines
+        tls = []
+        for i_scs, (scs, prefix) in enumerate(((VEHICLE_SCS, 'VL'),
+                                              (OBSERVING_SCS, 'CL'))):
+            tls.append(dict(id=i_load * 2 + i_scs + 1,
+                            name='{}{:03d}:{:02d}00'.format(prefix, doy, i_scs),
+                            year=year, datestart=date_start,
+                            datestop=date_stop, scs=scs, mp_dir=tl_dir))
+
+        # Pending loads are added after making cmd_states
+        if i_load >= n_loads - n_pending:
+            pending.append(tls)
+            continue
+
+        insert_timelines(db, tls)
+        for tl in tls:
+            cmd_states.insert_cmds_db(state_cmds(bs_cmds, tl), tl['id'], db)
+
+        # SCS107 (observing loads only) or NSM (all loads) interrupt
+        p_nsm = rate_nsm * load_days / 365.25
+        p_scs107 = rate_scs107 * load_days / 365.25
+        interrupt = rng.choice(['none', 'nsm', 'scs107'],
+                               p=[1 - p_nsm - p_scs107, p_nsm, p_scs107])
+        if interrupt != 'none':
+            date = DateTime(rng.uniform(tl_start + 86400,
+                                        tl_stop - 86400)).date
+            nl_cmds = cmd_states.generate_cmds(date,
+                                               cmd_states.cmd_set(interrupt))
+            cmd_states.insert_cmds_db(nl_cmds, None, db)
+            cmd_states.interrupt_loads(date, db,
+                                       observing_only=(interrupt == 'scs107'),
+                                       current_only=True)
+            out['n_interrupts'] += 1
+            # Next observation starts in the next week
+            time = tl_stop
+
+    # Commanded states from the database commands
+    state0 = dict(cmd_states.STATE0, datestart=DateTime(t_start).date)
+    cmds = cmd_states.get_cmds_table(state0['datestart'], db=db,
+                                     mp_dir=mp_dir)
+    states = cmd_states.get_states(state0, cmds)
+    cols = states.dtype.names
+    db.conn.cursor().executemany(
+        'INSERT INTO cmd_states ({}) VALUES ({})'
+        .format(', '.join(cols), ', '.join('?' for col in cols)),
+        states.tolist())
+    db.conn.commit()
+
+    for tls in pending:
+        insert_timelines(db, tls)
+
+    if h5:
+        import tables
+        from chandra_cmd_states.update_cmd_states import CMD_STATES_DTYPE
+        h5_file = os.path.join(outdir, 'cmd_states.h5')
+        rows = np.empty(len(states), dtype=CMD_STATES_DTYPE)
+        for name in rows.dtype.names:
+            rows[name][:] = states[name]
+        filters = tables.Filters(complevel=5, complib='zlib')
+        with tables.open_file(h5_file, mode='w', filters=filters) as h5:
+            h5.create_table(h5.root, 'data', rows, "Cmd_states",
+                            expectedrows=len(rows))
+        out['h5file'] = h5_file
+
+    for table in ('timelines', 'cmds', 'cmd_intpars', 'cmd_fltpars',
+                  'cmd_states'):
+        out['n_' + table] = int(db.fetchone('SELECT count(*) AS n FROM {}'
+                                            .format(table))['n'])
+    db.conn.close()
+
+    out.update(db_file=db_file, mp_dir=mp_dir,
+               pending_timelines=[tl['id'] for tls in pending for tl in tls],
+               datestart=DateTime(t_start).date,
+               datestop=DateTime(t_start + n_loads * load_secs).date)
+    return out
+
+
+def get_options(args=None):
+    parser = argparse.ArgumentParser(
+        description='Make a synthetic commanded states dataset')
+    parser.add_argument('--outdir',
+                        default='synthetic',
+                        help='Output directory (default=synthetic)')
+    parser.add_argument('--years',
+                        type=float,
+                        default=1.0,
+                        help='Years of mission (default=1)')
+    parser.add_argument('--start',
+                        default='2005:001:00:00:00.000',
+                        help='Start date (default=2005:001)')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='Random seed (default=0)')
+    parser.add_argument('--load-days',
+                        type=float,
+                        default=7.0,
+                        help='Days in each weekly load (default=7)')
+    parser.add_argument('--rate-scs107',
+                        type=float,
+                        default=3.0,
+                        help='SCS107 interrupts per year (default=3)')
+    parser.add_argument('--rate-nsm',
+                        type=float,
+                        default=0.5,
+                        help='NSM interrupts per year (default=0.5)')
+    parser.add_argument('--n-pending',
+                        type=int,
+                        default=1,
+                        help='Final loads without cmds or cmd_states '
+                        '(default=1)')
+    parser.add_argument('--no-h5',
+                        action='store_true',
+                        help='Do not make the HDF5 cmd_states mirror')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    opt = get_options(args)
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    out = make_dataset(opt.outdir, years=opt.years, start=opt.start,
+                       seed=opt.seed, load_days=opt.load_days,
+                       rate_scs107=opt.rate_scs107, rate_nsm=opt.rate_nsm,
+                       n_pending=opt.n_pending, h5=not opt.no_h5)
+    summary = dict(out, backstop_files=len(out['backstop_files']))
+    print(json.dumps(summary, indent=2))
+    return out
+
+
+if __name__ == '__main__':
+    main()
@@ -20,7 +20,7 @@ else:
 
 import ska_helpers
 from .cmd_states import *
-from .get_cmd_states import fetch_states
+from .get_cmd_states import fetch_states, fetch_states_many, states_at, fetch_intervals
 
 __version__ = ska_helpers.get_version('chandra_cmd_states')
 
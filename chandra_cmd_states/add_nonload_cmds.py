@@ -11,10 +11,20 @@ Usage: add_nonload_cmds.py [options] [cmd_set_arg1 ...]::
    --server=SERVER       DBI server (<filename>|sybase)
    --check               Check for recent non-load commands and do not generate
                          commands
+   --n-recent=N          Number of recent non-load commands to show (0 for no
+                         limit, default=10)
+   --recent-start=DATE   Show only recent non-load commands at or after DATE
    --date=DATE           Date for command set
    --cmd-set=CMD_SET     Command set name (obsid|manvr|scs107|nsm|acis)
    --loglevel=LOGLEVEL   Log level (10=debug, 20=info, 30=warnings)
    --archive-file=FILE   Archive file for storing nonload cmd sets
+   --archive-data-file=FILE
+                         Structured (JSON lines) archive file for storing
+                         nonload cmd sets
+   --load-archive        Validate the structured archive and load all
+                         non-load commands from it into the database
+   --convert-archive     Write the structured archive (which must not exist)
+                         from the Python archive file
    --interrupt           Interrupt timelines and load_segments after ``date``
    --observing-only      Interrupt only 'observing' timelines
 
@@ -23,6 +33,9 @@ Examples::
   # Print recent non-load commands
   add_nonload_cmds.py --check
 
+  # Print all non-load commands since 2012:001
+  add_nonload_cmds.py --check --recent-start 2012:001 --n-recent 0
+
   # Add a maneuver to RA, Dec, Roll = 10, 20, 30
   add_nonload_cmds.py --date '2009:065:12:13:14' --cmd-set manvr 10 20 30
 
@@ -33,16 +46,45 @@ Examples::
   # Add ACIS CTI commanding
   add_nonload_cmds.py --date '2012:072:20:52:00.000' --cmd-set aciscti
 
+  # Make the structured archive from the Python archive (once), check it
+  # against the database and then replace all non-load commands with it
+  add_nonload_cmds.py --convert-archive --archive-file nonload_cmds_archive.py \
+                      --archive-data-file nonload_cmds_archive.jsonl
+  add_nonload_cmds.py --load-archive --archive-data-file nonload_cmds_archive.jsonl --dry-run
+  add_nonload_cmds.py --load-archive --archive-data-file nonload_cmds_archive.jsonl
+
+Each command set is appended to two archives.  The ``--archive-file`` is
+Python code which replays the command set through ``generate_cmds()``.  The
+``--archive-data-file`` has one JSON record per line with the date, cmd_set
+name and args, the fully generated commands and any load interrupt, e.g.::
+
+  {"date": "2012:072:20:52:00.000", "cmd_set": "aciscti", "args": [],
+   "cmds": [{"date": "2012:072:20:52:00.000", "time": 447886386.184,
+             "cmd": "ACISPKT", "tlmsid": "WSVIDALLDN", "msid": null}, ...],
+   "interrupt": null}
+
 """
 from __future__ import print_function
 
+import io
+import os
+import re
+import ast
 import sys
-import logging
+import json
 import time
+import types
+import logging
+import contextlib
+from collections import Counter
 
+import numpy as np
 
 import chandra_cmd_states as cmd_states
-from chandra_cmd_states.cmd_states import _tl_to_bs_cmds
+from chandra_cmd_states.cmd_states import (_get_cmds_rows, _get_cmds_tables,
+                                           _insert_rows, STATE_PAR_COLS)
+from chandra_cmd_states import queries
+from chandra_cmd_states.profiling import profiled, PROFILE_HELP
 import Ska.DBI
 from Chandra.Time import DateTime
 import Ska.ParseCM
@@ -50,7 +92,8 @@ import Ska.ParseCM
 
 def get_options():
     from optparse import OptionParser
-    parser = OptionParser(usage="usage: %prog [options] [cmd_set_arg1 ...]")
+    parser = OptionParser(usage="usage: %prog [options] [cmd_set_arg1 ...]",
+                          epilog=PROFILE_HELP)
     parser.set_defaults()
     parser.add_option("--date",
                       help="Date for command set")
@@ -73,6 +116,14 @@ def get_options():
     parser.add_option("--check",
                       action="store_true",
                       help="Show recent non-load commands and exit")
+    parser.add_option("--n-recent",
+                      type='int',
+                      default=10,
+                      help="Number of recent non-load commands to show "
+                           "(0 for no limit, default=10)")
+    parser.add_option("--recent-start",
+                      help="Show only recent non-load commands at or after "
+                           "this date")
     parser.add_option("--dbi",
                       default='sqlite',
                       help="Database interface (sqlite|sybase)")
@@ -84,6 +135,18 @@ def get_options():
     parser.add_option("--archive-file",
                       default="nonload_cmds_archive.py",
                       help='Archive file for storing nonload cmd sets')
+    parser.add_option("--archive-data-file",
+                      default="nonload_cmds_archive.jsonl",
+                      help='Structured (JSON lines) archive file for storing '
+                           'nonload cmd sets')
+    parser.add_option("--load-archive",
+                      action="store_true",
+                      help="Validate the structured archive and load all "
+                           "non-load commands from it into the database")
+    parser.add_option("--convert-archive",
+                      action="store_true",
+                      help="Write the structured archive (which must not "
+                           "exist) from the Python archive file")
     (opt, args) = parser.parse_args()
     return (opt, args)
 
@@ -101,6 +164,353 @@ def log_cmds(cmds):
                       str(cmd['msid']), paramstr))
 
 
+def get_recent_nonload_cmds(db, n_cmds=10, start=None):
+    """
+    Get the most recent non-load commands from the database, newest first.
+
+    Only the selected commands are read from the ``cmds`` table (the row limit
+    is applied in the query) and parameters are read only for those commands,
+    so the cost does not grow with the full non-load command history.
+
+    :param db: Ska.DBI db object
+    :param n_cmds: maximum number of commands (None or 0 for no limit)
+    :param start: only get commands at or after this date (default=no limit)
+
+    :returns: list of command dicts with params ala _tl_to_bs_cmds()
+    """
+    nl_cmds = db.fetchall(queries.recent_nonload_cmds(n_cmds, start, db.dbi))
+
+    par_cols = set(col for name, col in STATE_PAR_COLS)
+    bs_cmds = [dict((col, row[col]) for col in nl_cmds.dtype.names
+                    if col not in par_cols)
+               for row in nl_cmds]
+    if not bs_cmds:
+        return bs_cmds
+
+    cmd_index = dict((cmd['id'], cmd) for cmd in bs_cmds)
+    cmd_ids = ','.join(str(int(cmd_id)) for cmd_id in cmd_index)
+    for par_table in ('cmd_intpars', 'cmd_fltpars'):
+        params = db.fetchall('SELECT * FROM %s WHERE cmd_id IN (%s)'
+                             % (par_table, cmd_ids))
+        for par in params:
+            cmd_index[par.cmd_id].setdefault('params', {})[par.name] = par.value
+
+    return bs_cmds
+
+
+def make_archive_record(date, cmd_set_name, cmd_set_args, cmds,
+                        interrupt=False, observing_only=None):
+    """Make a structured archive record for a non-load command set.
+
+    Interrupts are recorded with ``current_only=True`` because on replay the
+    subsequent timelines already reflect any following replan.
+
+    :param date: date of command set
+    :param cmd_set_name: command set name
+    :param cmd_set_args: list of command set args
+    :param cmds: list of command dicts from generate_cmds()
+    :param interrupt: command set interrupted the loads
+    :param observing_only: interrupt only 'observing' timelines
+    :returns: dict
+    """
+    archive_cmds = []
+    for cmd in cmds:
+        archive_cmd = dict((key, _json_value(val)) for key, val in cmd.items()
+                           if key not in ('params', 'paramstr'))
+        if cmd.get('params'):
+            archive_cmd['params'] = dict((key, _json_value(val))
+                                         for key, val in cmd['params'].items())
+        archive_cmds.append(archive_cmd)
+
+    return {'date': date,
+            'cmd_set': cmd_set_name,
+            'args': [_json_value(arg) for arg in cmd_set_args],
+            'cmds': archive_cmds,
+            'interrupt': ({'observing_only': observing_only,
+                           'current_only': True}
+                          if interrupt else None)}
+
+
+def _json_value(val):
+    """Convert numpy scalar ``val`` to the equivalent Python type for JSON.
+    """
+    return val.item() if isinstance(val, np.generic) else val
+
+
+def append_archive(record, filename):
+    """Append the structured archive ``record`` to ``filename``.
+    """
+    with open(filename, 'a') as fh:
+        fh.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+RE_DATE = re.compile(r'^\d{4}:\d{3}:\d{2}:\d{2}:\d{2}\.\d{3}$')
+
+
+def read_archive(filename):
+    """Read and validate the structured non-load commands archive ``filename``.
+
+    Every record is checked before anything is returned so a problem
+    anywhere in the archive is found before touching the database.  As a
+    final check the command times are compared with the command dates.
+
+    :param filename: JSON lines archive file
+    :returns: list of archive records
+    """
+    records = []
+    with open(filename, 'r') as fh:
+        for lineno, line in enumerate(fh, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                _validate_archive_record(record)
+            except (ValueError, TypeError, KeyError) as err:
+                raise ValueError('{}:{}: invalid archive record: {}'
+                                 .format(filename, lineno, err))
+            records.append(record)
+
+    cmds = [cmd for record in records for cmd in record['cmds']]
+    if cmds:
+        dates = [cmd['date'] for cmd in cmds]
+        times = np.array([cmd['time'] for cmd in cmds], dtype=float)
+        bad = np.abs(DateTime(dates).secs - times) > 0.001
+        if np.any(bad):
+            cmd = cmds[np.flatnonzero(bad)[0]]
+            raise ValueError('{}: command time {} does not match date {}'
+                             .format(filename, cmd['time'], cmd['date']))
+
+    return records
+
+
+def _validate_archive_record(record):
+    """Check the structure and types of one structured archive ``record``.
+    """
+    for key in ('date', 'cmd_set', 'args', 'cmds', 'interrupt'):
+        if key not in record:
+            raise KeyError('missing key {!r}'.format(key))
+    if not RE_DATE.match(record['date']):
+        raise ValueError('bad date {!r}'.format(record['date']))
+    if not isinstance(record['cmds'], list):
+        raise TypeError('cmds must be a list')
+    if record['interrupt'] is not None:
+        if not isinstance(record['interrupt'].get('current_only'), bool):
+            raise TypeError('interrupt current_only must be a bool')
+
+    for cmd in record['cmds']:
+        if not RE_DATE.match(cmd['date']):
+            raise ValueError('bad command date {!r}'.format(cmd['date']))
+        if not isinstance(cmd['time'], (int, float)):
+            raise TypeError('bad command time {!r}'.format(cmd['time']))
+        if not cmd['cmd'] or not isinstance(cmd['cmd'], str):
+            raise TypeError('bad command {!r}'.format(cmd['cmd']))
+        for key in ('tlmsid', 'msid'):
+            if not isinstance(cmd.get(key), (str, type(None))):
+                raise TypeError('bad command {} {!r}'.format(key, cmd[key]))
+        for key in ('vcdu', 'step', 'scs'):
+            if not isinstance(cmd.get(key), (int, type(None))):
+                raise TypeError('bad command {} {!r}'.format(key, cmd[key]))
+        for name, value in cmd.get('params', {}).items():
+            if not isinstance(value, (int, float, str)):
+                raise TypeError('bad command param {}={!r}'.format(name, value))
+
+
+def _cmd_key(cmd):
+    """Key (date, cmd, tlmsid) used to match database and archive commands.
+    """
+    return (str(cmd['date']), str(cmd['cmd']), cmd['tlmsid'] or None)
+
+
+def check_archive_coverage(records, db):
+    """Check that every non-load command in ``db`` is in the archive
+    ``records``, matching commands by date, type and TLMSID.
+
+    :param records: list of archive records
+    :param db: Ska.DBI.DBI object
+    :raises ValueError: if any database non-load command is not in the archive
+    """
+    archive_keys = Counter(_cmd_key(cmd) for record in records
+                           for cmd in record['cmds'])
+    db_cmds = db.fetchall('SELECT date, cmd, tlmsid FROM cmds '
+                          'WHERE timeline_id IS NULL ORDER BY date')
+    db_keys = Counter(_cmd_key(cmd) for cmd in db_cmds)
+    missing = db_keys - archive_keys
+    if missing:
+        first = min(missing)
+        raise ValueError('{} non-load commands in the database are not in '
+                         'the archive (first is {} {} {}), not replacing '
+                         'them'.format(sum(missing.values()), *first))
+
+
+def load_archive(filename, db, dry_run=False):
+    """Replace all non-load commands in ``db`` with the commands in the
+    structured archive ``filename``.
+
+    The whole archive is validated first and every non-load command already
+    in ``db`` must be in it (see :func:`check_archive_coverage`).  Then the
+    existing non-load commands are deleted, the archived commands are
+    inserted in bulk and the load interrupts in the archive are replayed, all
+    in a single transaction.
+
+    :param filename: JSON lines archive file
+    :param db: Ska.DBI.DBI object
+    :param dry_run: only validate the archive and report what would be
+                    replaced, without changing ``db``
+    :returns: list of archive records
+    """
+    records = read_archive(filename)
+    cmds = [cmd for record in records for cmd in record['cmds']]
+    logging.info('Read %d non-load command sets with %d commands from %s'
+                 % (len(records), len(cmds), filename))
+    check_archive_coverage(records, db)
+
+    if dry_run:
+        n_old = db.fetchone('SELECT count(*) AS n FROM cmds '
+                            'WHERE timeline_id IS NULL')['n']
+        n_interrupts = sum(record['interrupt'] is not None
+                           for record in records)
+        logging.info('Dry run: would replace %d non-load commands with %d '
+                     'and replay %d load interrupts'
+                     % (n_old, len(cmds), n_interrupts))
+        return records
+
+    # Look up the table columns first since that query commits
+    cmds_tables = _get_cmds_tables(db)
+    try:
+        cursor = db.conn.cursor()
+        for table in ('cmd_intpars', 'cmd_fltpars', 'cmds'):
+            cursor.execute('DELETE FROM %s WHERE timeline_id IS NULL' % table)
+        cursor.close()
+
+        cmd_id = db.fetchone('SELECT max(id) AS max_id FROM cmds')['max_id'] or 0
+        rows = _get_cmds_rows(cmds, None, cmd_id)
+        for table, cols in cmds_tables:
+            _insert_rows(db, table, cols, rows[table])
+
+        for record in records:
+            if record['interrupt'] is not None:
+                cmd_states.interrupt_loads(record['date'], db, commit=False,
+                                           **record['interrupt'])
+        db.conn.commit()
+    except Exception:
+        db.conn.rollback()
+        raise
+    logging.info('Loaded %d non-load commands' % len(cmds))
+
+    return records
+
+
+class _ArchiveCmdSet(tuple):
+    """Command set from cmd_set() tagged with its name and args"""
+
+
+def convert_archive(archive_file):
+    """Convert the Python non-load commands archive ``archive_file`` (see
+    ``--archive-file``) to structured archive records.
+
+    The archive script is run with its database access replaced by recorders.
+    Each ``generate_cmds()`` call whose commands are passed to
+    ``insert_cmds_db()`` gives a record with the command set name and args
+    (None and [] for a hand-written command set).  Each
+    ``interrupt_loads()`` call is added to the last record at the same date,
+    or else gives a record without commands, so the interrupts are replayed
+    in the order of the archive.
+
+    :param archive_file: Python archive file
+    :returns: list of archive records in the order of the archive
+    """
+    with open(archive_file, 'r') as fh:
+        source = fh.read()
+    # Old parts of the archive use Python 2 print statements
+    source = re.sub(r'^(\s*)print (.+)$', r'\1print(\2)', source,
+                    flags=re.MULTILINE)
+    tree = ast.parse(source, archive_file)
+    # Drop the imports, option parsing and database connection
+    skip_names = set(['opt', 'args', 'db'])
+    tree.body = [node for node in tree.body
+                 if not isinstance(node, (ast.Import, ast.ImportFrom,
+                                          ast.FunctionDef))
+                 and not (isinstance(node, ast.Assign)
+                          and skip_names.intersection(
+                              name.id for target in node.targets
+                              for name in ast.walk(target)
+                              if isinstance(name, ast.Name)))]
+
+    records = []
+    cmd_records = {}
+
+    def cmd_set(name, *args):
+        out = _ArchiveCmdSet(cmd_states.cmd_set(name, *args))
+        out.name, out.args = name, list(args)
+        return out
+
+    def generate_cmds(date, cmd_set):
+        date = DateTime(date).date
+        cmds = cmd_states.generate_cmds(date, cmd_set)
+        record = make_archive_record(date, getattr(cmd_set, 'name', None),
+                                     getattr(cmd_set, 'args', []), cmds)
+        record['inserted'] = False
+        records.append(record)
+        for cmd in cmds:
+            cmd_records[id(cmd)] = record
+        return cmds
+
+    def insert_cmds_db(cmds, timeline_id, db):
+        for cmd in cmds:
+            cmd_records[id(cmd)]['inserted'] = True
+
+    def interrupt_loads(datestop, db, observing_only=False,
+                        current_only=False):
+        date = DateTime(datestop).date
+        interrupt = {'observing_only': observing_only,
+                     'current_only': bool(current_only)}
+        for record in reversed(records):
+            if record['date'] == date and record['interrupt'] is None:
+                record['interrupt'] = interrupt
+                return
+        record = make_archive_record(date, None, [], [])
+        record.update(interrupt=interrupt, inserted=True)
+        records.append(record)
+
+    class RecordingDB(object):
+        def execute(self, *args, **kwargs):
+            pass
+
+    shim = types.SimpleNamespace(cmd_set=cmd_set, generate_cmds=generate_cmds,
+                                 insert_cmds_db=insert_cmds_db,
+                                 interrupt_loads=interrupt_loads)
+    namespace = {'__name__': '__archive__', 'cmd_states': shim,
+                 'cmd_set': cmd_set, 'generate_cmds': generate_cmds,
+                 'interrupt_loads': interrupt_loads, 'db': RecordingDB()}
+    with contextlib.redirect_stdout(io.StringIO()):
+        exec(compile(tree, archive_file, 'exec'), namespace)
+
+    out = []
+    for record in records:
+        if not record.pop('inserted'):
+            if record['interrupt'] is None:
+                continue
+            record['cmds'] = []
+        out.append(record)
+    return out
+
+
+def write_archive(records, filename):
+    """Write the structured archive ``records`` to the new file ``filename``.
+
+    :param records: list of archive records
+    :param filename: JSON lines archive file, which must not exist
+    """
+    if os.path.exists(filename):
+        raise IOError('{} already exists'.format(filename))
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as fh:
+        for record in records:
+            fh.write(json.dumps(record, sort_keys=True) + '\n')
+    os.replace(tmp_filename, filename)
+
+
+@profiled
 def main():
     opt, args = get_options()
     cmd_set_args = [Ska.ParseCM._coerce_type(x) for x in args]
@@ -110,17 +520,26 @@ def main():
                         format='%(message)s',
                         stream=sys.stdout)
 
+    if opt.convert_archive:
+        records = convert_archive(opt.archive_file)
+        logging.info('Writing %d non-load command sets to %s'
+                     % (len(records), opt.archive_data_file))
+        if not opt.dry_run:
+            write_archive(records, opt.archive_data_file)
+        sys.exit(0)
+
     logging.info('Connecting to db: dbi=%s server=%s' % (opt.dbi, opt.server))
     db = Ska.DBI.DBI(dbi=opt.dbi, server=opt.server,
                      user=opt.user, database=opt.database, verbose=False)
 
+    if opt.load_archive:
+        load_archive(opt.archive_data_file, db, dry_run=opt.dry_run)
+        sys.exit(0)
+
     # Print information about recent non-load commands
-    nl_cmds = db.fetchall("SELECT * FROM cmds "
-                          "WHERE timeline_id IS NULL ORDER BY date DESC")
-    # Convert from np.recarray to list of dict (with params included)
-    nl_cmds = _tl_to_bs_cmds(nl_cmds, None, db)
+    nl_cmds = get_recent_nonload_cmds(db, opt.n_recent, opt.recent_start)
     logging.info('Most recent non-load commands')
-    log_cmds(nl_cmds[:10])
+    log_cmds(nl_cmds)
     logging.info('')
 
     # Jump out if only doing a check
@@ -160,6 +579,16 @@ def main():
                     "observing_only=%s, current_only=True)" %
                     (date, opt.observing_only)), file=f)
 
+    # Append the same command set to the structured archive
+    record = make_archive_record(date, opt.cmd_set, cmd_set_args, cmds,
+                                 interrupt=opt.interrupt,
+                                 observing_only=opt.observing_only)
+    if opt.dry_run:
+        print(json.dumps(record, sort_keys=True))
+    else:
+        logging.info('Appending cmd_set record to %s' % opt.archive_data_file)
+        append_archive(record, opt.archive_data_file)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,181 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Cache of the NPNT anchor states used as ``state0``.
+
+The state0 for a date is the last NPNT state with ``datestop`` (or
+``datestart``) before that date.  For each cached day the cache keeps the
+state0 at the start of the day (the anchor) and the NPNT states that end
+during the day, so the state0 for any date in the day is found with a
+binary search instead of a database query.  See the ``anchor_cache``
+argument of :func:`~chandra_cmd_states.cmd_states.get_state0` and
+:func:`~chandra_cmd_states.cmd_states.get_state0_many`.
+
+Only days that end before the definitive date (see ``date_margin`` of
+``get_state0``) are added, since those states are assumed not to change,
+and only the days of the requested dates are added so the cache stays
+small.  ``update_cmd_states --anchor-cache`` drops the cached days from the
+start of each update on, so reprocessed states never leave stale anchors.
+
+The cache can be kept in a JSON file, which is replaced atomically on each
+save so that processes sharing it never read a partial file.  A save is
+merged with the file as it is then, so days added or dropped by another
+process since the file was read are kept.
+"""
+
+import os
+import json
+import bisect
+
+from Chandra.Time import DateTime
+
+CACHE_VERSION = 1
+
+
+def get_day(date):
+    """
+    Get the day ('YYYY:DDD') of ``date``.
+
+    :param date: date string
+    :returns: day string
+    """
+    return date[:8]
+
+
+def get_day_start(day):
+    """
+    Get the date at the start of ``day``.
+
+    :param day: day string ('YYYY:DDD')
+    :returns: date string
+    """
+    return day + ':00:00:00.000'
+
+
+def get_next_day(day):
+    """
+    Get the day after ``day``.
+
+    :param day: day string ('YYYY:DDD')
+    :returns: day string
+    """
+    return get_day(DateTime(DateTime(day + ':12:00:00').secs + 86400.).date)
+
+
+def _drop_days(days, day0):
+    n_dropped = 0
+    for datepar_days in days.values():
+        for day in [day for day in datepar_days if day >= day0]:
+            del datepar_days[day]
+            n_dropped += 1
+    return n_dropped
+
+
+def _json_state(state):
+    if state is None:
+        return None
+    return dict((key, val.item() if hasattr(val, 'item') else val)
+                for key, val in state.items())
+
+
+class AnchorCache(object):
+    """
+    NPNT anchor states by day, kept in the JSON file ``filename`` or only in
+    memory if ``filename`` is None.
+
+    :param filename: cache file name (optional)
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.days = self._read()
+        # Changes since the last save
+        self.added = set()
+        self.day0_dropped = None
+
+    def _read(self):
+        days = {'datestart': {}, 'datestop': {}}
+        if self.filename and os.path.exists(self.filename):
+            with open(self.filename) as fh:
+                cache = json.load(fh)
+            if cache.get('version') == CACHE_VERSION:
+                days.update(cache['days'])
+        return days
+
+    def has_day(self, day, datepar='datestop'):
+        """
+        Check if ``day`` is cached.
+
+        :param day: day string ('YYYY:DDD')
+        :param datepar: table parameter for select (datestop|datestart)
+        :returns: bool
+        """
+        return day in self.days[datepar]
+
+    def get(self, date, datepar='datestop'):
+        """
+        Get the last NPNT state with ``datepar`` before ``date`` from the
+        cache.
+
+        :param date: date string
+        :param datepar: table parameter for select (datestop|datestart)
+        :returns: state dict or None if there is no NPNT state before date
+        :raises KeyError: if the day of ``date`` is not cached
+        """
+        states = self.days[datepar][get_day(date)]
+        anchor, day_states = states[0], states[1:]
+        idx = bisect.bisect_left([state[datepar] for state in day_states],
+                                 date)
+        state = day_states[idx - 1] if idx > 0 else anchor
+        return None if state is None else dict(state)
+
+    def add(self, day, anchor, day_states, datepar='datestop'):
+        """
+        Add ``day`` to the cache.
+
+        :param day: day string ('YYYY:DDD')
+        :param anchor: last NPNT state with ``datepar`` before the day, or
+                       None if there is none
+        :param day_states: NPNT states with ``datepar`` in the day, in time
+                           order
+        :param datepar: table parameter for select (datestop|datestart)
+        """
+        self.days[datepar][day] = ([_json_state(anchor)]
+                                   + [_json_state(state)
+                                      for state in day_states])
+        self.added.add((datepar, day))
+
+    def invalidate(self, datestart):
+        """
+        Drop the cached days that can depend on states at or after
+        ``datestart``, i.e. the days that end after it.
+
+        :param datestart: date string
+        :returns: number of dropped days
+        """
+        day0 = get_day(datestart)
+        if self.day0_dropped is None or day0 < self.day0_dropped:
+            self.day0_dropped = day0
+        self.added = set((datepar, day) for datepar, day in self.added
+                         if day < day0)
+        return _drop_days(self.days, day0)
+
+    def save(self):
+        """
+        Write the cache file if the cache changed, via a temporary file so a
+        failed write never leaves a partial file.
+        """
+        if not self.filename or (not self.added
+                                 and self.day0_dropped is None):
+            return
+        days = self._read()
+        if self.day0_dropped is not None:
+            _drop_days(days, self.day0_dropped)
+        for datepar, day in self.added:
+            days[datepar][day] = self.days[datepar][day]
+
+        tmp_filename = '{}.{}.tmp'.format(self.filename, os.getpid())
+        with open(tmp_filename, 'w') as fh:
+            json.dump({'version': CACHE_VERSION, 'days': days}, fh)
+        os.replace(tmp_filename, self.filename)
+        self.days = days
+        self.added = set()
+        self.day0_dropped = None
@@ -5,22 +5,27 @@ the Chandra commanded states database.
 """
 
 import re
+import numbers
 import logging
 import os
 import time
-import pprint
+from contextlib import nullcontext
 
 import numpy as np
+import six
 from six.moves import range
 
-import Ska.File
-import Ska.DBI
 from Chandra.Time import DateTime
-import Chandra.Maneuver
-from Quaternion import Quat
-import Ska.Sun
-import Ska.ParseCM
-import Ska.Numpy
+
+from . import queries
+from . import anchors
+from .metrics import Metrics
+from . import trace
+
+# The state generation dependencies (Ska.File, Ska.DBI, Chandra.Maneuver,
+# Quaternion, Ska.Sun, Ska.ParseCM) are imported within the functions that
+# use them.  This keeps ``import chandra_cmd_states`` fast for the common case
+# of only reading states with fetch_states().
 
 # Canonical state0 giving spacecraft state at beginning of timelines
 # 2002:007:13 fetch --start 2002:007:13:00:00 --stop 2002:007:13:02:00 aoattqt1
@@ -53,6 +58,56 @@ STATE0 = {'ccd_count': 5,
           'dither': 'None'}
 
 
+# Command parameters used by get_states() and the cmds table columns that
+# also store them
+STATE_PAR_COLS = (('ID', 'par_id'),
+                  ('POS', 'par_pos'),
+                  ('Q1', 'par_q1'),
+                  ('Q2', 'par_q2'),
+                  ('Q3', 'par_q3'),
+                  ('Q4', 'par_q4'))
+
+# Columns of the commands tables in the order used for bulk inserts
+CMDS_COLS = ('id', 'timeline_id', 'date', 'time', 'cmd', 'tlmsid', 'msid',
+             'vcdu', 'step', 'scs') + tuple(col for name, col in STATE_PAR_COLS)
+CMD_PARS_COLS = ('cmd_id', 'timeline_id', 'name', 'value')
+CMDS_TABLES = (('cmds', CMDS_COLS),
+               ('cmd_intpars', CMD_PARS_COLS),
+               ('cmd_fltpars', CMD_PARS_COLS))
+
+# Command types that can change the commanded state.  In a command table the
+# ``cmd`` column is the index of the command type in this tuple.
+CMD_TYPES = ('GET_PITCH', 'ACISPKT', 'COMMAND_HW', 'COMMAND_SW', 'MP_OBSID',
+             'MP_TARGQUAT', 'SIMFOCUS', 'SIMTRANS')
+CMD_CODES = dict((cmd_type, code) for code, cmd_type in enumerate(CMD_TYPES))
+
+# Compact command table used by get_cmds() and get_states().  The state
+# parameters (see STATE_PAR_COLS) are NaN when not set for a command.
+CMDS_TABLE_DTYPE = np.dtype([('date', 'U21'),
+                             ('time', 'f8'),
+                             ('cmd', 'u1'),
+                             ('tlmsid', 'U10'),
+                             ('msid', 'U8')]
+                            + [(col, 'f8') for name, col in STATE_PAR_COLS])
+
+# State parameters that are ints in command dicts
+INT_STATE_PARS = ('ID', 'POS')
+
+# State parameters that get_states() needs for each command type
+REQUIRED_STATE_PARS = {'MP_OBSID': ('ID',),
+                       'SIMTRANS': ('POS',),
+                       'SIMFOCUS': ('POS',),
+                       'MP_TARGQUAT': ('Q1', 'Q2', 'Q3', 'Q4')}
+
+# Values of cmd or tlmsid for backstop commands that get_cmds() retains
+STATE_CMD_TYPES = set(('MP_OBSID', 'SIMTRANS', 'SIMFOCUS',
+                       'ACISPKT', 'MP_TARGQUAT'))
+STATE_TLMSIDS = set(('AONM2NPE', 'AONM2NPD', 'AONMMODE',
+                     'AONPMODE', 'AOMANUVR', 'AONSMSAF',
+                     '4OHETGRE', '4OLETGRE', '4OHETGIN',
+                     '4OLETGIN', 'AOENDITH', 'AODSDITH'))
+
+
 def decode_power(mnem):
     """
     Decode number of chips and feps from a ACIS power command
@@ -142,14 +197,18 @@ def _make_pitch_cmds(datestart, datestop, sample_time=10000.):
     tstart = np.floor(DateTime(datestart).secs / sample_time) * sample_time
     tstop = DateTime(datestop).secs
     times = np.arange(tstart, tstop, sample_time)
-    out = [{'cmd': 'GET_PITCH',
-            'tlmsid': 'GET_PITCH',
-            'date': DateTime(t).date}
-            for t in times]
+    out = np.zeros(len(times), dtype=CMDS_TABLE_DTYPE)
+    out['cmd'] = CMD_CODES['GET_PITCH']
+    out['tlmsid'] = 'GET_PITCH'
+    out['time'] = times
+    if len(times) > 0:
+        out['date'] = DateTime(times).date
+    for name, col in STATE_PAR_COLS:
+        out[col] = np.nan
     return out
 
 
-def get_states(state0, cmds, exclude=None):
+def get_states(state0, cmds, exclude=None, metrics=None):
     """Get states resulting from the spacecraft commands ``cmds`` starting
     from an initial ``state0``.
 
@@ -190,24 +249,40 @@ def get_states(state0, cmds, exclude=None):
      dither        varchar       4
     ============   =========   ====
 
-    The input commands must be a list of dicts including keys ``date, vcdu,
-    cmd, params, time``.  See also Ska.ParseCM.read_backstop().
+    The input commands are a command table (see :func:`cmds_as_table`) as
+    returned by :func:`get_cmds_table` and :func:`generate_cmds_many`, or a
+    list of dicts including keys ``date, vcdu, cmd, params, time``.  See also
+    Ska.ParseCM.read_backstop().
 
     :param state0: initial state.
-    :param cmds: list of commands
+    :param cmds: command table or list of command dicts
     :param ignore: list or set of state keys to ignore
+    :param metrics: Metrics object for stage timing and counters (optional,
+                    default=None for no metrics)
 
     :returns: recarray of states starting with state0 (which might be modified)
     """
+    import Chandra.Maneuver
+    from Quaternion import Quat
+    import Ska.Sun
+
+    # Check once which trace events are enabled so that the command loop does
+    # no formatting work when tracing is off.
+    trace_manvr = trace.enabled('maneuver')
+    trace_step = trace.enabled('maneuver_step')
+    trace_pitch = trace.enabled('pitch')
 
     logging.debug('get_states: starting from %s' % state0['datestart'])
 
+    # Other command types cannot change the state so they are dropped
+    cmds = cmds_as_table(cmds, strict=False)
+
     curr_att = [state0[x] for x in ('q1', 'q2', 'q3', 'q4')]
 
     # Add extra mocked-up cmds to sample pitch
-    pitch_cmds = _make_pitch_cmds(state0['datestart'], cmds[-1]['date'])
-    cmds.extend(pitch_cmds)
-    cmds.sort(key=lambda y: y['date'])
+    pitch_cmds = _make_pitch_cmds(state0['datestart'], cmds['date'][-1])
+    cmds = np.concatenate([cmds, pitch_cmds])
+    cmds = cmds[np.argsort(cmds['date'], kind='stable')]
 
     # A transition is a dictionary of state updates occuring at one time, e.g.
     # {'simpos': -99616, 'pcad_mode': 'NMAN'}. The transition dicts are
@@ -215,144 +290,159 @@ def get_states(state0, cmds, exclude=None):
     # commands at the same time can easily be accumulated to a single
     # transition.  Also use the dictionary to store a value for the
     # last transition date.
-    transitions = {'last_date': cmds[0]['date']}
-
-    cmds_after_state0 = [x for x in cmds if x['date'] > state0['datestart']]
-
-    for cmd in cmds_after_state0:
-        params = cmd.get('params', {})
-        # Following two might not be in cmd
-        tlmsid = cmd['tlmsid'] or params.get('TLMSID', '')
-        cmd_type = cmd['cmd']
-        date = cmd['date']
-
-        # Make a convenience function to add to transitions at command date
-        add_trans = _make_add_trans(transitions, date, exclude)
-
-        # Obsid
-        if cmd_type == 'MP_OBSID':
-            add_trans(obsid=params['ID'])
-
-        # Mocked-up cmds to sample pitch
-        elif cmd_type == 'GET_PITCH':
-            # If we have made transitions with dates after
-            # this mock command (maneuver transitions),
-            # skip the 'GET_PITCH'
-            if cmd['date'] < transitions['last_date']:
-                continue
-            q_att = Quat(curr_att)
-            # add pitch/attitude commands
-            pitch = Ska.Sun.pitch(q_att.ra, q_att.dec, date)
-            add_trans(pitch=pitch)
-
-        # SIM Z
-        elif cmd_type == 'SIMTRANS':
-            add_trans(simpos=params['POS'])
-
-        # SIM focus
-        elif cmd_type == 'SIMFOCUS':
-            add_trans(simfa_pos=params['POS'])
-
-        # ACIS power command section
-        elif cmd_type == 'ACISPKT':
-            if tlmsid.startswith('WSPOW'):
-                pwr = decode_power(tlmsid)
-                add_trans(fep_count=pwr['fep_count'],
-                          ccd_count=pwr['ccd_count'],
-                          vid_board=pwr['vid_board'],
-                          clocking=pwr['clocking'],
-                          power_cmd=tlmsid)
-
-            elif re.match(r'X(T|C)Z0000005', tlmsid):
-                add_trans(clocking=1, power_cmd=tlmsid)
-
-            elif tlmsid == 'WSVIDALLDN':
-                add_trans(vid_board=0, ccd_count=0,
-                          power_cmd=tlmsid)
-
-            elif tlmsid == 'AA00000000':
-                add_trans(clocking=0, power_cmd=tlmsid)
-
-            elif tlmsid == 'WSFEPALLUP':
-                add_trans(fep_count=6, power_cmd=tlmsid)
-
-            elif tlmsid.startswith('WC'):
-                add_trans(si_mode='CC_' + tlmsid[2:7])
-
-            elif tlmsid.startswith('WT'):
-                add_trans(si_mode='TE_' + tlmsid[2:7])
-
-        # Set the target attitude
-        elif cmd_type == 'MP_TARGQUAT':
-            targ_att = [params[x] for x in ('Q1', 'Q2', 'Q3', 'Q4')]
-
-        # Specify auto transition to NPNT with star acq after maneuver
-        elif cmd_type == 'COMMAND_SW' and re.match('AONM2NP(E|D)', tlmsid):
-            auto_npnt = (tlmsid == 'AONM2NPE')
-
-        # Transition to NMM
-        elif cmd_type == 'COMMAND_SW' and tlmsid == 'AONMMODE':
-            add_trans(pcad_mode='NMAN')
-
-        # Transition to NPM
-        elif cmd_type == 'COMMAND_SW' and tlmsid == 'AONPMODE':
-            add_trans(pcad_mode='NPNT')
-
-        # Transition to HETG inserted
-        elif cmd_type == 'COMMAND_SW' and tlmsid == '4OHETGIN':
-            add_trans(hetg='INSR')
-
-        # Transition to HETG retracted
-        elif cmd_type == 'COMMAND_SW' and tlmsid == '4OHETGRE':
-            add_trans(hetg='RETR')
-
-        # Transition to LETG inserted
-        elif cmd_type == 'COMMAND_SW' and tlmsid == '4OLETGIN':
-            add_trans(letg='INSR')
-
-        # Transition to LETG retracted
-        elif cmd_type == 'COMMAND_SW' and tlmsid == '4OLETGRE':
-            add_trans(letg='RETR')
-
-        elif cmd_type == 'COMMAND_SW' and tlmsid == 'AOENDITH':
-            add_trans(dither='ENAB')
-
-        elif cmd_type == 'COMMAND_SW' and tlmsid == 'AODSDITH':
-            add_trans(dither='DISA')
-
-        # Start a maneuver to targ_att or else to normal sun pointed attitude
-        # via normal sun mode
-        elif cmd_type == 'COMMAND_SW' and tlmsid in ('AOMANUVR', 'AONSMSAF'):
-            if tlmsid == 'AONSMSAF':
-                add_trans(pcad_mode='NSUN')
-                targ_att = Chandra.Maneuver.NSM_attitude(curr_att, cmd['time'])
-                auto_npnt = False
-
-            # add pitch/attitude commands
-            atts = Chandra.Maneuver.attitudes(curr_att, targ_att,
-                                              tstart=cmd['time'])
-            logging.debug('Maneuver at {0} {1}\nfrom {2}\nto {3}'.format(
-                DateTime(cmd['time']).date, cmd['time'], curr_att, targ_att))
-            logging.debug(Ska.Numpy.pformat(atts))
-            pitches = np.hstack([(atts[:-1].pitch + atts[1:].pitch) / 2,
-                                 atts[-1].pitch])
-            for att, pitch in zip(atts, pitches):
-                q_att = Quat([att[x] for x in ('q1', 'q2', 'q3', 'q4')])
-                add_trans(date=DateTime(att.time).date,
-                          pitch=pitch,
-                          q1=att.q1, q2=att.q2, q3=att.q3, q4=att.q4,
-                          ra=q_att.ra, dec=q_att.dec, roll=q_att.roll)
-                logging.debug(pprint.pformat(dict(date=DateTime(att.time).date,
-                          pitch=pitch,
-                          q1=att.q1, q2=att.q2, q3=att.q3, q4=att.q4,
-                          ra=q_att.ra, dec=q_att.dec, roll=q_att.roll)))
-            # If auto-transition to NPM after manvr is enabled (this is
-            # normally the case) then back to NPNT at end of maneuver
-            if auto_npnt:
-                add_trans(date=DateTime(atts[-1].time).date, pcad_mode='NPNT')
-
-            # update the current attitude to the target attitude
-            curr_att = targ_att
+    transitions = {'last_date': str(cmds['date'][0])}
+
+    cmds_after_state0 = cmds[cmds['date'] > state0['datestart']]
+    cmd_cols = [cmds_after_state0[name].tolist()
+                for name in ('date', 'time', 'cmd', 'tlmsid', 'par_id',
+                             'par_pos', 'par_q1', 'par_q2', 'par_q3', 'par_q4')]
+
+    # Time the whole command loop as one stage (most of it is the pitch
+    # sampling and maneuvers) and count in locals so that the loop does no
+    # metrics work per command.
+    n_pitch = n_manvr = n_manvr_steps = 0
+    loop_stage = (nullcontext() if metrics is None
+                  else metrics.stage('get_states.transitions'))
+    with loop_stage:
+        for (date, cmd_time, code, tlmsid, par_id, par_pos,
+             *targ_q) in zip(*cmd_cols):
+            cmd_type = CMD_TYPES[code]
+
+            # Make a convenience function to add to transitions at command date
+            add_trans = _make_add_trans(transitions, date, exclude)
+
+            # Obsid
+            if cmd_type == 'MP_OBSID':
+                add_trans(obsid=int(par_id))
+
+            # Mocked-up cmds to sample pitch
+            elif cmd_type == 'GET_PITCH':
+                # If we have made transitions with dates after
+                # this mock command (maneuver transitions),
+                # skip the 'GET_PITCH'
+                if date < transitions['last_date']:
+                    continue
+                q_att = Quat(curr_att)
+                # add pitch/attitude commands
+                pitch = Ska.Sun.pitch(q_att.ra, q_att.dec, date)
+                add_trans(pitch=pitch)
+                if trace_pitch:
+                    trace.event('pitch', 'pitch', date=date, pitch=pitch)
+                n_pitch += 1
+
+            # SIM Z
+            elif cmd_type == 'SIMTRANS':
+                add_trans(simpos=int(par_pos))
+
+            # SIM focus
+            elif cmd_type == 'SIMFOCUS':
+                add_trans(simfa_pos=int(par_pos))
+
+            # ACIS power command section
+            elif cmd_type == 'ACISPKT':
+                if tlmsid.startswith('WSPOW'):
+                    pwr = decode_power(tlmsid)
+                    add_trans(fep_count=pwr['fep_count'],
+                              ccd_count=pwr['ccd_count'],
+                              vid_board=pwr['vid_board'],
+                              clocking=pwr['clocking'],
+                              power_cmd=tlmsid)
+
+                elif re.match(r'X(T|C)Z0000005', tlmsid):
+                    add_trans(clocking=1, power_cmd=tlmsid)
+
+                elif tlmsid == 'WSVIDALLDN':
+                    add_trans(vid_board=0, ccd_count=0,
+                              power_cmd=tlmsid)
+
+                elif tlmsid == 'AA00000000':
+                    add_trans(clocking=0, power_cmd=tlmsid)
+
+                elif tlmsid == 'WSFEPALLUP':
+                    add_trans(fep_count=6, power_cmd=tlmsid)
+
+                elif tlmsid.startswith('WC'):
+                    add_trans(si_mode='CC_' + tlmsid[2:7])
+
+                elif tlmsid.startswith('WT'):
+                    add_trans(si_mode='TE_' + tlmsid[2:7])
+
+            # Set the target attitude
+            elif cmd_type == 'MP_TARGQUAT':
+                targ_att = targ_q
+
+            # Specify auto transition to NPNT with star acq after maneuver
+            elif cmd_type == 'COMMAND_SW' and re.match('AONM2NP(E|D)', tlmsid):
+                auto_npnt = (tlmsid == 'AONM2NPE')
+
+            # Transition to NMM
+            elif cmd_type == 'COMMAND_SW' and tlmsid == 'AONMMODE':
+                add_trans(pcad_mode='NMAN')
+
+            # Transition to NPM
+            elif cmd_type == 'COMMAND_SW' and tlmsid == 'AONPMODE':
+                add_trans(pcad_mode='NPNT')
+
+            # Transition to HETG inserted
+            elif cmd_type == 'COMMAND_SW' and tlmsid == '4OHETGIN':
+                add_trans(hetg='INSR')
+
+            # Transition to HETG retracted
+            elif cmd_type == 'COMMAND_SW' and tlmsid == '4OHETGRE':
+                add_trans(hetg='RETR')
+
+            # Transition to LETG inserted
+            elif cmd_type == 'COMMAND_SW' and tlmsid == '4OLETGIN':
+                add_trans(letg='INSR')
+
+            # Transition to LETG retracted
+            elif cmd_type == 'COMMAND_SW' and tlmsid == '4OLETGRE':
+                add_trans(letg='RETR')
+
+            elif cmd_type == 'COMMAND_SW' and tlmsid == 'AOENDITH':
+                add_trans(dither='ENAB')
+
+            elif cmd_type == 'COMMAND_SW' and tlmsid == 'AODSDITH':
+                add_trans(dither='DISA')
+
+            # Start a maneuver to targ_att or else to normal sun pointed
+            # attitude via normal sun mode
+            elif (cmd_type == 'COMMAND_SW'
+                  and tlmsid in ('AOMANUVR', 'AONSMSAF')):
+                if tlmsid == 'AONSMSAF':
+                    add_trans(pcad_mode='NSUN')
+                    targ_att = Chandra.Maneuver.NSM_attitude(curr_att,
+                                                             cmd_time)
+                    auto_npnt = False
+
+                # add pitch/attitude commands
+                atts = Chandra.Maneuver.attitudes(curr_att, targ_att,
+                                                  tstart=cmd_time)
+                if trace_manvr:
+                    trace.event('maneuver', 'maneuver', date=date,
+                                time=cmd_time, from_att=curr_att,
+                                to_att=targ_att, atts=atts)
+                pitches = np.hstack([(atts[:-1].pitch + atts[1:].pitch) / 2,
+                                     atts[-1].pitch])
+                att_dates = DateTime(atts.time).date.tolist()
+                for att, att_date, pitch in zip(atts, att_dates, pitches):
+                    q_att = Quat([att[x] for x in ('q1', 'q2', 'q3', 'q4')])
+                    trans = dict(pitch=pitch,
+                                 q1=att.q1, q2=att.q2, q3=att.q3, q4=att.q4,
+                                 ra=q_att.ra, dec=q_att.dec, roll=q_att.roll)
+                    add_trans(date=att_date, **trans)
+                    if trace_step:
+                        trace.event('maneuver_step', 'maneuver_step',
+                                    date=att_date, **trans)
+                # If auto-transition to NPM after manvr is enabled (this is
+                # normally the case) then back to NPNT at end of maneuver
+                if auto_npnt:
+                    add_trans(date=att_dates[-1], pcad_mode='NPNT')
+                n_manvr += 1
+                n_manvr_steps += len(atts)
+
+                # update the current attitude to the target attitude
+                curr_att = targ_att
 
     # Delete the last_date bookkeeping key
     # It is no longer needed and would break the following loop
@@ -369,6 +459,12 @@ def get_states(state0, cmds, exclude=None):
         states.append(new_state)
 
     logging.debug('get_states: found %d states' % len(states))
+    if metrics is not None:
+        metrics.count('get_states.cmds', len(cmds_after_state0))
+        metrics.count('get_states.states', len(states))
+        metrics.count('get_states.pitch_samples', n_pitch)
+        metrics.count('get_states.maneuvers', n_manvr)
+        metrics.count('get_states.maneuver_steps', n_manvr_steps)
 
     # Set datestop values to be the datestart of the next state.  Last state
     # is given a datestop far in the future
@@ -386,7 +482,8 @@ def get_states(state0, cmds, exclude=None):
     return np.rec.fromrecords(staterecs, names=statecols)
 
 
-def get_state0(date=None, db=None, date_margin=10, datepar='datestop'):
+def get_state0(date=None, db=None, date_margin=10, datepar='datestop',
+               anchor_cache=None):
     """From the cmd_states table get the last state with ``datepar`` before
     ``date``.
 
@@ -400,32 +497,37 @@ def get_state0(date=None, db=None, date_margin=10, datepar='datestop'):
      that pcad_mode == 'NPNT') will be used.  In this case a ``date`` must be
      supplied.
 
+     With an ``anchor_cache`` (see :mod:`chandra_cmd_states.anchors`) the
+     state is looked up in the cache first and the cache is filled with the
+     day of ``date`` if that day is definitive.  The cache is not used if
+     ``date_margin`` is None.
+
     :param db: Ska.DBI.DBI object.  Created automatically if not supplied.
     :param date: date cutoff for state0 (Chandra.Time compatible value) or None
     :param date_margin: days before current time for definitive values or None
     :param datepar: table parameter for select (datestop|datestart)
+    :param anchor_cache: AnchorCache object (optional)
 
     :returns: ``state0``
     :rtype: dict
     """
+    if anchor_cache is not None and date_margin is not None:
+        dates = [_get_definitive_date(date_margin) if date is None else date]
+        return get_state0_many(dates, db, date_margin, datepar,
+                               anchor_cache)[0]
+
     if db is None:
-        db = Ska.DBI.DBI(dbi='sqlite',
-                         server=os.path.join(
-                             os.environ['SKA'], 'data', 'cmd_states', 'cmd_states.db3'))
+        db = _get_default_db()
     if date is not None:
         date = DateTime(date).date
 
     if date_margin is not None:
         # Date for which cmd_states are certainly reliable
-        definitive_date = DateTime(time.time() - date_margin * 86400.,
-                                   format='unix').date
+        definitive_date = _get_definitive_date(date_margin)
         if date is None or date > definitive_date:
             date = definitive_date
 
-    state0 = db.fetchone("""SELECT * FROM cmd_states
-                            WHERE %s < '%s'
-                            AND pcad_mode = 'NPNT'
-                            ORDER BY %s DESC""" % (datepar, date, datepar))
+    state0 = db.fetchone(queries.state0(date, datepar, dbi=db.dbi))
 
     if state0:
         logging.debug('get_state0: found definitive state at %s'
@@ -438,21 +540,140 @@ def get_state0(date=None, db=None, date_margin=10, datepar='datestop'):
     return state0 or STATE0
 
 
-def _tl_to_bs_cmds(tl_cmds, tl_id, db):
+def get_state0_many(dates, db=None, date_margin=10, datepar='datestop',
+                    anchor_cache=None):
+    """Get the state0 for each of ``dates``, i.e. the same as
+    ``[get_state0(date, db, date_margin, datepar) for date in dates]``.
+
+    Instead of one query per date this does two queries: the last NPNT state
+    before the earliest date and all NPNT states between the earliest and
+    latest dates.  Each date is then matched to its state with a binary
+    search.
+
+    With an ``anchor_cache`` (see :mod:`chandra_cmd_states.anchors`) the
+    dates in cached days are looked up without any query, and the queries
+    for the other dates cover their whole days so that the definitive ones
+    are added to the cache.  The cache is not used if ``date_margin`` is
+    None.
+
+    :param dates: list of dates (Chandra.Time compatible values)
+    :param db: Ska.DBI.DBI object.  Created automatically if not supplied.
+    :param date_margin: days before current time for definitive values or None
+    :param datepar: table parameter for select (datestop|datestart)
+    :param anchor_cache: AnchorCache object (optional)
+
+    :returns: list of ``state0`` dicts
+    """
+    if len(dates) == 0:
+        return []
+    dates = np.atleast_1d(DateTime(dates).date)
+
+    definitive_date = None
+    if date_margin is not None:
+        definitive_date = _get_definitive_date(date_margin)
+        dates = np.where(dates > definitive_date, definitive_date, dates)
+    else:
+        anchor_cache = None
+
+    states0 = [None] * len(dates)
+    i_dates = list(range(len(dates)))
+    if anchor_cache is not None:
+        i_dates = [i for i, date in enumerate(dates)
+                   if not anchor_cache.has_day(anchors.get_day(date), datepar)]
+        for i in set(range(len(dates))) - set(i_dates):
+            states0[i] = anchor_cache.get(dates[i], datepar) or dict(STATE0)
+        logging.debug('get_state0_many: found {} of {} dates in anchor cache'
+                      .format(len(dates) - len(i_dates), len(dates)))
+        if not i_dates:
+            return states0
+
+    if db is None:
+        db = _get_default_db()
+    query_dates = [dates[i] for i in i_dates]
+    date_min = min(query_dates)
+    date_max = max(query_dates)
+    if anchor_cache is not None:
+        date_min = anchors.get_day_start(anchors.get_day(date_min))
+        date_max = anchors.get_day_start(
+            anchors.get_next_day(anchors.get_day(date_max)))
+
+    states = []
+    state0 = db.fetchone(queries.state0(date_min, datepar, dbi=db.dbi))
+    if state0:
+        states.append(state0)
+    npnt_states = db.fetchall(queries.npnt_states(date_min, date_max, datepar))
+    names = npnt_states.dtype.names
+    states.extend(dict(zip(names, row)) for row in npnt_states.tolist())
+    state_dates = [state[datepar] for state in states]
+
+    # Index of the last state with datepar < date, or -1 if there is none
+    idxs = np.searchsorted(state_dates, query_dates) - 1
+    logging.debug('get_state0_many: found {} NPNT states for {} dates'
+                  .format(len(states), len(query_dates)))
+
+    # Return a copy for each date since get_states() may modify state0
+    for i, idx in zip(i_dates, idxs):
+        states0[i] = dict(states[idx] if idx >= 0 else STATE0)
+
+    if anchor_cache is not None:
+        for day in set(anchors.get_day(date) for date in query_dates):
+            next_day = anchors.get_next_day(day)
+            if anchors.get_day_start(next_day) > definitive_date:
+                continue
+            i0, i1 = np.searchsorted(state_dates,
+                                     [anchors.get_day_start(day),
+                                      anchors.get_day_start(next_day)])
+            anchor_cache.add(day, states[i0 - 1] if i0 > 0 else None,
+                             states[i0:i1], datepar)
+        anchor_cache.save()
+
+    return states0
+
+
+def _get_default_db():
+    import Ska.DBI
+    return Ska.DBI.DBI(dbi='sqlite',
+                       server=os.path.join(
+                           os.environ['SKA'], 'data', 'cmd_states', 'cmd_states.db3'))
+
+
+def _get_definitive_date(date_margin):
+    """Date for which cmd_states are certainly reliable"""
+    return DateTime(time.time() - date_margin * 86400., format='unix').date
+
+
+def _tl_to_bs_cmds(tl_cmds, tl_id, db, state_pars_only=False):
     """
     Convert the commands ``tl_cmds`` (numpy recarray) that occur in the
     timeline ``tl_id'' to a format mimicking backstop commands from
     Ska.ParseCM.read_backstop().  This includes reading parameter values
     from the ``db``.
 
+    If ``state_pars_only`` is True and ``tl_cmds`` has the state parameter
+    columns (see ``STATE_PAR_COLS``) then only those parameters are included
+    and they are taken directly from ``tl_cmds``, so the parameter tables are
+    not read.
+
     :param tl_cmds: numpy recarray of commands from timeline load segment
     :param tl_id: timeline id
     :param db: Ska.DBI db object
+    :param state_pars_only: only include parameters used by get_states()
 
     :returns: list of command dicts
     """
-    bs_cmds = [dict((col, row[col]) for col in tl_cmds.dtype.names)
+    par_cols = set(col for name, col in STATE_PAR_COLS)
+    cols = tl_cmds.dtype.names or ()
+    bs_cmds = [dict((col, row[col]) for col in cols if col not in par_cols)
                for row in tl_cmds]
+
+    if state_pars_only and par_cols.issubset(cols):
+        for bs_cmd, row in zip(bs_cmds, tl_cmds):
+            params = dict((name, row[col]) for name, col in STATE_PAR_COLS
+                          if row[col] is not None)
+            if params:
+                bs_cmd['params'] = params
+        return bs_cmds
+
     cmd_index = dict((x['id'], x) for x in bs_cmds)
 
     # Add 'params' dict of command parameter key=val pairs to each tl_cmd
@@ -474,7 +695,7 @@ def _tl_to_bs_cmds(tl_cmds, tl_id, db):
 def get_cmds(datestart='1998:001:00:00:00.000',
              datestop='2099:001:00:00:00.000',
              db=None, update_db=None, timeline_loads=None,
-             mp_dir=f'{os.environ["SKA"]}/data/mpcrit1/mplogs'):
+             mp_dir=f'{os.environ["SKA"]}/data/mpcrit1/mplogs', metrics=None):
     """Get all commands with ``datestart`` < date <= ``datestop`` using DBI
     object ``db``.  This includes both commands already in the database and new
     commands.  If ``update_db`` is True then update the database cmds table
@@ -492,34 +713,87 @@ def get_cmds(datestart='1998:001:00:00:00.000',
     supplemented by backstop commands found in the SOTMP repository of load
     products.
 
+    See :func:`get_cmds_table` for the same commands as a compact command
+    table, which is faster to get and to pass to :func:`get_states`.
+
     :param datestart: start date (Chandra.Time 'date' str) (default=1998:001)
     :param datestop: stop date (default=2099:001)
     :param db: Ska.DBI.DBI object (required)
     :param update_db: update the 'cmds' table
+    :param metrics: Metrics object for stage timing and counters (optional)
 
     :returns: ``cmds``
     :rtype: list of dicts
     """
+    cmds = _get_cmds(datestart, datestop, db, update_db, timeline_loads,
+                     mp_dir, metrics, as_table=False)
+
+    # Filter commands on date and sort by date.
+    # IS THE "datestart <=" CORRECT?  docstring above says "<".  ?????
+    return sorted((x for x in cmds if datestart <= x['date'] <= datestop),
+                  key=lambda y: y['date'])
+
+
+def get_cmds_table(datestart='1998:001:00:00:00.000',
+                   datestop='2099:001:00:00:00.000',
+                   db=None, update_db=None, timeline_loads=None,
+                   mp_dir=f'{os.environ["SKA"]}/data/mpcrit1/mplogs',
+                   metrics=None):
+    """Get the commands of :func:`get_cmds` as a command table (see
+    :func:`cmds_as_table`) for :func:`get_states`.
+
+    Commands from a migrated database are converted directly from the cmds
+    table columns without reading the parameter tables.  The table only has
+    the state parameters of the commands, so use :func:`get_cmds` for the
+    full command dicts.
+
+    :param datestart: start date (Chandra.Time 'date' str) (default=1998:001)
+    :param datestop: stop date (default=2099:001)
+    :param db: Ska.DBI.DBI object (required)
+    :param update_db: update the 'cmds' table
+    :param metrics: Metrics object for stage timing and counters (optional)
+
+    :returns: command table sorted by date
+    """
+    cmds = np.concatenate(_get_cmds(datestart, datestop, db, update_db,
+                                    timeline_loads, mp_dir, metrics,
+                                    as_table=True))
+    cmds = cmds[(cmds['date'] >= datestart) & (cmds['date'] <= datestop)]
+    return cmds[np.argsort(cmds['date'], kind='stable')]
+
+
+def _get_cmds(datestart, datestop, db, update_db, timeline_loads, mp_dir,
+              metrics, as_table):
+    """
+    Get the commands for :func:`get_cmds` (``as_table=False``, list of
+    command dicts) or :func:`get_cmds_table` (``as_table=True``, list of
+    command tables) before the final date filter and sort.
+    """
+    import Ska.File
+    import Ska.ParseCM
+
+    if metrics is None:
+        metrics = Metrics()
+
+    if as_table:
+        db_cmds_as = _db_cmds_as_table
+    else:
+        db_cmds_as = _tl_to_bs_cmds
+
     # Get timeline_loads including and after datestart
     if timeline_loads is None:
-        timeline_loads = db.fetchall("""SELECT * from timeline_loads
-                                        WHERE datestop > '%s'""" % datestart)
+        timeline_loads = db.fetchall(queries.timeline_loads(datestart))
 
     # Get non-load commands (from autonomous or ground SCS107, NSM, etc)
-    nl_cmds = db.fetchall("""SELECT * from cmds where timeline_id IS NULL""")
-    cmds = _tl_to_bs_cmds(nl_cmds, None, db)
-
-    # Values of cmd or tlmsid for commands that are retained
-    cmd_types = set(('MP_OBSID', 'SIMTRANS', 'SIMFOCUS',
-                     'ACISPKT', 'MP_TARGQUAT'))
-    tlmsids = set(('AONM2NPE', 'AONM2NPD', 'AONMMODE',
-                   'AONPMODE', 'AOMANUVR', 'AONSMSAF',
-                   '4OHETGRE', '4OLETGRE', '4OHETGIN',
-                   '4OLETGIN', 'AOENDITH', 'AODSDITH'))
+    with metrics.stage('get_cmds.db'):
+        nl_cmds = db.fetchall(queries.nonload_cmds(datestart, datestop))
+        nl_cmds = db_cmds_as(nl_cmds, None, db)
+    cmds = [nl_cmds] if as_table else list(nl_cmds)
+    metrics.count('get_cmds.nonload_cmds', len(nl_cmds))
 
     for tl in timeline_loads:
-        tl_cmds = db.fetchall("SELECT * from cmds WHERE timeline_id = %d"
-                              % tl.id)
+        with metrics.stage('get_cmds.db'):
+            tl_cmds = db.fetchall(queries.timeline_cmds(tl.id))
 
         logging.debug('get_cmds: got %3d cmds from db for timeline_id=%d '
                       '(%s - %s)'
@@ -528,20 +802,25 @@ def get_cmds(datestart='1998:001:00:00:00.000',
         # If not yet in DB then read from MP backstop file.  Put into DB if
         # needed.
         if len(tl_cmds) == 0:
-            bs_file = Ska.File.get_globfiles(os.path.join(mp_dir + tl.mp_dir,
-                                                          '*.backstop'))[0]
-            bs_cmds = Ska.ParseCM.read_backstop(bs_file)
-            # Retain state-changing cmds within timeline for database
-            bs_cmds = [x for x in bs_cmds
-                       if tl.datestart <= x['date'] <= tl.datestop
-                       and (x['cmd'] in cmd_types or x['params'].get('TLMSID')
-                            in tlmsids)]
-            # Only store commands for this timelines's scs
-            bs_cmds = [x for x in bs_cmds if x['scs'] == tl['scs']]
+            with metrics.stage('get_cmds.backstop'):
+                bs_file = Ska.File.get_globfiles(
+                    os.path.join(mp_dir + tl.mp_dir, '*.backstop'))[0]
+                bs_cmds = Ska.ParseCM.read_backstop(bs_file)
+                # Retain state-changing cmds within timeline for database
+                bs_cmds = [x for x in bs_cmds
+                           if tl.datestart <= x['date'] <= tl.datestop
+                           and is_state_cmd(x)]
+                # Only store commands for this timelines's scs
+                bs_cmds = [x for x in bs_cmds if x['scs'] == tl['scs']]
             logging.info('get_cmds: got %d commands from %s'
                          % (len(bs_cmds), bs_file))
+            metrics.count('get_cmds.timelines_backstop')
+            metrics.count('get_cmds.backstop_cmds', len(bs_cmds))
             if update_db and bs_cmds:
-                insert_cmds_db(bs_cmds, tl.id, db)
+                with metrics.stage('get_cmds.insert_cmds_db'):
+                    insert_cmds_db(bs_cmds, tl.id, db)
+            if as_table:
+                bs_cmds = cmds_as_table(bs_cmds, strict=False)
         else:
             # Check for commands before the timeline start, which is a problem.
             if any(tl_cmds.date < tl.datestart):
@@ -557,16 +836,75 @@ def get_cmds(datestart='1998:001:00:00:00.000',
                 # Filter out commands after tl.datestop
                 tl_cmds = tl_cmds[np.logical_not(after)]
 
+            metrics.count('get_cmds.timelines_db')
+            metrics.count('get_cmds.db_cmds', len(tl_cmds))
             # Now flatten to a list of dicts to emulate read_backstop and
-            # incorporate params
-            bs_cmds = _tl_to_bs_cmds(tl_cmds, tl.id, db)
+            # incorporate params, or convert to a command table
+            with metrics.stage('get_cmds.db'):
+                bs_cmds = db_cmds_as(tl_cmds, tl.id, db)
 
-        cmds.extend(bs_cmds)
+        if as_table:
+            cmds.append(bs_cmds)
+        else:
+            cmds.extend(bs_cmds)
+
+    metrics.hit_rate('get_cmds.timelines_db_hit_rate',
+                     'get_cmds.timelines_db', 'get_cmds.timelines_backstop')
+    return cmds
 
-    # Filter commands on date and sort by date.
-    # IS THE "datestart <=" CORRECT?  docstring above says "<".  ?????
-    return sorted((x for x in cmds if datestart <= x['date'] <= datestop),
-                  key=lambda y: y['date'])
+
+def is_state_cmd(cmd):
+    """
+    Return True if the backstop command ``cmd`` can change the commanded
+    states, i.e. it is one of the commands that :func:`get_cmds` stores in the
+    database.
+
+    :param cmd: command dict, e.g. from Ska.ParseCM.read_backstop()
+    """
+    return (cmd['cmd'] in STATE_CMD_TYPES
+            or cmd['params'].get('TLMSID') in STATE_TLMSIDS)
+
+
+def _db_cmds_as_table(db_cmds, tl_id, db):
+    """
+    Convert the commands ``db_cmds`` (numpy recarray from the cmds table) that
+    occur in the timeline ``tl_id`` to a command table.  The state parameters
+    are taken from the cmds table columns if available, otherwise they are
+    read from the ``db`` parameter tables.
+
+    :param db_cmds: numpy recarray of commands from the cmds table
+    :param tl_id: timeline id
+    :param db: Ska.DBI db object
+
+    :returns: command table
+    """
+    if len(db_cmds) == 0:
+        return np.zeros(0, dtype=CMDS_TABLE_DTYPE)
+
+    par_cols = [col for name, col in STATE_PAR_COLS]
+    if not set(par_cols).issubset(db_cmds.dtype.names):
+        return cmds_as_table(_tl_to_bs_cmds(db_cmds, tl_id, db), strict=False)
+
+    db_cmds = db_cmds[np.isin(db_cmds['cmd'], CMD_TYPES)]
+    out = np.zeros(len(db_cmds), dtype=CMDS_TABLE_DTYPE)
+    out['date'] = db_cmds['date']
+    out['time'] = db_cmds['time']
+    out['cmd'] = [CMD_CODES[cmd] for cmd in db_cmds['cmd']]
+    for col in ('tlmsid', 'msid'):
+        out[col] = [val or '' for val in db_cmds[col]]
+    for col in par_cols:
+        out[col] = [np.nan if val is None else val for val in db_cmds[col]]
+
+    par_col_names = dict(STATE_PAR_COLS)
+    for cmd_type, names in REQUIRED_STATE_PARS.items():
+        for name in names:
+            bad = ((out['cmd'] == CMD_CODES[cmd_type])
+                   & np.isnan(out[par_col_names[name]]))
+            if np.any(bad):
+                raise KeyError('{} command at {} has no {} parameter'
+                               .format(cmd_type, out['date'][bad][0], name))
+
+    return out
 
 
 def insert_cmds_db(cmds, timeline_id, db):
@@ -612,8 +950,17 @@ def insert_cmds_db(cmds, timeline_id, db):
     vcdu              int         4
     step              int         4
     scs               int         4
+    par_id            int         4
+    par_pos           int         4
+    par_q1            float       8
+    par_q2            float       8
+    par_q3            float       8
+    par_q4            float       8
     ================  ========  =======
 
+    The ``par_*`` columns are left out for a database that has not been
+    migrated with ``migrate_cmd_tables.py``.
+
     **cmd_intpars** and **cmd_fltpars**
 
     ================  ==========  =======
@@ -625,47 +972,129 @@ def insert_cmds_db(cmds, timeline_id, db):
     value              int/float     8
     ================  ==========  =======
 
+    A command table (see :func:`cmds_as_table`) is not accepted since it does
+    not have all the command parameters.
+
     :param cmds: list of command dicts, e.g. from Ska.ParseCM.read_backstop()
+                 or :func:`generate_cmds`
     :param db: Ska.DBI.DBI object
     :param timeline_id: id of timeline load segment that contains commands
 
     :returns: None
     """
+    if isinstance(cmds, np.ndarray):
+        raise TypeError('insert_cmds_db needs command dicts, not a command '
+                        'table which lacks vcdu, step, scs and non-state '
+                        'params')
     cmd_id = db.fetchone('SELECT max(id) AS max_id FROM cmds')['max_id'] or 0
     logging.info('insert_cmds_db: inserting %d cmds to commands tables'
                  % (len(cmds)))
 
-    for cmd in cmds:
-        cmd_id += 1
+    rows = _get_cmds_rows(cmds, timeline_id, cmd_id)
+    for table, cols in _get_cmds_tables(db):
+        _insert_rows(db, table, cols, rows[table])
 
-        # Make a copy of the cmd while skipping any None values
-        db_cmd = dict((key, val) for (key, val) in cmd.items()
-                      if val is not None)
-        db_cmd['id'] = cmd_id
-        if timeline_id is not None:
-            db_cmd['timeline_id'] = timeline_id
+    db.conn.commit()
+
+
+def has_state_par_cols(db):
+    """Check if the cmds table in ``db`` has the state parameter columns (see
+    ``STATE_PAR_COLS``), which a database made from older table definitions
+    only gets from ``migrate_cmd_tables.py``.
+
+    :param db: Ska.DBI.DBI object
+    :returns: bool
+    """
+    try:
+        db.execute('SELECT {} FROM cmds WHERE 1 = 0'
+                   .format(', '.join(col for name, col in STATE_PAR_COLS)))
+    except Exception:
+        return False
+    return True
+
+
+def _get_cmds_tables(db):
+    """Get the (table, columns) of the commands tables in ``db`` for bulk
+    inserts, leaving out the state parameter columns of cmds if ``db`` has
+    not been migrated.
+    """
+    if has_state_par_cols(db):
+        return CMDS_TABLES
+    logging.debug('cmds table has no state parameter columns, run '
+                  'migrate_cmd_tables.py to add them')
+    par_cols = set(col for name, col in STATE_PAR_COLS)
+    return tuple((table, tuple(col for col in cols if col not in par_cols))
+                 for table, cols in CMDS_TABLES)
+
+
+def _get_cmds_rows(cmds, timeline_id, cmd_id):
+    """Convert ``cmds`` to rows for the 'cmds', 'cmd_intpars' and 'cmd_fltpars'
+    tables.  Command ids are assigned sequentially after ``cmd_id``.
+
+    :param cmds: list of command dicts, e.g. from Ska.ParseCM.read_backstop()
+    :param timeline_id: id of timeline load segment that contains commands
+    :param cmd_id: last used command id
+
+    :returns: dict of table name: list of row dicts with the CMDS_TABLES
+              columns
+    """
+    rows = dict((table, []) for table, cols in CMDS_TABLES)
 
-        # The params and paramstr don't get stored to db
-        for key in set(['params', 'paramstr']).intersection(db_cmd):
-            del db_cmd[key]
+    for cmd in cmds:
+        cmd_id += 1
 
-        db.insert(db_cmd, 'cmds', commit=False)
+        # Only the table columns are stored, so params and paramstr are dropped
+        db_cmd = dict(cmd, id=cmd_id, timeline_id=timeline_id)
+        params = cmd.get('params', {})
+        for name, col in STATE_PAR_COLS:
+            if isinstance(params.get(name), (int, float)):
+                db_cmd[col] = params[name]
+        rows['cmds'].append(dict((col, _db_value(db_cmd.get(col)))
+                                 for col in CMDS_COLS))
 
-        # Insert int and float command parameters
+        # Int and float command parameters
         for name, value in cmd.get('params', {}).items():
             if name in ('MSID', 'TLMSID', 'SCS', 'STEP', 'VCDU'):
                 continue
 
-            par = dict(cmd_id=cmd_id,
-                       timeline_id=timeline_id,
-                       name=name,
-                       value=value)
+            par = dict(zip(CMD_PARS_COLS,
+                           (cmd_id, timeline_id, name, _db_value(value))))
             if isinstance(value, int):
-                db.insert(par, 'cmd_intpars', commit=False)
+                rows['cmd_intpars'].append(par)
             elif isinstance(value, float):
-                db.insert(par, 'cmd_fltpars', commit=False)
+                rows['cmd_fltpars'].append(par)
+
+    return rows
+
+
+def _db_value(value):
+    """Convert numpy scalar ``value`` to the equivalent Python type for the DB.
+    """
+    return value.item() if isinstance(value, np.generic) else value
 
-    db.conn.commit()
+
+def _insert_rows(db, table, cols, rows):
+    """Insert the ``cols`` values of ``rows`` (sequence of dicts) into
+    ``table`` using the DBI object ``db``.  This does not commit.
+
+    For sqlite all rows are inserted with a single executemany() call,
+    otherwise one row at a time.
+    """
+    if len(rows) == 0:
+        return
+
+    if db.dbi == 'sqlite':
+        cursor = db.conn.cursor()
+        cursor.executemany('INSERT INTO {} ({}) VALUES ({})'
+                           .format(table, ', '.join(cols),
+                                   ', '.join('?' for col in cols)),
+                           [tuple(row[col] for col in cols) for row in rows])
+        cursor.close()
+    else:
+        for row in rows:
+            db.insert(dict((col, row[col]) for col in cols
+                           if row[col] is not None),
+                      table, commit=False)
 
 
 def interpolate_states(states, times):
@@ -715,6 +1144,166 @@ def generate_cmds(time, cmd_set):
     return cmds
 
 
+def generate_cmds_many(time_cmd_sets):
+    """
+    Generate commands for many ``(time, cmd_set)`` pairs at once.
+
+    This gives the same commands as calling :func:`generate_cmds` for each
+    pair, but the command times are computed for all sets at once with a
+    cumulative sum over the ``dur`` values and all dates are computed with a
+    single vectorized ``DateTime`` call.
+
+    The output is a command table (see :func:`cmds_as_table`) that can be
+    passed directly to :func:`get_states`.  It only has the state parameters
+    of the commands, so use :func:`generate_cmds` for commands to insert with
+    :func:`insert_cmds_db`.
+
+    :param time_cmd_sets: list of (time, cmd_set) pairs
+    :returns: command table sorted by set order and time within each set
+    """
+    cmd_sets = [cmd_set for time, cmd_set in time_cmd_sets]
+    n_cmds = np.array([len(cmd_set) for cmd_set in cmd_sets], dtype=int)
+
+    cmds = np.zeros(0, dtype=CMDS_TABLE_DTYPE)
+    if len(cmd_sets) == 0 or n_cmds.sum() == 0:
+        return cmds
+
+    # Row i is [time_i, dur_0, dur_1, ...] for set i, so the cumulative sum
+    # along each row gives the time of each command in the same sequential
+    # order of addition as generate_cmds().
+    set_times = _as_secs([time for time, cmd_set in time_cmd_sets])
+    times = np.zeros((len(cmd_sets), n_cmds.max()), dtype=float)
+    times[:, 0] = set_times
+    is_cmd = np.zeros(times.shape, dtype=bool)
+    for i_set, cmd_set in enumerate(cmd_sets):
+        for i_cmd, cmd in enumerate(cmd_set):
+            is_cmd[i_set, i_cmd] = 'cmd' in cmd
+            if i_cmd + 1 < times.shape[1]:
+                times[i_set, i_cmd + 1] = cmd.get('dur', 0.0)
+    times = np.cumsum(times, axis=1)
+
+    cmd_defs = [cmd for cmd_set in cmd_sets for cmd in cmd_set if 'cmd' in cmd]
+    for cmd in cmd_defs:
+        bad_keys = set(cmd) - set(['cmd', 'tlmsid', 'msid', 'params', 'dur'])
+        if bad_keys:
+            raise ValueError('unexpected keys {} in cmd_set command'
+                             .format(', '.join(sorted(bad_keys))))
+    cmds = cmds_as_table(cmd_defs)
+    cmds['time'] = times[is_cmd]
+    cmds['date'] = DateTime(cmds['time']).date
+
+    return cmds
+
+
+def _as_secs(times):
+    """
+    Convert a list of times in any DateTime-compatible format to CXC seconds,
+    using one vectorized DateTime call for all the date strings.
+    """
+    secs = np.zeros(len(times), dtype=float)
+    i_strs = []
+    for i, time in enumerate(times):
+        if isinstance(time, six.string_types):
+            i_strs.append(i)
+        elif isinstance(time, numbers.Real):
+            secs[i] = time
+        else:
+            secs[i] = DateTime(time).secs
+    if i_strs:
+        secs[i_strs] = DateTime([times[i] for i in i_strs]).secs
+    return secs
+
+
+def cmds_as_table(cmds, strict=True):
+    """
+    Convert a list of command dicts (e.g. from Ska.ParseCM.read_backstop() or
+    :func:`generate_cmds`) to a compact command table for :func:`get_states`.
+    A command table is returned unchanged.
+
+    A command table is a numpy structured array with ``CMDS_TABLE_DTYPE``.
+    The ``cmd`` column is an index into ``CMD_TYPES`` and the state parameters
+    ``ID``, ``POS`` and ``Q1`` to ``Q4`` are in the ``par_*`` columns (NaN if
+    not set).  A missing ``tlmsid`` is taken from the ``TLMSID`` parameter if
+    available.  The table only has what :func:`get_states` needs: ``vcdu``,
+    ``step``, ``scs`` and the other command parameters are not kept, so use
+    the command dicts for anything else (e.g. :func:`insert_cmds_db`).
+
+    Commands with a type that is not in ``CMD_TYPES`` raise a ValueError
+    unless ``strict`` is False, in which case they are dropped since they
+    cannot change the commanded state.  A command without a state parameter
+    that its type needs (see ``REQUIRED_STATE_PARS``) raises a KeyError and
+    a ``tlmsid`` or ``msid`` that does not fit in the table raises a
+    ValueError.
+
+    :param cmds: list of command dicts or command table
+    :param strict: raise ValueError for unknown command types (default=True)
+    :returns: command table
+    """
+    if isinstance(cmds, np.ndarray):
+        return cmds
+
+    if strict:
+        bad_cmds = set(cmd['cmd'] for cmd in cmds) - set(CMD_CODES)
+        if bad_cmds:
+            raise ValueError('unexpected command types {}'
+                             .format(', '.join(sorted(bad_cmds))))
+    cmds = [cmd for cmd in cmds if cmd['cmd'] in CMD_CODES]
+
+    out = np.zeros(len(cmds), dtype=CMDS_TABLE_DTYPE)
+    for name, col in STATE_PAR_COLS:
+        out[col] = np.nan
+    str_lens = dict((col, CMDS_TABLE_DTYPE[col].itemsize // 4)
+                    for col in ('tlmsid', 'msid'))
+    for i_cmd, cmd in enumerate(cmds):
+        params = cmd.get('params', {})
+        strs = dict(tlmsid=cmd.get('tlmsid') or params.get('TLMSID') or '',
+                    msid=cmd.get('msid') or '')
+        for col, val in strs.items():
+            if len(val) > str_lens[col]:
+                raise ValueError('{} {!r} of {} command at {} is longer '
+                                 'than {} characters'
+                                 .format(col, val, cmd['cmd'],
+                                         cmd.get('date'), str_lens[col]))
+        for name in REQUIRED_STATE_PARS.get(cmd['cmd'], ()):
+            if name not in params:
+                raise KeyError('{} command at {} has no {} parameter'
+                               .format(cmd['cmd'], cmd.get('date'), name))
+        out[i_cmd] = ((cmd.get('date', ''), cmd.get('time', np.nan),
+                       CMD_CODES[cmd['cmd']], strs['tlmsid'], strs['msid'])
+                      + tuple(params.get(name, np.nan)
+                              for name, col in STATE_PAR_COLS))
+
+    return out
+
+
+def cmds_as_dicts(cmds):
+    """
+    Convert a command table (see :func:`cmds_as_table`) to a list of command
+    dicts like the output of :func:`generate_cmds`, with only the state
+    parameters in ``params``.  A list of command dicts is returned unchanged.
+
+    :param cmds: command table or list of command dicts
+    :returns: list of command dicts
+    """
+    if not isinstance(cmds, np.ndarray):
+        return cmds
+
+    out = []
+    n_base = len(CMDS_TABLE_DTYPE.names) - len(STATE_PAR_COLS)
+    for row in cmds.tolist():
+        date, time, code, tlmsid, msid = row[:n_base]
+        cmd = dict(time=time, date=date, cmd=CMD_TYPES[code],
+                   tlmsid=tlmsid or None, msid=msid or None)
+        params = dict((name, int(val) if name in INT_STATE_PARS else val)
+                      for (name, col), val in zip(STATE_PAR_COLS, row[n_base:])
+                      if not np.isnan(val))
+        if params:
+            cmd['params'] = params
+        out.append(cmd)
+
+    return out
+
+
 def cmd_set(name, *args):
     r"""
     Return a predefined cmd_set ``name`` generated with \*args.
@@ -723,6 +1312,8 @@ def cmd_set(name, *args):
     :param \*args: optional args
     :returns: cmd set
     """
+    from Quaternion import Quat
+
     def obsid(*args):
         """Return a command set that initiates a maneuver to the given attitude
         ``att``.
@@ -828,7 +1419,8 @@ def cmd_set(name, *args):
     return cmd_sets[name](*args)
 
 
-def interrupt_loads(datestop, db, observing_only=False, current_only=False):
+def interrupt_loads(datestop, db, observing_only=False, current_only=False,
+                    commit=True):
     """Interrupt the timelines  with
     db.datestop > ``datestop`` by updating the table datestop accordingly.
     Use DBI handle ``db`` to access tables.  If ``current_only`` is set
@@ -838,18 +1430,19 @@ def interrupt_loads(datestop, db, observing_only=False, current_only=False):
     :param db: Ska.DBI.DBI object
     :param observing_only: only interrupt 'observing' slots (131,132,133)
     :param current_only: only stop the load containing datestop
+    :param commit: commit each update (default=True), or leave it to the
+                   caller's transaction
     :returns: None
     """
     datestop = DateTime(datestop).date
 
-    select = "SELECT * FROM timeline_loads WHERE datestop > '%s'" % datestop
-    select_datestart = (" AND datestart <= '%s'" % datestop
-                        if current_only else '')
-    select_observing = " AND scs > 130" if observing_only else ''
+    select = queries.timeline_loads(datestop,
+                                    datestart=(datestop if current_only
+                                               else None),
+                                    observing_only=observing_only)
 
-    logging.info('interrupt_loads: '
-                 + select + select_datestart + select_observing)
-    timelines = db.fetchall(select + select_datestart + select_observing)
+    logging.info('interrupt_loads: ' + select)
+    timelines = db.fetchall(select)
     if len(timelines) == 0:
         logging.info('No timelines containing %s' % datestop)
         return
@@ -876,43 +1469,67 @@ def interrupt_loads(datestop, db, observing_only=False, current_only=False):
             interrupt_time = tl['datestart']
         update = ("UPDATE timelines SET datestop='%s' where id=%d"
                   % (interrupt_time, tl['id']))
-        db.execute(update)
+        db.execute(update, commit=commit)
 
 
-def reduce_states(states, cols, allow_identical=True):
+def _get_transitions(states, cols, allow_identical=True):
     """
-    Reduce the input ``states`` so that only transitions in the ``cols``
-    columns are noticed.
+    Get a boolean mask of the ``states`` that have a transition in at least
+    one of the ``cols`` columns.  The first state is always marked as a
+    transition.
 
     :param states: numpy recarray of states
     :param cols: notice transitions in this list of columns
     :param allow_identical: allow null transitions between apparently identical states
 
-    :returns: numpy recarray of reduced states
+    :returns: boolean numpy array
     """
     cols = set(cols)
 
-    # Boolean func for when at least one state transition key is among the
-    # supplied cols Transition keys are are the values that changed between
-    # previous and current state
-    trans_in_cols = lambda state: bool(cols.intersection(state['trans_keys']
-                                                         .split(',')))
+    # Transition keys are the values that changed between previous and
+    # current state.  There are relatively few distinct trans_keys values so
+    # evaluate the intersection with cols once per distinct value and then
+    # broadcast back to all states.
+    trans_keys, i_trans_keys = np.unique(states['trans_keys'],
+                                         return_inverse=True)
+    i_trans_keys = i_trans_keys.ravel()
+    trans_in_cols = np.array([bool(cols.intersection(keys.split(',')))
+                              for keys in trans_keys], dtype=bool)
 
     # Generate the transition markers
-    transitions = np.array([trans_in_cols(state) for state in states])
+    transitions = trans_in_cols[i_trans_keys]
     transitions[0] = True
 
     if not allow_identical:
-        i_transitions = np.flatnonzero(transitions)
-        no_trans = []
-        for i in i_transitions[1:]:  # Skip the first one which is index=0
-            state0 = states[i - 1]
-            state1 = states[i]
-            trans_keys = state1['trans_keys'].split(',')
-            if all(state0[key] == state1[key] for key in trans_keys):
-                no_trans.append(i)
-        transitions[no_trans] = False
+        # Skip the first one which is index=0
+        i_transitions = np.flatnonzero(transitions[1:]) + 1
+        no_trans = np.zeros(len(i_transitions), dtype=bool)
+        i_keys = i_trans_keys[i_transitions]
+        # Compare each transition state with the previous state over its own
+        # trans_keys, processing all states sharing the same trans_keys at once.
+        for i_key in np.unique(i_keys):
+            in_group = i_keys == i_key
+            i1 = i_transitions[in_group]
+            same = np.ones(len(i1), dtype=bool)
+            for key in trans_keys[i_key].split(','):
+                same &= states[key][i1 - 1] == states[key][i1]
+            no_trans[in_group] = same
+        transitions[i_transitions[no_trans]] = False
+
+    return transitions
+
+
+def _select_transitions(states, transitions):
+    """
+    Select the ``states`` marked in ``transitions`` and fix up the datestop
+    and tstop values so the selected states are contiguous and span the same
+    interval as the input ``states``.
+
+    :param states: numpy recarray of states
+    :param transitions: boolean mask of states to keep (first must be True)
 
+    :returns: numpy recarray of reduced states
+    """
     newstates = states[transitions].copy()
     newstates['datestop'][:-1] = newstates['datestart'][1:]
     newstates['tstop'][:-1] = newstates['tstart'][1:]
@@ -920,3 +1537,18 @@ def reduce_states(states, cols, allow_identical=True):
     newstates['tstop'][-1] = states['tstop'][-1]
 
     return newstates
+
+
+def reduce_states(states, cols, allow_identical=True):
+    """
+    Reduce the input ``states`` so that only transitions in the ``cols``
+    columns are noticed.
+
+    :param states: numpy recarray of states
+    :param cols: notice transitions in this list of columns
+    :param allow_identical: allow null transitions between apparently identical states
+
+    :returns: numpy recarray of reduced states
+    """
+    transitions = _get_transitions(states, cols, allow_identical)
+    return _select_transitions(states, transitions)
@@ -0,0 +1,453 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Differential checks of the state generation engine against the frozen
+reference implementations in :mod:`chandra_cmd_states.reference`.
+
+:func:`check_stream` runs :func:`~chandra_cmd_states.get_states` and the
+reference version on a command stream and diffs the states column by column.
+If they agree it goes on to check :func:`~chandra_cmd_states.reduce_states`
+for a few sets of columns and
+:func:`~chandra_cmd_states.update_cmd_states.get_states_i_diff` for
+perturbed copies of the states.  The first divergence found is returned as a
+:class:`Divergence`, or None if the engine matches the reference.
+
+Command streams are either randomized (:func:`random_cmds`) or recorded in a
+commands database (:func:`check_db`).  Non-float columns must match exactly.
+Float columns must match within the absolute tolerances in ``FLOAT_ATOL``,
+where NaN matches NaN.  The ``benchmarks/check_equivalence.py`` script runs
+all of this at scale with one command.
+"""
+
+import logging
+
+import numpy as np
+from six.moves import range
+
+from Chandra.Time import DateTime
+
+from . import cmd_states
+from . import reference
+
+# Absolute tolerances for float state columns.  Any other float column must
+# match exactly.
+FLOAT_ATOL = {'tstart': 1e-6,  # sec
+              'tstop': 1e-6,
+              'pitch': 1e-6,  # deg
+              'ra': 1e-6,
+              'dec': 1e-6,
+              'roll': 1e-6,
+              'q1': 1e-9,
+              'q2': 1e-9,
+              'q3': 1e-9,
+              'q4': 1e-9}
+
+# Column sets for the reduce_states() checks
+REDUCE_COLS = (('obsid',),
+               ('simpos', 'simfa_pos'),
+               ('pcad_mode', 'pitch'),
+               ('power_cmd', 'si_mode', 'ccd_count', 'fep_count'),
+               ('obsid', 'simpos', 'pcad_mode', 'hetg', 'letg', 'dither'))
+
+# ACIS packets for random command streams, in addition to random WSPOW
+# power commands
+ACIS_TLMSIDS = ('WSPOW00000', 'WSPOW0002A', 'WSPOW0CF3F', 'WSPOW08F3E',
+                'XTZ0000005', 'XCZ0000005', 'WSVIDALLDN', 'AA00000000',
+                'WSFEPALLUP', 'WT00216024', 'WT00C60024', 'WC00124014')
+
+# Single software commands for random command streams
+SW_TLMSIDS = ('AONMMODE', 'AONPMODE', '4OHETGIN', '4OHETGRE', '4OLETGIN',
+              '4OLETGRE', 'AOENDITH', 'AODSDITH', 'AONM2NPE', 'AONM2NPD',
+              'OORMPDS')
+
+
+class Divergence(object):
+    """
+    First difference between the reference and optimized engine output.
+
+    :param check: name of the check (get_states, reduce_states, i_diff)
+    :param reason: values, columns, length or exception
+    :param row: row index of the first differing state (or None)
+    :param col: name of the differing column (or None)
+    :param ref: reference value
+    :param new: optimized engine value
+    :param datestart: datestart of the reference state at ``row``
+    :param atol: tolerance that was exceeded (for float columns)
+    """
+    def __init__(self, check, reason, row=None, col=None, ref=None, new=None,
+                 datestart=None, atol=None):
+        self.check = check
+        self.reason = reason
+        self.row = row
+        self.col = col
+        self.ref = ref
+        self.new = new
+        self.datestart = datestart
+        self.atol = atol
+        self.context = ''
+
+    def __str__(self):
+        out = '{}: {}'.format(self.check, self.reason)
+        if self.context:
+            out += ' ({})'.format(self.context)
+        if self.row is not None:
+            out += ' at row {}'.format(self.row)
+            if self.datestart is not None:
+                out += ' (datestart {})'.format(self.datestart)
+        if self.col is not None:
+            out += ' column {}'.format(self.col)
+        out += ': reference={!r} optimized={!r}'.format(self.ref, self.new)
+        if self.atol is not None:
+            out += ' (|diff|={:.3g} > atol={:.3g})'.format(
+                abs(self.ref - self.new), self.atol)
+        return out
+
+
+def _as_str(vals):
+    return vals.astype('U') if vals.dtype.kind == 'S' else vals
+
+
+def diff_states(ref, new, check='states', atol=None):
+    """
+    Diff states ``new`` against reference states ``ref`` column by column.
+
+    :param ref: reference states
+    :param new: states to check
+    :param check: check name for the Divergence
+    :param atol: dict of absolute tolerances by column (default=FLOAT_ATOL)
+    :returns: Divergence for the first differing row, or None
+    """
+    if atol is None:
+        atol = FLOAT_ATOL
+
+    if set(ref.dtype.names) != set(new.dtype.names):
+        ref_names = set(ref.dtype.names)
+        new_names = set(new.dtype.names)
+        return Divergence(check, 'columns', ref=sorted(ref_names - new_names),
+                          new=sorted(new_names - ref_names))
+
+    n_rows = min(len(ref), len(new))
+    first = None
+    for col in ref.dtype.names:
+        ref_vals = _as_str(ref[col][:n_rows])
+        new_vals = _as_str(new[col][:n_rows])
+        col_atol = None
+        if ref_vals.dtype.kind == 'f' and new_vals.dtype.kind == 'f':
+            col_atol = atol.get(col, 0.0)
+            ref_nan = np.isnan(ref_vals)
+            new_nan = np.isnan(new_vals)
+            with np.errstate(invalid='ignore'):
+                bad = ((np.abs(ref_vals - new_vals) > col_atol)
+                       | (ref_nan != new_nan))
+        else:
+            bad = ref_vals != new_vals
+        i_bad = np.flatnonzero(bad)
+        if len(i_bad) and (first is None or i_bad[0] < first.row):
+            row = int(i_bad[0])
+            first = Divergence(check, 'values', row=row, col=col,
+                               ref=ref_vals[row].item(),
+                               new=new_vals[row].item(),
+                               atol=col_atol)
+    if first is None and len(ref) != len(new):
+        first = Divergence(check, 'length', row=n_rows,
+                           ref=len(ref), new=len(new))
+    if first is not None and first.row is not None and first.row < len(ref):
+        first.datestart = _as_str(ref['datestart'][first.row:first.row + 1])[0]
+
+    return first
+
+
+def _call(func, *args, **kwargs):
+    """Call ``func`` and return (result, exception)"""
+    try:
+        return func(*args, **kwargs), None
+    except Exception as err:
+        return None, err
+
+
+def _check_exceptions(check, ref_err, new_err):
+    """Divergence if exactly one of the engines raised (or they raised
+    different exception types), else None."""
+    if type(ref_err) is not type(new_err):
+        return Divergence(check, 'exception', ref=ref_err, new=new_err)
+    logging.warning('{}: both engines raised {!r}'.format(check, ref_err))
+    return None
+
+
+def reference_states(state0, cmds, exclude=None):
+    """
+    Get the states for ``cmds`` from the reference
+    :func:`~chandra_cmd_states.reference.get_states`, which only takes a list
+    of command dicts and changes it.  ``state0`` and ``cmds`` are not changed.
+
+    :param state0: initial state
+    :param cmds: command table or list of command dicts
+    :param exclude: list or set of state keys to ignore
+    :returns: reference states
+    """
+    cmds = [dict(cmd) for cmd in cmd_states.cmds_as_dicts(cmds)]
+    return reference.get_states(dict(state0), cmds, exclude)
+
+
+def check_get_states(state0, cmds, exclude=None, atol=None):
+    """
+    Check get_states() against the reference for ``cmds``.
+
+    :param state0: initial state
+    :param cmds: command table or list of command dicts
+    :param exclude: list or set of state keys to ignore
+    :param atol: dict of absolute tolerances by column (default=FLOAT_ATOL)
+    :returns: (Divergence or None, reference states)
+    """
+    ref, ref_err = _call(reference_states, state0, cmds, exclude)
+    new, new_err = _call(cmd_states.get_states, dict(state0), cmds, exclude)
+    if ref_err or new_err:
+        return _check_exceptions('get_states', ref_err, new_err), None
+    return diff_states(ref, new, 'get_states', atol), ref
+
+
+def check_reduce_states(states, cols, allow_identical=True, atol=None):
+    """
+    Check reduce_states() against the reference for ``states``.
+
+    :param states: states
+    :param cols: notice transitions in this list of columns
+    :param allow_identical: allow null transitions between identical states
+    :param atol: dict of absolute tolerances by column (default=FLOAT_ATOL)
+    :returns: Divergence or None
+    """
+    ref, ref_err = _call(reference.reduce_states, states, cols,
+                         allow_identical)
+    new, new_err = _call(cmd_states.reduce_states, states, cols,
+                         allow_identical)
+    if ref_err or new_err:
+        return _check_exceptions('reduce_states', ref_err, new_err)
+    return diff_states(ref, new, 'reduce_states', atol)
+
+
+def check_states_i_diff(db_states, states):
+    """
+    Check get_states_i_diff() against the reference.
+
+    :param db_states: states in database
+    :param states: new states
+    :returns: Divergence or None
+    """
+    from .update_cmd_states import get_states_i_diff
+
+    ref, ref_err = _call(reference.get_states_i_diff, db_states, states)
+    new, new_err = _call(get_states_i_diff, db_states, states)
+    if ref_err or new_err:
+        return _check_exceptions('i_diff', ref_err, new_err)
+    if ref != new:
+        return Divergence('i_diff', 'values', ref=ref, new=new)
+    return None
+
+
+def perturb_states(states, rng):
+    """
+    Make perturbed copies of ``states`` for the get_states_i_diff() checks:
+    identical, truncated, and with one value changed in a random row either
+    beyond or within the pitch / attitude match tolerance.
+
+    :param states: states
+    :param rng: numpy RandomState
+    :returns: list of (description, states) pairs
+    """
+    out = [('identical', states.copy())]
+    if len(states) > 1:
+        n_keep = rng.randint(1, len(states))
+        out.append(('truncated to {}'.format(n_keep), states[:n_keep].copy()))
+
+    changes = (('obsid', 1), ('simpos', 1), ('power_cmd', 'ZZ'),
+               ('pcad_mode', 'ZZ'), ('pitch', 0.001), ('pitch', 0.0001),
+               ('ra', 0.01), ('dec', 0.0001))
+    for col, change in changes:
+        row = rng.randint(len(states))
+        perturbed = states.copy()
+        if isinstance(change, str):
+            perturbed[col][row] = change
+        else:
+            perturbed[col][row] += change
+        out.append(('{} changed by {!r} at row {}'.format(col, change, row),
+                    perturbed))
+    return out
+
+
+def check_stream(state0, cmds, rng=None, exclude=None, atol=None,
+                 db_states=None):
+    """
+    Check get_states(), reduce_states() and get_states_i_diff() against the
+    reference implementations for one command stream.
+
+    :param state0: initial state
+    :param cmds: command table or list of command dicts
+    :param rng: numpy RandomState for the i_diff perturbations (default seed 0)
+    :param exclude: list or set of state keys to ignore in get_states()
+    :param atol: dict of absolute tolerances by column (default=FLOAT_ATOL)
+    :param db_states: recorded database states to check i_diff against
+    :returns: first Divergence or None
+    """
+    if rng is None:
+        rng = np.random.RandomState(0)
+
+    divergence, states = check_get_states(state0, cmds, exclude, atol)
+    if divergence or states is None:
+        return divergence
+
+    for cols in REDUCE_COLS:
+        for allow_identical in (True, False):
+            divergence = check_reduce_states(states, cols, allow_identical,
+                                             atol)
+            if divergence:
+                divergence.context = 'cols={} allow_identical={}'.format(
+                    ','.join(cols), allow_identical)
+                return divergence
+
+    variants = perturb_states(states, rng)
+    if db_states is not None:
+        variants.append(('recorded database states', db_states))
+    for desc, db_variant in variants:
+        divergence = check_states_i_diff(db_variant, states)
+        if divergence:
+            divergence.context = desc
+            return divergence
+
+    return None
+
+
+def _random_quat(rng):
+    q = rng.normal(size=4)
+    return q / np.sqrt(np.sum(q ** 2))
+
+
+def random_cmds(n_sets, start='2012:001:00:00:00.000', seed=0,
+                mean_gap=7200.0):
+    """
+    Make a random command stream of ``n_sets`` command sets: maneuvers,
+    normal sun mode, SCS-107, obsid changes, ACIS packets, SIM moves and
+    single software commands.  About 10% of the sets are at the same time as
+    the previous one and others can fall within a maneuver.
+
+    :param n_sets: number of command sets
+    :param start: start date
+    :param seed: random seed
+    :param mean_gap: mean time between command sets (sec)
+    :returns: command table
+    """
+    rng = np.random.RandomState(seed)
+    gaps = rng.exponential(mean_gap, n_sets)
+    gaps[rng.uniform(size=n_sets) < 0.1] = 0.0
+    times = DateTime(start).secs + np.cumsum(gaps)
+
+    kinds = ('manvr', 'obsid', 'acis', 'sim', 'sw', 'aciscti', 'dith',
+             'scs107', 'nsm')
+    probs = np.array([20, 15, 20, 10, 15, 5, 5, 5, 2], dtype=float)
+    probs /= probs.sum()
+
+    time_cmd_sets = []
+    for set_time in times:
+        kind = kinds[rng.choice(len(kinds), p=probs)]
+        if kind == 'manvr':
+            cmd_set = cmd_states.cmd_set('manvr', *_random_quat(rng))
+        elif kind == 'obsid':
+            cmd_set = cmd_states.cmd_set('obsid', int(rng.randint(0, 65536)))
+        elif kind == 'acis':
+            tlmsids = [ACIS_TLMSIDS[i] for i in
+                       rng.randint(len(ACIS_TLMSIDS), size=rng.randint(1, 4))]
+            if rng.uniform() < 0.3:
+                tlmsids.append('WSPOW{:05X}'.format(rng.randint(0x100000)))
+            cmd_set = cmd_states.cmd_set('acis', *tlmsids)
+        elif kind == 'sim':
+            pos = int(rng.randint(-100000, 100000))
+            cmd_set = (dict(cmd=('SIMTRANS', 'SIMFOCUS')[rng.randint(2)],
+                            params=dict(POS=pos)),)
+        elif kind == 'sw':
+            tlmsid = SW_TLMSIDS[rng.randint(len(SW_TLMSIDS))]
+            cmd_set = (dict(cmd='COMMAND_SW', tlmsid=tlmsid, msid=tlmsid),)
+        elif kind == 'dith':
+            name = ('dith_on', 'dith_off')[rng.randint(2)]
+            cmd_set = cmd_states.cmd_set(name)
+        else:
+            cmd_set = cmd_states.cmd_set(kind)
+        time_cmd_sets.append((set_time, cmd_set))
+
+    # Start with a maneuver so the target attitude and auto-NPNT flag are
+    # defined before any normal sun mode or maneuver command.
+    time_cmd_sets.insert(0, (DateTime(start).secs - 600,
+                             cmd_states.cmd_set('manvr', *_random_quat(rng))))
+    return cmd_states.generate_cmds_many(time_cmd_sets)
+
+
+def random_state0(cmds):
+    """
+    Initial state one hour before the first command of ``cmds``.
+
+    :param cmds: command table
+    :returns: state0 dict
+    """
+    return dict(cmd_states.STATE0,
+                datestart=DateTime(cmds['time'][0] - 3600).date)
+
+
+def check_random(n_streams, n_sets=200, seed=0, atol=None):
+    """
+    Check ``n_streams`` random command streams of ``n_sets`` command sets.
+    Stream ``i`` uses random seed ``seed + i``.
+
+    :param n_streams: number of streams
+    :param n_sets: number of command sets per stream
+    :param seed: random seed of the first stream
+    :param atol: dict of absolute tolerances by column (default=FLOAT_ATOL)
+    :returns: first Divergence or None
+    """
+    for i_seed in range(seed, seed + n_streams):
+        cmds = random_cmds(n_sets, seed=i_seed)
+        rng = np.random.RandomState(i_seed)
+        exclude = ['simfa_pos'] if i_seed % 5 == 4 else None
+        divergence = check_stream(random_state0(cmds), cmds, rng,
+                                  exclude=exclude, atol=atol)
+        logging.info('Random stream seed={} n_cmds={}: {}'
+                     .format(i_seed, len(cmds),
+                             'DIVERGED' if divergence else 'ok'))
+        if divergence:
+            divergence.context = ('random stream seed={} n_sets={}{}'
+                                  .format(i_seed, n_sets,
+                                          ', ' + divergence.context
+                                          if divergence.context else ''))
+            return divergence
+    return None
+
+
+def check_db(db, datestart, datestop='2099:001:00:00:00.000', mp_dir=None,
+             atol=None):
+    """
+    Check the engine on the commands recorded in database ``db`` from
+    ``datestart`` to ``datestop``, including get_states_i_diff() against the
+    recorded cmd_states.
+
+    :param db: Ska.DBI.DBI object
+    :param datestart: start date
+    :param datestop: stop date (default=2099:001)
+    :param mp_dir: mission planning directory for backstop files
+                   (default=get_cmds_table() default)
+    :param atol: dict of absolute tolerances by column (default=FLOAT_ATOL)
+    :returns: first Divergence or None
+    """
+    kwargs = {'mp_dir': mp_dir} if mp_dir else {}
+    state0 = cmd_states.get_state0(datestart, db)
+    cmds = cmd_states.get_cmds_table(state0['datestart'], datestop, db=db,
+                                     **kwargs)
+    db_states = db.fetchall("SELECT * FROM cmd_states WHERE datestart >= '{}'"
+                            " ORDER BY datestart".format(state0['datestart']))
+    if len(db_states) == 0:
+        db_states = None
+    divergence = check_stream(state0, cmds, atol=atol, db_states=db_states)
+    logging.info('Recorded stream {} to {} n_cmds={}: {}'
+                 .format(state0['datestart'], datestop, len(cmds),
+                         'DIVERGED' if divergence else 'ok'))
+    if divergence:
+        divergence.context = ('recorded stream from {}{}'
+                              .format(state0['datestart'],
+                                      ', ' + divergence.context
+                                      if divergence.context else ''))
+    return divergence
@@ -0,0 +1,165 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Fingerprints of the inputs to the commanded states update.
+
+The states after a date are fully determined by the ``timeline_loads`` rows,
+the non-load commands and the backstop files of the timelines from that date
+on.  A fingerprint records, for the update window starting at the definitive
+state0:
+
+- each timeline load (by id) with its datestart, datestop and a digest of the
+  other columns plus the name, size and mtime of the backstop file(s) in its
+  MP directory;
+- a (date, digest) pair for each non-load command.
+
+:func:`earliest_change` compares the fingerprint saved by the previous update
+to the current one and returns the earliest date that can be affected by a
+difference, or None if nothing changed.  The update then only needs to
+regenerate states from the state just before that date, or can stop right
+away.
+"""
+
+import os
+import glob
+import json
+import hashlib
+
+from . import queries
+
+FINGERPRINT_VERSION = 1
+
+
+def _digest(vals):
+    return hashlib.sha1(repr(vals).encode()).hexdigest()[:16]
+
+
+def _rows(recs):
+    """Rows of the ``recs`` query result as dicts of Python values"""
+    names = recs.dtype.names or ()
+    return [dict(zip(names, row)) for row in recs.tolist()]
+
+
+def backstop_stats(mp_dir, tl_mp_dir):
+    """
+    Get the name, size and mtime of the backstop files for a timeline.
+
+    :param mp_dir: root MP directory
+    :param tl_mp_dir: timeline MP directory (relative to ``mp_dir``)
+    :returns: list of (name, size, mtime)
+    """
+    stats = []
+    for filename in sorted(glob.glob(os.path.join(mp_dir + tl_mp_dir,
+                                                  '*.backstop'))):
+        stat = os.stat(filename)
+        stats.append((os.path.basename(filename), stat.st_size,
+                      stat.st_mtime))
+    return stats
+
+
+def get_fingerprint(db, datestart, mp_dir, meta=None):
+    """
+    Get the fingerprint of the update inputs after ``datestart``.
+
+    :param db: Ska.DBI.DBI object
+    :param datestart: start of the update window
+    :param mp_dir: root MP directory for backstop files
+    :param meta: dict of run settings (server, engine version, etc).  A
+                 change in any of these forces a full update.
+    :returns: fingerprint dict
+    """
+    timelines = {}
+    for tl in _rows(db.fetchall(queries.timeline_loads(datestart))):
+        other = sorted((name, val) for name, val in tl.items()
+                       if name not in ('id', 'datestart', 'datestop'))
+        timelines[str(tl['id'])] = {
+            'datestart': tl['datestart'],
+            'datestop': tl['datestop'],
+            'digest': _digest((other, backstop_stats(mp_dir, tl['mp_dir'])))}
+
+    nonload_cmds = []
+    for cmd in _rows(db.fetchall(queries.nonload_cmds(datestart))):
+        del cmd['id']
+        nonload_cmds.append([cmd['date'], _digest(sorted(cmd.items()))])
+    nonload_cmds.sort()
+
+    return {'version': FINGERPRINT_VERSION,
+            'meta': meta or {},
+            'datestart': datestart,
+            'timelines': timelines,
+            'nonload_cmds': nonload_cmds}
+
+
+def earliest_change(old, new):
+    """
+    Get the earliest date after which states may differ between the inputs
+    with fingerprint ``old`` (from the previous update) and ``new``.
+
+    Differences before the ``new`` window start are ignored, as are timelines
+    and commands that have simply moved out of the window.  If ``old`` is
+    None or was made with other settings the ``new`` window start is
+    returned.
+
+    :param old: previous fingerprint dict or None
+    :param new: current fingerprint dict
+    :returns: date string or None if nothing changed
+    """
+    window_start = new['datestart']
+    if (old is None
+            or old.get('version') != new['version']
+            or old.get('meta') != new['meta']
+            or old['datestart'] > window_start):
+        return window_start
+
+    dates = []
+    for tl_id in set(old['timelines']) | set(new['timelines']):
+        old_tl = old['timelines'].get(tl_id)
+        new_tl = new['timelines'].get(tl_id)
+        if old_tl == new_tl:
+            continue
+        if old_tl is None:
+            dates.append(new_tl['datestart'])
+        elif new_tl is None:
+            # Timeline dropped out of the window: only matters if it had not
+            # already ended before the window start
+            if old_tl['datestop'] > window_start:
+                dates.append(old_tl['datestart'])
+        elif (old_tl['datestart'] == new_tl['datestart']
+              and old_tl['digest'] == new_tl['digest']):
+            # Only datestop changed, e.g. a load interrupt
+            dates.append(min(old_tl['datestop'], new_tl['datestop']))
+        else:
+            dates.append(min(old_tl['datestart'], new_tl['datestart']))
+
+    old_cmds = set(tuple(cmd) for cmd in old['nonload_cmds']
+                   if cmd[0] >= window_start)
+    new_cmds = set(tuple(cmd) for cmd in new['nonload_cmds'])
+    dates.extend(date for date, digest in old_cmds ^ new_cmds)
+
+    return max(min(dates), window_start) if dates else None
+
+
+def read_fingerprint(filename):
+    """
+    Read a fingerprint from ``filename``.
+
+    :param filename: fingerprint JSON file name
+    :returns: fingerprint dict or None if the file does not exist
+    """
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as fh:
+        return json.load(fh)
+
+
+def write_fingerprint(filename, fingerprint):
+    """
+    Write ``fingerprint`` to ``filename`` via a temporary file so a failed
+    write never leaves a partial file.
+
+    :param filename: fingerprint JSON file name
+    :param fingerprint: fingerprint dict
+    """
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as fh:
+        json.dump(fingerprint, fh)
+    os.replace(tmp_filename, filename)
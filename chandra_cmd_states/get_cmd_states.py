@@ -14,7 +14,11 @@ import numpy as np
 from Chandra.Time import DateTime
 import Ska.Numpy
 
-from .cmd_states import reduce_states
+from .cmd_states import reduce_states, _get_transitions, _select_transitions
+from . import queries
+from . import h5store
+from . import shards
+from .profiling import profiled, PROFILE_HELP
 
 SKA = os.environ.get('SKA', '/proj/sot/ska')
 
@@ -43,12 +47,24 @@ STATE_VALS = """
      dither
 """.split()
 
+OUTPUT_FORMATS = ('text', 'csv', 'npy', 'bin')
 
-def get_h5_states(start, stop, server):
-    """Get states from HDF5 ``server`` file between ``start`` and ``stop``.
+
+# Resident time indexes of HDF5 cmd_states files used by states_at() and
+# fetch_intervals().  Keyed by absolute file name, each value is
+# (file signature, tstart column, tstop column, row map).  The row map gives
+# the table row of each live state for the versioned layout (else None).
+_H5_TIME_INDEXES = {}
+
+
+def _open_h5(server):
+    """Open the HDF5 cmd_states ``server`` file read-only and return the handle.
+
+    ``update_cmd_states`` replaces the file by renaming a new version into
+    place, so an open handle always reads one complete version.  The file
+    status from just before opening is kept as ``h5.open_stat``.
     """
     import tables
-    import numpy as np
 
     if server is None:
         server = os.path.join(SKA, 'data', 'cmd_states',
@@ -57,29 +73,377 @@ def get_h5_states(start, stop, server):
     if not os.path.exists(server):
         raise IOError('HDF5 cmd_states file {} not found'
                       .format(server))
+    stat = os.stat(server)
     tables_open_file = getattr(tables, 'open_file', None) or tables.openFile
     h5 = tables_open_file(server, mode='r')
+    h5.open_stat = stat
+
+    return h5
+
+
+def _as_unicode_dtype(dtype):
+    """Return ``dtype`` with any bytes (S) fields converted to unicode (U).
+    """
+    if six.PY2:
+        return dtype
+
+    dtypes = []
+    for descr in dtype.descr:
+        descr = list(descr)
+        descr[1] = re.sub('S', 'U', str(descr[1]))
+        dtypes.append(tuple(descr))
+
+    return np.dtype(dtypes)
+
+
+def _get_h5_files(server, start=None, stop=None):
+    """Get the HDF5 cmd_states files to read for ``server``.  This is just
+    ``server`` for a single HDF5 file.  For a shard directory (or its
+    manifest, see :mod:`chandra_cmd_states.shards`) it is the shard files
+    with states between ``start`` and ``stop`` in time order.
+
+    :returns: list of dicts with the ``filename`` (and manifest entries for
+              shards)
+    """
+    shard_dir = shards.get_shard_dir(server)
+    if shard_dir is None:
+        return [{'filename': server}]
+    return shards.get_shards(shard_dir,
+                             start.date if start else None,
+                             stop.date if stop else None)
+
+
+def _get_h5_files_for_range(server, start, stop):
+    """Get the HDF5 cmd_states files for ``server`` with states between
+    ``start`` and ``stop``, or raise ValueError if there are none.
+    """
+    h5_files = _get_h5_files(server, start, stop)
+    if len(h5_files) == 0:
+        raise ValueError('no cmd_states in {} between {} and {}'
+                         .format(server, start.date,
+                                 stop.date if stop else 'end'))
+    return h5_files
+
+
+def get_h5_states(start, stop, server):
+    """Get states from HDF5 ``server`` file (or shard directory) between
+    ``start`` and ``stop``.
+    """
+    states = [_get_h5_file_states(start, stop, h5_file['filename'])
+              for h5_file in _get_h5_files_for_range(server, start, stop)]
+    return states[0] if len(states) == 1 else np.concatenate(states)
+
+
+def _get_h5_file_states(start, stop, server):
+    """Get states from the HDF5 ``server`` file between ``start`` and
+    ``stop``.
+    """
+    h5 = _open_h5(server)
     h5d = h5.root.data
+    row_map = _get_h5_row_map(h5)
+    idx0, idx1 = _get_h5_row_range(h5d, start, stop, row_map)
+    states = _read_h5_rows(h5d, row_map, idx0, idx1)
+    h5.close()
+
+    states = states.astype(_as_unicode_dtype(states.dtype))
+
+    return states
+
 
+def _get_h5_row_range(h5d, start, stop, row_map=None):
+    """Get the row range [idx0, idx1) of states in HDF5 table ``h5d`` between
+    ``start`` and ``stop``.  With a ``row_map`` (versioned layout) the range
+    is of positions in the row map.
+    """
     query = "(datestop > b'{}')".format(start.date)
     if stop:
         query += " & (datestart < b'{}')".format(stop.date)
     idxs = (getattr(h5d, 'get_where_list', None) or h5d.getWhereList)(query)
+    if row_map is not None:
+        # Positions of the matching live states
+        positions = np.full(h5d.nrows, -1)
+        positions[row_map] = np.arange(len(row_map))
+        idxs = positions[idxs]
+        idxs = idxs[idxs >= 0]
     idx0, idx1 = np.min(idxs), np.max(idxs)
     if idx1 - idx0 != len(idxs) - 1:
         raise ValueError('HDF5 table seems to have elements out of order')
-    states = h5d[idx0:idx1 + 1]
-    h5.close()
 
-    if not six.PY2:
-        dtypes = []
-        for dtype in states.dtype.descr:
-            dtype = list(dtype)
-            dtype[1] = re.sub('S', 'U', str(dtype[1]))
-            dtypes.append(tuple(dtype))
-        states = states.astype(dtypes)
+    return idx0, idx1 + 1
 
-    return states
+
+def _read_h5_rows(h5d, row_map, row0, row1, field=None):
+    """Read states [row0, row1) from HDF5 table ``h5d``, as positions in the
+    ``row_map`` if it is not None.
+    """
+    if row_map is None:
+        return h5d.read(row0, row1, field=field)
+    return h5store.read_rows(h5d, row_map[row0:row1], field=field)
+
+
+def _get_h5_row_map(h5):
+    """Get the row map for the HDF5 cmd_states file ``h5``: the table rows of
+    the live states in time order for the versioned layout, else None.
+    """
+    return _get_h5_time_index(h5)[2] if h5store.is_versioned(h5) else None
+
+
+def _get_h5_time_index(h5):
+    """Get the resident (tstart, tstop, row map) index for the HDF5
+    cmd_states table in file ``h5`` (opened with :func:`_open_h5`).  For the
+    versioned layout tstart and tstop are of the live states in time order
+    and the row map gives their table rows, otherwise the row map is None.
+
+    The index is read once per file and kept in memory until the file
+    changes on disk.  The signature uses the file status from before the
+    file was opened, so if a new version is swapped in meanwhile the index
+    is just read again at the next call.
+    """
+    h5d = h5.root.data
+    filename = os.path.abspath(h5.filename)
+    stat = h5.open_stat
+    signature = (stat.st_ino, stat.st_mtime, stat.st_size, h5d.nrows)
+
+    index = _H5_TIME_INDEXES.get(filename)
+    if index is None or index[0] != signature:
+        if h5store.is_versioned(h5):
+            row_map = h5store.live_rows(h5)
+            index = (signature,
+                     h5store.read_rows(h5d, row_map, field='tstart'),
+                     h5store.read_rows(h5d, row_map, field='tstop'),
+                     row_map)
+        else:
+            index = (signature, h5d.col('tstart'), h5d.col('tstop'), None)
+        _H5_TIME_INDEXES[filename] = index
+
+    return index[1], index[2], index[3]
+
+
+def states_at(times, vals=None, server=None, chunk_size=1000000):
+    """Get the commanded state values at ``times`` directly from the HDF5
+    cmd_states table.
+
+    This gives the same values as ``interpolate_states(states, times)`` but
+    without first fetching the covering states.  A resident index of state
+    stop times is binary-searched for each chunk of ``times`` and only the
+    rows and columns that are hit are read from the table, so memory use
+    beyond the output array is bounded by ``chunk_size``.  The ``times`` do
+    not need to be sorted.
+
+    Example::
+
+      >>> from chandra_cmd_states import states_at
+      >>> vals = states_at(tlm_times, vals=['pitch', 'simpos'])
+      >>> diff = tlm_pitch - vals['pitch']
+
+    :param times: times (CXC seconds or Chandra.Time compatible array)
+    :param vals: list of state columns for output (default=all)
+    :param server: HDF5 file or shard directory (default=None)
+    :param chunk_size: number of times to look up in each chunk
+
+    :returns: structured array of state ``vals`` with the shape of ``times``
+    """
+    state_vals = _get_state_vals(vals)
+
+    times = np.asarray(times)
+    if times.dtype.kind not in 'iuf':
+        times = np.asarray(DateTime(times).secs)
+    flat_times = times.ravel()
+
+    h5_files = _get_h5_files(server)
+    if len(h5_files) == 1:
+        out = _states_at_file(flat_times, state_vals, h5_files[0]['filename'],
+                              chunk_size)
+    elif len(h5_files) == 0:
+        raise ValueError('HDF5 cmd_states table is empty')
+    else:
+        # Look up each time in the first shard that stops at or after it,
+        # which is the same lookup as within one file.
+        i_shards = np.searchsorted([h5_file['tstop'] for h5_file in h5_files],
+                                   flat_times)
+        i_shards = i_shards.clip(max=len(h5_files) - 1)
+        # No times gives an empty array with the state dtype, as for one file
+        dtype = _states_at_file(flat_times[:0], state_vals,
+                                h5_files[0]['filename'], chunk_size).dtype
+        out = np.empty(len(flat_times), dtype=dtype)
+        for i_shard in np.unique(i_shards):
+            ok = i_shards == i_shard
+            out[ok] = _states_at_file(flat_times[ok], state_vals,
+                                      h5_files[i_shard]['filename'],
+                                      chunk_size)
+
+    return out.reshape(times.shape)
+
+
+def _states_at_file(flat_times, state_vals, server, chunk_size):
+    """Get the ``state_vals`` at ``flat_times`` from the HDF5 ``server``
+    file (see :func:`states_at`).
+    """
+    h5 = _open_h5(server)
+    try:
+        h5d = h5.root.data
+        tstarts, tstops, row_map = _get_h5_time_index(h5)
+        if len(tstops) == 0:
+            raise ValueError('HDF5 cmd_states table is empty')
+
+        dtype = _as_unicode_dtype(np.dtype([(name, h5d.coldtypes[name])
+                                            for name in state_vals]))
+        out = np.empty(len(flat_times), dtype=dtype)
+
+        for i0 in range(0, len(flat_times), chunk_size):
+            chunk_times = flat_times[i0:i0 + chunk_size]
+
+            # Same lookup as interpolate_states, with times after the last
+            # state stop clipped to the last state.
+            idxs = np.searchsorted(tstops, chunk_times)
+            idxs = idxs.clip(max=len(tstops) - 1)
+            rows, i_rows = np.unique(idxs, return_inverse=True)
+            i_rows = i_rows.ravel()
+
+            # Read a contiguous block of rows if the hits are dense, otherwise
+            # read just the hit rows.
+            row0, row1 = rows[0], rows[-1] + 1
+            dense = (row1 - row0) <= 4 * len(rows)
+            out_chunk = out[i0:i0 + len(chunk_times)]
+            for name in state_vals:
+                if row_map is not None:
+                    col_vals = h5store.read_rows(h5d, row_map[rows],
+                                                 field=name)
+                elif dense:
+                    col_vals = h5d.read(row0, row1, field=name)[rows - row0]
+                else:
+                    col_vals = (getattr(h5d, 'read_coordinates', None)
+                                or h5d.readCoordinates)(rows, field=name)
+                out_chunk[name] = col_vals[i_rows]
+    finally:
+        h5.close()
+
+    return out
+
+
+def fetch_intervals(predicate, vals, start=None, stop=None, server=None,
+                    chunk_size=100000):
+    """Get the time intervals where ``predicate`` is true for the commanded
+    states in the HDF5 cmd_states table.
+
+    The ``predicate`` is a function that takes a structured array of states
+    with the ``vals`` columns and returns a boolean array.  It is evaluated
+    on the table in chunks of ``chunk_size`` states, reading only the
+    ``vals`` columns, and consecutive states where it is true are merged into
+    a single interval.  Intervals are clipped to ``start`` and ``stop``.
+
+    Example::
+
+      >>> from chandra_cmd_states import fetch_intervals
+      >>> def hetg_science(states):
+      ...     return ((states['pcad_mode'] == 'NPNT') & (states['simpos'] > 0)
+      ...             & (states['hetg'] == 'INSR'))
+      >>> intervals = fetch_intervals(hetg_science, ['pcad_mode', 'simpos', 'hetg'],
+      ...                             start='2010:001', stop='2011:001')
+      >>> hetg_days = intervals['duration'].sum() / 86400
+
+    :param predicate: function of states returning a boolean array
+    :param vals: list of state columns used by ``predicate``
+    :param start: start date (default=start of table)
+    :param stop: stop date (default=end of table)
+    :param server: HDF5 file or shard directory (default=None)
+    :param chunk_size: number of states to evaluate in each chunk
+
+    :returns: structured array with datestart, datestop, tstart, tstop and
+              duration of each interval
+    """
+    state_vals = _get_state_vals(vals)
+    start = DateTime(start) if start else None
+    stop = DateTime(stop) if stop else None
+
+    run_tstarts = []
+    run_tstops = []
+    in_run = False
+    for h5_file in _get_h5_files(server, start, stop):
+        tstarts, tstops, at_first, at_last = _get_h5_runs(
+            predicate, state_vals, start, stop, h5_file['filename'],
+            chunk_size)
+        if in_run and at_first:
+            # Run continues from the last state of the previous shard
+            run_tstops[-1] = tstops[0]
+            tstarts, tstops = tstarts[1:], tstops[1:]
+        run_tstarts.extend(tstarts)
+        run_tstops.extend(tstops)
+        in_run = at_last
+
+    intervals = np.zeros(len(run_tstarts), dtype=[('datestart', 'U21'),
+                                                  ('datestop', 'U21'),
+                                                  ('tstart', 'f8'),
+                                                  ('tstop', 'f8'),
+                                                  ('duration', 'f8')])
+    if len(intervals) == 0:
+        return intervals
+
+    intervals['tstart'] = run_tstarts
+    intervals['tstop'] = run_tstops
+    if start is not None:
+        intervals['tstart'] = intervals['tstart'].clip(min=start.secs)
+    if stop is not None:
+        intervals['tstop'] = intervals['tstop'].clip(max=stop.secs)
+    intervals['datestart'] = DateTime(intervals['tstart']).date
+    intervals['datestop'] = DateTime(intervals['tstop']).date
+    intervals['duration'] = intervals['tstop'] - intervals['tstart']
+
+    return intervals
+
+
+def _get_h5_runs(predicate, state_vals, start, stop, server, chunk_size):
+    """Get the runs of states in the HDF5 ``server`` file between ``start``
+    and ``stop`` where ``predicate`` is true (see :func:`fetch_intervals`).
+
+    :returns: tstart and tstop lists of the runs, and whether the first run
+              starts at the first state and the last run stops at the last
+              state of the table
+    """
+    h5 = _open_h5(server)
+    try:
+        h5d = h5.root.data
+        tstarts, tstops, row_map = _get_h5_time_index(h5)
+
+        # Rows with ``tstop > start`` and ``tstart < stop``
+        idx0 = (0 if start is None else
+                np.searchsorted(tstops, start.secs, side='right'))
+        idx1 = (len(tstarts) if stop is None else
+                np.searchsorted(tstarts, stop.secs, side='left'))
+
+        dtype = _as_unicode_dtype(np.dtype([(name, h5d.coldtypes[name])
+                                            for name in state_vals]))
+
+        # Row indexes where runs of true predicate start and (exclusive) stop
+        run_starts = []
+        run_stops = []
+        in_run = False
+        for row0 in range(idx0, idx1, chunk_size):
+            row1 = min(row0 + chunk_size, idx1)
+            states = np.empty(row1 - row0, dtype=dtype)
+            for name in state_vals:
+                states[name] = _read_h5_rows(h5d, row_map, row0, row1,
+                                             field=name)
+            ok = np.asarray(predicate(states), dtype=bool)
+
+            edges = np.diff(np.concatenate([[in_run], ok]).astype(np.int8))
+            run_starts.append(np.flatnonzero(edges == 1) + row0)
+            run_stops.append(np.flatnonzero(edges == -1) + row0)
+            in_run = ok[-1]
+
+        if in_run:
+            run_stops.append(np.array([idx1]))
+    finally:
+        h5.close()
+
+    run_starts = np.concatenate(run_starts) if run_starts else np.array([], dtype=int)
+    run_stops = np.concatenate(run_stops) if run_stops else np.array([], dtype=int)
+
+    # States are contiguous so each run spans from the start of its first state
+    # to the stop of its last state.
+    return (tstarts[run_starts].tolist(), tstops[run_stops - 1].tolist(),
+            len(run_starts) > 0 and run_starts[0] == 0,
+            bool(in_run) and idx1 == len(tstarts))
 
 
 def get_sql_states(start, stop, dbi, server, user, database):
@@ -99,11 +463,8 @@ def get_sql_states(start, stop, dbi, server, user, database):
         raise IOError('ERROR: failed to connect to {0}:{1} server: {2}'
                       .format(dbi, server, msg))
 
-    query = ("SELECT * from cmd_states WHERE datestop > '{}'"
-             .format(start.date))
-    if stop:
-        query += " AND datestart < '{}'".format(stop.date)
-    states = db.fetchall(query)
+    states = db.fetchall(queries.cmd_states_overlap(
+        start.date, stop.date if stop else None))
 
     return states
 
@@ -138,6 +499,297 @@ def fetch_states(start=None, stop=None, vals=None, allow_identical=False,
     :param database: sybase database (default=Ska.DBI default)
     """
 
+    state_vals = _get_state_vals(vals)
+
+    start = (DateTime(start) if start else DateTime() - 10)
+    if stop:
+        stop = DateTime(stop)
+
+    states = _get_states(start, stop, dbi, server, user, database)
+
+    states = reduce_states(states, state_vals,
+                           allow_identical=allow_identical)
+    states = _output_states(states, state_vals)
+
+    return states
+
+
+def iter_states(start=None, stop=None, vals=None, allow_identical=False,
+                server=None, chunk_size=10000):
+    """Iterate over Chandra commanded states from the HDF5 cmd_states table in
+    chunks of at most ``chunk_size`` states.
+
+    The concatenation of the chunks is the same as the output of
+    :func:`fetch_states` with the same arguments, but only ``chunk_size``
+    rows of the table are held in memory at a time.  This is used by the
+    get_cmd_states command line tool to stream long time ranges.
+
+    :param start: start date (default=Now-10 days)
+    :param stop: stop date (default=None)
+    :param vals: list of state columns for output
+    :param allow_identical: Allow identical states from cmd_states table
+    :param server: HDF5 file or shard directory (default=None)
+    :param chunk_size: number of table rows to process in each chunk
+
+    :returns: iterator over states structured arrays
+    """
+    state_vals = _get_state_vals(vals)
+
+    start = (DateTime(start) if start else DateTime() - 10)
+    if stop:
+        stop = DateTime(stop)
+
+    h5s = _open_h5_range(server, start, stop)
+    try:
+        for states in _iter_h5_states(h5s, start, stop, state_vals,
+                                      allow_identical, chunk_size):
+            yield states
+    finally:
+        for h5 in h5s:
+            h5.close()
+
+
+def _open_h5_range(server, start, stop):
+    """Open the HDF5 cmd_states files of ``server`` with states between
+    ``start`` and ``stop`` (one file unless ``server`` is a shard directory).
+
+    :returns: list of HDF5 file handles
+    """
+    h5s = []
+    try:
+        for h5_file in _get_h5_files_for_range(server, start, stop):
+            h5s.append(_open_h5(h5_file['filename']))
+    except Exception:
+        for h5 in h5s:
+            h5.close()
+        raise
+    return h5s
+
+
+def _iter_h5_states(h5s, start, stop, state_vals, allow_identical=False,
+                    chunk_size=10000):
+    """Iterate over the states between ``start`` and ``stop`` in the open
+    HDF5 cmd_states files ``h5s`` (see :func:`iter_states`).  This can be
+    called more than once on the same files, e.g. for the two passes of the
+    text output, and always gives the same states.
+    """
+    # Last selected state, which is held back until the datestart of the
+    # next selected state (i.e. its datestop) is known, and the last state of
+    # the previous chunk.
+    pending = None
+    prev_state = None
+    for h5 in h5s:
+        h5d = h5.root.data
+        row_map = _get_h5_row_map(h5)
+        idx0, idx1 = _get_h5_row_range(h5d, start, stop, row_map)
+
+        for row0 in range(idx0, idx1, chunk_size):
+            row1 = min(row0 + chunk_size, idx1)
+
+            # Include the last state of the previous chunk (or shard) so
+            # transitions at the chunk boundary are evaluated against the
+            # previous state.
+            states = _read_h5_rows(h5d, row_map, row0, row1)
+            states = states.astype(_as_unicode_dtype(states.dtype))
+            if prev_state is not None:
+                states = np.concatenate([prev_state, states])
+            transitions = _get_transitions(states, state_vals,
+                                           allow_identical=allow_identical)
+            if prev_state is not None:
+                states = states[1:]
+                transitions = transitions[1:]
+            prev_state = states[-1:]
+
+            new_states = _output_states(states, state_vals)[transitions]
+            if pending is not None:
+                new_states = np.concatenate([pending, new_states])
+            new_states['datestop'][:-1] = new_states['datestart'][1:]
+            new_states['tstop'][:-1] = new_states['tstart'][1:]
+
+            pending = new_states[-1:].copy()
+            if len(new_states) > 1:
+                yield new_states[:-1]
+
+    pending['datestop'][-1] = states['datestop'][-1]
+    pending['tstop'][-1] = np.round(states['tstop'][-1], 3)
+    yield pending
+
+
+def write_states(states, out, format='text', chunk_size=10000):
+    """Write ``states`` to the file object ``out`` in the given ``format``.
+
+    Formats are:
+
+    - ``text``: space-delimited aligned columns with a header line.  This is
+      the same as ``Ska.Numpy.pformat(states)``.
+    - ``csv``: comma-separated values with a header line.
+    - ``npy``: NumPy ``.npy`` file that can be read with ``np.load()``.
+    - ``bin``: raw binary structured records with strings encoded as
+      bytes, matching the dtype of the HDF5 table.
+
+    The ``states`` can be a states structured array or a function that
+    returns an iterator over chunks of states, e.g.
+    ``lambda: iter_states(start, stop)``.  The output is written one chunk
+    at a time.  For the text format the function is called twice, first to
+    get the column widths and then to write the rows, and for the npy format
+    first to count the states for the header.  Both calls must give the
+    same states.  The npy and bin
+    formats need a binary ``out``.
+
+    :param states: states structured array or function returning chunks
+    :param out: output file object
+    :param format: output format (text|csv|npy|bin)
+    :param chunk_size: number of states per chunk for array input
+    """
+    if format not in OUTPUT_FORMATS:
+        raise ValueError("format argument '{}' must be one of {}"
+                         .format(format, ', '.join(OUTPUT_FORMATS)))
+
+    if callable(states):
+        get_chunks = states
+    else:
+        def get_chunks():
+            for i0 in range(0, len(states), chunk_size):
+                yield states[i0:i0 + chunk_size]
+
+    if format == 'text':
+        widths = None
+        for chunk in get_chunks():
+            chunk_widths = [np.char.str_len(_as_str(chunk[name])).max(initial=0)
+                            for name in chunk.dtype.names]
+            if widths is None:
+                widths = [len(name) for name in chunk.dtype.names]
+            widths = [max(width, chunk_width)
+                      for width, chunk_width in zip(widths, chunk_widths)]
+        if widths is None:
+            return
+
+        header = None
+        for chunk in get_chunks():
+            if header is None:
+                header = ' '.join(name.ljust(width) for name, width
+                                  in zip(chunk.dtype.names, widths))
+                out.write(header + '\n')
+            lines = np.char.ljust(_as_str(chunk[chunk.dtype.names[0]]), widths[0])
+            for name, width in zip(chunk.dtype.names[1:], widths[1:]):
+                lines = np.char.add(np.char.add(lines, ' '),
+                                    np.char.ljust(_as_str(chunk[name]), width))
+            if len(lines):
+                out.write('\n'.join(lines.tolist()) + '\n')
+
+    elif format == 'csv':
+        import csv
+        writer = None
+        for chunk in get_chunks():
+            if writer is None:
+                writer = csv.writer(out, lineterminator='\n')
+                writer.writerow(chunk.dtype.names)
+            writer.writerows(chunk.tolist())
+
+    elif format == 'npy':
+        # The header needs the total number of states so count them first
+        n_states = sum(len(chunk) for chunk in get_chunks())
+        for i_chunk, chunk in enumerate(get_chunks()):
+            if i_chunk == 0:
+                np.lib.format.write_array_header_1_0(
+                    out, {'descr': np.lib.format.dtype_to_descr(chunk.dtype),
+                          'fortran_order': False,
+                          'shape': (n_states,)})
+            out.write(np.ascontiguousarray(chunk).tobytes())
+
+    elif format == 'bin':
+        for chunk in get_chunks():
+            chunk = chunk.astype(_as_bytes_dtype(chunk.dtype))
+            out.write(chunk.tobytes())
+
+
+def _as_str(vals):
+    """Convert ``vals`` to an array of str as given by ``str(val)``.
+    """
+    return np.asarray(vals).astype(str)
+
+
+def _as_bytes_dtype(dtype):
+    """Return ``dtype`` with any unicode (U) fields converted to bytes (S).
+    """
+    dtypes = []
+    for descr in dtype.descr:
+        descr = list(descr)
+        descr[1] = re.sub('U', 'S', str(descr[1]))
+        dtypes.append(tuple(descr))
+
+    return np.dtype(dtypes)
+
+
+def fetch_states_many(windows, vals=None, allow_identical=False,
+                      dbi='hdf5', server=None, user='aca_read', database='aca'):
+    """Get Chandra commanded states for many time windows at once.
+
+    This is equivalent to calling :func:`fetch_states` for each ``(start,
+    stop)`` pair in ``windows`` but is much faster for a large number of
+    windows.  The data source is opened and read only once for the span of
+    all the windows, then each window is located within that span with a
+    binary search.
+
+    Example::
+
+      >>> from chandra_cmd_states import fetch_states_many
+      >>> windows = [('2011:100:12:00:00', '2011:100:18:00:00'),
+      ...            ('2011:101:00:00:00', '2011:101:12:00:00')]
+      >>> states_list = fetch_states_many(windows, vals=['obsid', 'simpos'])
+      >>> [len(states) for states in states_list]
+      [1, 3]
+
+    :param windows: list of (start, stop) date pairs
+    :param vals: list of state columns for output
+    :param allow_identical: Allow identical states from cmd_states table
+    :param dbi: database interface (default=hdf5)
+    :param server: DBI server or HDF5 file (default=None)
+    :param user: sybase database user (default='aca_read')
+    :param database: sybase database (default=Ska.DBI default)
+
+    :returns: list of states structured arrays, one for each window
+    """
+    state_vals = _get_state_vals(vals)
+
+    if len(windows) == 0:
+        return []
+
+    starts, stops = zip(*windows)
+    starts = np.atleast_1d(DateTime(list(starts)).date)
+    stops = np.atleast_1d(DateTime(list(stops)).date)
+
+    # Read the union span of all windows in one query
+    states = _get_states(DateTime(min(starts)), DateTime(max(stops)),
+                         dbi, server, user, database)
+
+    # Locate each window within the union span.  These match the selection
+    # ``datestop > start AND datestart < stop`` used in fetch_states.
+    idx0s = np.searchsorted(states['datestop'], starts, side='right')
+    idx1s = np.searchsorted(states['datestart'], stops, side='left')
+
+    # Transitions within each window are the same as in the union span
+    # except that the first state of a window is always a transition.
+    transitions = _get_transitions(states, state_vals,
+                                   allow_identical=allow_identical)
+    out_states = _output_states(states, state_vals)
+
+    states_list = []
+    for idx0, idx1 in zip(idx0s, idx1s):
+        if idx1 <= idx0:
+            states_list.append(out_states[0:0].copy())
+            continue
+        window_transitions = transitions[idx0:idx1].copy()
+        window_transitions[0] = True
+        states_list.append(_select_transitions(out_states[idx0:idx1],
+                                               window_transitions))
+
+    return states_list
+
+
+def _get_state_vals(vals):
+    """Validate requested state ``vals`` and return the list of state columns.
+    """
     allowed_state_vals = STATE_VALS
 
     if vals is None:
@@ -149,10 +801,12 @@ def fetch_states(start=None, stop=None, vals=None, allow_identical=False,
             raise ValueError('ERROR: requested --values {} are not allowed '
                              .format(','.join(sorted(bad_state_vals))))
 
-    start = (DateTime(start) if start else DateTime() - 10)
-    if stop:
-        stop = DateTime(stop)
+    return state_vals
 
+
+def _get_states(start, stop, dbi, server, user, database):
+    """Get all states between ``start`` and ``stop`` from the ``dbi`` source.
+    """
     if dbi == 'hdf5':
         states = get_h5_states(start, stop, server)
     elif dbi in ('sybase', 'sqlite'):
@@ -161,11 +815,15 @@ def fetch_states(start=None, stop=None, vals=None, allow_identical=False,
         raise ValueError("dbi argument '{}' must be one of 'hdf5', 'sybase', "
                          "'sqlite'".format(dbi))
 
-    states = reduce_states(states, state_vals,
-                           allow_identical=allow_identical)
+    return states
+
+
+def _output_states(states, state_vals):
+    """Select the output columns ``state_vals`` from ``states`` and round times.
+    """
     states = Ska.Numpy.structured_array(
         states, colnames=['datestart', 'datestop',
-                          'tstart', 'tstop'] + state_vals)
+                          'tstart', 'tstop'] + list(state_vals))
 
     states['tstart'] = np.round(states['tstart'], 3)
     states['tstop'] = np.round(states['tstop'], 3)
@@ -173,13 +831,14 @@ def fetch_states(start=None, stop=None, vals=None, allow_identical=False,
     return states
 
 
+@profiled
 def main(main_args=None):
     """Command line interface to fetch_states.
     """
 
     descr = ('Get the Chandra commanded states over a range '
              'of time as a space-delimited ASCII table.')
-    parser = argparse.ArgumentParser(description=descr)
+    parser = argparse.ArgumentParser(description=descr, epilog=PROFILE_HELP)
     parser.add_argument("--start",
                         help="Start date (default=Now-10 days)")
     parser.add_argument("--stop",
@@ -194,11 +853,16 @@ def main(main_args=None):
                         "(default=False)")
     parser.add_argument("--outfile",
                         help="Output file (default=stdout)")
+    parser.add_argument("--format",
+                        default='text',
+                        choices=OUTPUT_FORMATS,
+                        help="Output format (text|csv|npy|bin) (default=text)")
     parser.add_argument("--dbi",
                         default='hdf5',
                         help="Cmd states data source (sybase|hdf5|sqlite) (default=hdf5)")
     parser.add_argument("--server",
-                        help="DBI server (sybase) or data file (hdf5 or sqlite)")
+                        help="DBI server (sybase), data file (hdf5 or sqlite) "
+                        "or shard directory (hdf5)")
     parser.add_argument("--user",
                         default='aca_read',
                         help="sybase database user (default='aca_read')")
@@ -207,8 +871,8 @@ def main(main_args=None):
 
     args = parser.parse_args(main_args)
     kwargs = vars(args)
-    outfile = kwargs['outfile']
-    del kwargs['outfile']
+    outfile = kwargs.pop('outfile')
+    format = kwargs.pop('format')
 
     if kwargs['vals'] is not None:
         input_vals = kwargs['vals'].split(',')
@@ -218,10 +882,36 @@ def main(main_args=None):
                 ordered_vals.append(state_val)
         kwargs['vals'] = ordered_vals
 
-    states = fetch_states(**kwargs)
+    h5s = []
+    if kwargs['dbi'] == 'hdf5':
+        # Stream states from the HDF5 table in chunks.  The text and npy
+        # writers read the states twice, so the time range and files are
+        # fixed here and both passes see the same version of the table even
+        # if an update replaces it meanwhile.
+        start = (DateTime(kwargs['start']) if kwargs['start']
+                 else DateTime() - 10)
+        stop = DateTime(kwargs['stop']) if kwargs['stop'] else None
+        state_vals = _get_state_vals(kwargs['vals'])
+        h5s = _open_h5_range(kwargs['server'], start, stop)
+
+        def states():
+            return _iter_h5_states(h5s, start, stop, state_vals,
+                                   allow_identical=kwargs['allow_identical'])
+    else:
+        states = fetch_states(**kwargs)
 
-    out = open(outfile, 'w') if outfile else sys.stdout
-    out.write(Ska.Numpy.pformat(states))
+    binary = format in ('npy', 'bin')
+    try:
+        if outfile:
+            out = open(outfile, 'wb' if binary else 'w')
+        else:
+            out = sys.stdout.buffer if binary else sys.stdout
+        write_states(states, out, format=format)
+        if outfile:
+            out.close()
+    finally:
+        for h5 in h5s:
+            h5.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,265 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Layouts of the HDF5 cmd_states table.
+
+The *flat* layout is a single ``/data`` table holding the states in time
+order.  Replacing states means removing rows from the end of the table and
+appending the new states.
+
+The *versioned* (append-only) layout never removes rows.  ``/data`` has an
+extra ``generation`` column and a ``/cuts`` table records a tombstone for
+each update: the generation of the update and the start of the replaced
+states.  A row is superseded by any cut of a later generation at or before
+its tstart, so the live states are::
+
+  tstart < min(cut tstart for cuts with generation > row generation)
+
+Readers get the physical row indexes of the live states in time order from
+:func:`live_rows` (cached with the time index by the readers in
+``get_cmd_states``) and read them with :func:`read_rows`.  Superseded rows
+accumulate until :func:`compact` rewrites the table with only the live
+states.
+
+Writers of a cmd_states file (``update_cmd_states`` and
+``repack_cmd_states``) hold a :class:`WriterLock` so their new versions of
+the file are never swapped in over each other.
+"""
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+GENERATION_COL = 'generation'
+CUTS_DTYPE = [('generation', '<i4'),
+              ('datestart', '|S21'),
+              ('tstart', '<f8')]
+
+# Dates have a resolution of 1 msec so a cut half a msec before the first
+# replaced datestart cleanly separates kept and replaced states.
+CUT_MARGIN = 0.0005
+
+
+def is_versioned(h5):
+    """True if the HDF5 file ``h5`` has the versioned layout"""
+    return hasattr(h5.root, 'cuts')
+
+
+def _states_only(recs):
+    """Drop the ``generation`` column from the table records ``recs``"""
+    names = recs.dtype.names
+    if names is None or GENERATION_COL not in names:
+        return recs
+    dtype = [(name, recs.dtype[name]) for name in names
+             if name != GENERATION_COL]
+    out = np.empty(recs.shape, dtype=dtype)
+    for name in out.dtype.names:
+        out[name] = recs[name]
+    return out
+
+
+def _with_generation(rows, generation):
+    """Add a ``generation`` column with value ``generation`` to ``rows``"""
+    out = np.empty(len(rows), dtype=rows.dtype.descr
+                   + [(GENERATION_COL, '<i4')])
+    for name in rows.dtype.names:
+        out[name] = rows[name]
+    out[GENERATION_COL] = generation
+    return out
+
+
+def create_tables(h5, rows, versioned=False, expectedrows=5e5, filters=None,
+                  chunkshape=None, index=False):
+    """
+    Create the cmd_states table ``h5.root.data`` (and ``h5.root.cuts`` for
+    the versioned layout) from the states table ``rows``.
+
+    :param h5: HDF5 file object
+    :param rows: states with the HDF5 table dtype
+    :param versioned: use the versioned (append-only) layout
+    :param expectedrows: expected number of table rows
+    :param filters: tables.Filters for the data table (default=file filters)
+    :param chunkshape: rows per HDF5 chunk (default=PyTables choice for
+                       ``expectedrows``)
+    :param index: create a completely sorted index on tstart
+    """
+    create_table = getattr(h5, 'create_table', None) or h5.createTable
+    if versioned:
+        rows = _with_generation(rows, 0)
+    kwargs = {'expectedrows': expectedrows}
+    if filters is not None:
+        kwargs['filters'] = filters
+    if chunkshape is not None:
+        kwargs['chunkshape'] = (int(chunkshape),)
+    create_table(h5.root, 'data', rows, "Cmd_states", **kwargs)
+    if versioned:
+        create_table(h5.root, 'cuts', np.zeros(0, dtype=CUTS_DTYPE),
+                     "Cmd_states superseded after each update")
+        h5.root.data.attrs.generation = 0
+    if index:
+        create_index(h5.root.data)
+    h5.flush()
+
+
+def create_index(h5d, col='tstart'):
+    """
+    Create a completely sorted index (CSI) on column ``col`` of table
+    ``h5d``.  PyTables keeps it up to date as rows are appended and removed.
+
+    :param h5d: HDF5 table
+    :param col: column name
+    """
+    column = h5d.cols._f_col(col)
+    create_csindex = (getattr(column, 'create_csindex', None)
+                      or column.createCSIndex)
+    create_csindex()
+
+
+def is_indexed(h5d, col='tstart'):
+    """True if column ``col`` of table ``h5d`` is indexed"""
+    column = h5d.cols._f_col(col)
+    return bool(getattr(column, 'is_indexed', None)
+                or getattr(column, 'index', None))
+
+
+def remove_tables(h5):
+    """Remove the cmd_states tables from ``h5``"""
+    remove_node = getattr(h5, 'remove_node', None) or h5.removeNode
+    for name in ('data', 'cuts'):
+        if hasattr(h5.root, name):
+            remove_node(h5.root, name)
+
+
+def live_rows(h5):
+    """
+    Get the physical row indexes of the live states in time order.
+
+    :param h5: HDF5 file object
+    :returns: int array of row indexes
+    """
+    h5d = h5.root.data
+    if not is_versioned(h5) or h5.root.cuts.nrows == 0:
+        return np.arange(h5d.nrows)
+
+    cuts = h5.root.cuts.read()
+    cuts.sort(order='generation')
+    # Earliest cut tstart of any generation after each cut index
+    limits = np.append(np.minimum.accumulate(cuts['tstart'][::-1])[::-1],
+                       np.inf)
+    tstarts = h5d.col('tstart')
+    idx = np.searchsorted(cuts['generation'], h5d.col(GENERATION_COL),
+                          side='right')
+    rows = np.flatnonzero(tstarts < limits[idx])
+    return rows[np.argsort(tstarts[rows], kind='stable')]
+
+
+def read_rows(h5d, rows, field=None):
+    """
+    Read the states at physical row indexes ``rows`` of table ``h5d``,
+    without the ``generation`` column.
+
+    :param h5d: HDF5 table
+    :param rows: int array of row indexes
+    :param field: read only this column (default=all state columns)
+    :returns: structured array of states or column values
+    """
+    rows = np.asarray(rows)
+    if len(rows) > 0 and rows[-1] - rows[0] == len(rows) - 1 and \
+            np.all(np.diff(rows) == 1):
+        recs = h5d.read(rows[0], rows[-1] + 1, field=field)
+    else:
+        read_coordinates = (getattr(h5d, 'read_coordinates', None)
+                            or h5d.readCoordinates)
+        recs = read_coordinates(rows, field=field)
+    return recs if field else _states_only(recs)
+
+
+def cut(h5, cut_date, cut_tstart):
+    """
+    Start a new generation of the versioned table that supersedes the states
+    starting at or after ``cut_date``.
+
+    :param h5: HDF5 file object with the versioned layout
+    :param cut_date: datestart of the first superseded state
+    :param cut_tstart: tstart (CXC sec) of ``cut_date``
+    """
+    h5d = h5.root.data
+    generation = int(h5d.attrs.generation) + 1
+    cut = np.zeros(1, dtype=CUTS_DTYPE)
+    cut[0] = (generation, cut_date, cut_tstart - CUT_MARGIN)
+    h5.root.cuts.append(cut)
+    h5.root.cuts.flush()
+    h5d.attrs.generation = generation
+
+
+def append(h5, rows):
+    """
+    Append the states ``rows`` to the cmd_states table in ``h5``.  For the
+    versioned layout they get the current generation.
+
+    :param h5: HDF5 file object
+    :param rows: states with the HDF5 table dtype
+    """
+    h5d = h5.root.data
+    if is_versioned(h5):
+        rows = _with_generation(rows, int(h5d.attrs.generation))
+    if len(rows) > 0:
+        h5d.append(rows)
+    h5d.flush()
+
+
+def compact(h5, versioned=None):
+    """
+    Rewrite the cmd_states table in ``h5`` with only the live states.  This
+    also converts between layouts.
+
+    :param h5: HDF5 file object
+    :param versioned: layout of the new table (default=current layout)
+    :returns: number of superseded rows dropped
+    """
+    if versioned is None:
+        versioned = is_versioned(h5)
+    h5d = h5.root.data
+    n_rows = h5d.nrows
+    rows = read_rows(h5d, live_rows(h5))
+    kwargs = {'filters': h5d.filters,
+              'chunkshape': h5d.chunkshape[0],
+              'index': is_indexed(h5d)}
+    remove_tables(h5)
+    create_tables(h5, rows, versioned=versioned, **kwargs)
+    return int(n_rows - len(rows))
+
+
+class WriterLock(object):
+    """
+    Exclusive lock for writing a new version of the HDF5 cmd_states file
+    ``filename``, held on ``<filename>.lock``.  Readers do not take it.
+    Without ``fcntl`` (not POSIX) this does nothing.
+
+    :param filename: HDF5 cmd_states file name
+    """
+    def __init__(self, filename):
+        self.filename = filename + '.lock'
+        self.fh = None
+
+    def acquire(self):
+        """Wait for and take the lock"""
+        if self.fh is None and fcntl is not None:
+            self.fh = open(self.filename, 'a')
+            fcntl.flock(self.fh.fileno(), fcntl.LOCK_EX)
+
+    def release(self):
+        """Release the lock"""
+        if self.fh is not None:
+            fcntl.flock(self.fh.fileno(), fcntl.LOCK_UN)
+            self.fh.close()
+            self.fh = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
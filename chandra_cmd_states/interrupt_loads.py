@@ -8,11 +8,12 @@ import logging
 
 import Ska.DBI
 import chandra_cmd_states as cmd_states
+from chandra_cmd_states.profiling import profiled, PROFILE_HELP
 
 
 def get_options():
     from optparse import OptionParser
-    parser = OptionParser()
+    parser = OptionParser(epilog=PROFILE_HELP)
     parser.set_defaults()
     parser.add_option("--dbi",
                       default='sqlite',
@@ -37,6 +38,7 @@ def get_options():
     return (opt, args)
 
 
+@profiled
 def main():
     opt, args = get_options()
 
@@ -0,0 +1,144 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Run metrics (per-stage wall and CPU time plus counters) for the commanded
+states processing, with output as a JSON file or a Prometheus textfile.
+
+Example::
+
+  metrics = Metrics()
+  with metrics.stage('get_cmds'):
+      cmds = get_cmds(datestart, db=db, metrics=metrics)
+  metrics.count('get_cmds.cmds', len(cmds))
+  metrics.write('cmd_states_metrics.json')
+"""
+
+import os
+import re
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class Metrics(object):
+    """
+    Collect per-stage timing and counters for a processing run.
+
+    Stages are named code blocks timed with :meth:`stage`.  Nested stages
+    are conventionally named ``<outer>.<inner>``, e.g. ``get_cmds.backstop``.
+    Counters are named numeric values set with :meth:`count` or :meth:`set`.
+
+    :param prefix: metric name prefix for Prometheus output
+    """
+    def __init__(self, prefix='cmd_states'):
+        self.prefix = prefix
+        self.start_time = time.time()
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager that adds the wall and CPU time of the enclosed block
+        to stage ``name``.  Repeated calls accumulate.
+
+        :param name: stage name
+        """
+        wall0 = time.perf_counter()
+        cpu0 = time.process_time()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, OrderedDict(
+                [('calls', 0), ('wall', 0.0), ('cpu', 0.0)]))
+            stage['calls'] += 1
+            stage['wall'] += time.perf_counter() - wall0
+            stage['cpu'] += time.process_time() - cpu0
+
+    def count(self, name, n=1):
+        """
+        Increment counter ``name`` by ``n``.
+
+        :param name: counter name
+        :param n: increment (default=1)
+        """
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        """
+        Set counter ``name`` to ``value``.
+
+        :param name: counter name
+        :param value: numeric value
+        """
+        self.counters[name] = value
+
+    def hit_rate(self, name, hits, misses):
+        """
+        Set counter ``name`` to the fraction ``hits / (hits + misses)`` of the
+        counters ``hits`` and ``misses``.  Nothing is set if both are zero.
+
+        :param name: counter name for the rate
+        :param hits: name of the hits counter
+        :param misses: name of the misses counter
+        """
+        n_hits = self.counters.get(hits, 0)
+        n_total = n_hits + self.counters.get(misses, 0)
+        if n_total:
+            self.set(name, n_hits / n_total)
+
+    def as_dict(self):
+        """
+        Return the metrics as a dict with keys ``start_time`` (unix time),
+        ``stages`` and ``counters``.
+        """
+        return OrderedDict([('start_time', self.start_time),
+                            ('stages', self.stages),
+                            ('counters', self.counters)])
+
+    def prometheus_text(self):
+        """
+        Return the metrics in the Prometheus text exposition format.  Stages
+        are ``<prefix>_stage_{calls,wall_seconds,cpu_seconds}`` metrics with a
+        ``stage`` label and counters are ``<prefix>_<counter>`` gauges.
+        """
+        prefix = _metric_name(self.prefix)
+        lines = ['# TYPE {}_start_time_seconds gauge'.format(prefix),
+                 '{}_start_time_seconds {:.3f}'.format(prefix,
+                                                       self.start_time)]
+        for key, suffix in (('calls', 'calls'),
+                            ('wall', 'wall_seconds'),
+                            ('cpu', 'cpu_seconds')):
+            name = '{}_stage_{}'.format(prefix, suffix)
+            lines.append('# TYPE {} gauge'.format(name))
+            for stage, vals in self.stages.items():
+                lines.append('{}{{stage="{}"}} {}'
+                             .format(name, stage, vals[key]))
+        for counter, value in self.counters.items():
+            name = '{}_{}'.format(prefix, _metric_name(counter))
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        """
+        Write metrics to ``filename``.  A Prometheus textfile is written if
+        the name ends with ``.prom``, otherwise JSON.  The file is written
+        to a temporary file and then renamed so readers never see a partial
+        file.
+
+        :param filename: output file name
+        """
+        if filename.endswith('.prom'):
+            text = self.prometheus_text()
+        else:
+            text = json.dumps(self.as_dict(), indent=2) + '\n'
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'w') as fh:
+            fh.write(text)
+        os.replace(tmp_filename, filename)
+
+
+def _metric_name(name):
+    """Convert ``name`` to a valid Prometheus metric name component"""
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
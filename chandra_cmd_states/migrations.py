@@ -0,0 +1,114 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Schema migrations for commanded states databases made from older versions of
+the ``*_def.sql`` table definitions.  Each migration checks what is already
+in place so :func:`migrate_db` can safely be run more than once.
+"""
+
+import logging
+
+from .cmd_states import STATE_PAR_COLS, _db_value, has_state_par_cols
+
+# Indexes on numeric time columns: (name, table, columns)
+TIME_INDEXES = (('idx_cmds_time', 'cmds', ('time',)),
+                ('idx_cmds_timeline_id_time', 'cmds', ('timeline_id', 'time')),
+                ('idx_cmd_states_tstart', 'cmd_states', ('tstart',)),
+                ('idx_cmd_states_tstop', 'cmd_states', ('tstop',)),
+                ('idx_cmd_states_pcad_mode_tstart', 'cmd_states',
+                 ('pcad_mode', 'tstart')),
+                ('idx_cmd_states_pcad_mode_tstop', 'cmd_states',
+                 ('pcad_mode', 'tstop')))
+
+# SQL types of the cmds state parameter columns
+STATE_PAR_TYPES = {'ID': 'int',
+                   'POS': 'int',
+                   'Q1': 'float(16)',
+                   'Q2': 'float(16)',
+                   'Q3': 'float(16)',
+                   'Q4': 'float(16)'}
+
+
+def add_time_indexes(db):
+    """
+    Add the ``TIME_INDEXES`` to an existing database, skipping any index that
+    already exists.
+
+    :param db: Ska.DBI.DBI object
+
+    :returns: list of names of indexes that were created
+    """
+    created = []
+    for name, table, cols in TIME_INDEXES:
+        try:
+            db.execute('CREATE INDEX {} ON {} ({})'
+                       .format(name, table, ', '.join(cols)))
+        except Exception as err:
+            if 'exist' not in str(err).lower():
+                raise
+            logging.debug('add_time_indexes: index {} already exists'
+                          .format(name))
+        else:
+            logging.info('add_time_indexes: created index {}'.format(name))
+            created.append(name)
+    return created
+
+
+def add_state_par_cols(db):
+    """
+    Add the state parameter columns (``par_id``, ``par_pos``, ``par_q1`` to
+    ``par_q4``) to the cmds table and fill them from the cmd_intpars and
+    cmd_fltpars tables.  Nothing is done if the columns already exist.
+
+    :param db: Ska.DBI.DBI object
+
+    :returns: number of cmds rows that were updated
+    """
+    if has_state_par_cols(db):
+        logging.debug('add_state_par_cols: columns already exist')
+        return 0
+
+    for name, col in STATE_PAR_COLS:
+        logging.info('add_state_par_cols: adding cmds column {}'.format(col))
+        db.execute('ALTER TABLE cmds ADD {} {} NULL'
+                   .format(col, STATE_PAR_TYPES[name]))
+
+    # Collect the parameter values for each command id
+    par_cols = dict(STATE_PAR_COLS)
+    names = ', '.join("'{}'".format(name) for name in par_cols)
+    cmd_pars = {}
+    for par_table in ('cmd_intpars', 'cmd_fltpars'):
+        pars = db.fetchall('SELECT cmd_id, name, value FROM {} WHERE name IN ({})'
+                           .format(par_table, names))
+        for par in pars:
+            cmd_pars.setdefault(int(par.cmd_id), {})[par_cols[par.name]] = \
+                _db_value(par.value)
+
+    cols = [col for name, col in STATE_PAR_COLS]
+    rows = [tuple(pars.get(col) for col in cols) + (cmd_id,)
+            for cmd_id, pars in sorted(cmd_pars.items())]
+    logging.info('add_state_par_cols: updating {} cmds'.format(len(rows)))
+    if db.dbi == 'sqlite':
+        update = ('UPDATE cmds SET {} WHERE id = ?'
+                  .format(', '.join('{} = ?'.format(col) for col in cols)))
+        db.conn.cursor().executemany(update, rows)
+    else:
+        for row in rows:
+            vals = ['NULL' if val is None else repr(val) for val in row[:-1]]
+            db.execute('UPDATE cmds SET {} WHERE id = {:d}'
+                       .format(', '.join('{} = {}'.format(col, val)
+                                         for col, val in zip(cols, vals)),
+                               row[-1]),
+                       commit=False)
+    db.conn.commit()
+
+    return len(rows)
+
+
+def migrate_db(db):
+    """
+    Apply all schema migrations to the commanded states database ``db``.
+
+    :param db: Ska.DBI.DBI object
+    """
+    add_time_indexes(db)
+    add_state_par_cols(db)
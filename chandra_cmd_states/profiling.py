@@ -0,0 +1,195 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Profiling support for the command line interfaces.
+
+Decorating a command line ``main()`` function with :func:`profiled` adds the
+options::
+
+  --profile[=MODE[,MODE]]  Profile the run, MODE is cprofile (default) or
+                           tracemalloc
+  --profile-file=FILE      Profile report file (default=<prog>.profile.txt)
+
+These are taken out of the argument list before ``main()`` parses its own
+options: the list passed as the first argument of ``main(args)`` if given,
+else ``sys.argv``.
+The ``CMD_STATES_PROFILE`` and ``CMD_STATES_PROFILE_FILE`` environment
+variables give the same settings, e.g. for a cron job::
+
+  env CMD_STATES_PROFILE=cprofile,tracemalloc update_cmd_states.py ...
+
+With ``cprofile`` the report lists the hot functions sorted by cumulative and
+by internal time, and the raw profile is saved as ``<FILE>.pstats`` for
+viewing with other tools.  With ``tracemalloc`` the report has the current and
+peak traced memory and the top allocation sites at the end of the run.  When
+profiling is not enabled ``main()`` is called directly.
+"""
+
+import os
+import sys
+import time
+import inspect
+import logging
+import functools
+
+PROFILE_MODES = ('cprofile', 'tracemalloc')
+PROFILE_ENV = 'CMD_STATES_PROFILE'
+PROFILE_FILE_ENV = 'CMD_STATES_PROFILE_FILE'
+
+# Number of lines in each section of the report
+N_REPORT = 40
+
+# Epilog for command line help of profiled programs
+PROFILE_HELP = ('Use --profile[=cprofile|tracemalloc] (or set the {} '
+                'environment variable) to profile the run and '
+                '--profile-file=FILE to set the report file.'
+                .format(PROFILE_ENV))
+
+
+def profile_args(argv, environ=None):
+    """
+    Get the profile settings from command line ``argv`` and the ``environ``
+    environment (default=os.environ).  Command line options take precedence.
+
+    :param argv: command line arguments (not including the program name)
+    :param environ: environment dict (default=os.environ)
+
+    :returns: tuple of (modes, profile_file, remaining argv), where modes is
+              an empty list if profiling is not enabled
+    """
+    if environ is None:
+        environ = os.environ
+    modes = environ.get(PROFILE_ENV) or None
+    profile_file = environ.get(PROFILE_FILE_ENV) or None
+
+    args = []
+    argv = list(argv)
+    while argv:
+        arg = argv.pop(0)
+        if arg == '--':
+            args.append(arg)
+            args.extend(argv)
+            break
+        if arg == '--profile':
+            modes = 'cprofile'
+        elif arg.startswith('--profile='):
+            modes = arg.split('=', 1)[1]
+        elif arg == '--profile-file' and argv:
+            profile_file = argv.pop(0)
+        elif arg.startswith('--profile-file='):
+            profile_file = arg.split('=', 1)[1]
+        else:
+            args.append(arg)
+
+    modes = [] if modes in (None, '0') else modes.split(',')
+    for mode in modes:
+        if mode not in PROFILE_MODES:
+            raise ValueError('profile mode {!r} is not one of {}'
+                             .format(mode, ', '.join(PROFILE_MODES)))
+
+    return modes, profile_file, args
+
+
+def profiled(main):
+    """
+    Decorator for a command line ``main()`` function that runs it under the
+    profilers selected by ``--profile`` or the ``CMD_STATES_PROFILE``
+    environment variable and writes a report when it finishes, including by
+    ``sys.exit()`` or an exception.
+
+    If ``main`` is called with an argument list (a list or tuple as its first
+    argument) the profile options are taken from that list and ``main`` gets
+    the rest of it.  Otherwise they are taken from ``sys.argv``.
+    """
+    params = list(inspect.signature(main).parameters)
+    args_name = params[0] if params else None
+
+    @functools.wraps(main)
+    def wrapper(*args, **kwargs):
+        args = list(args)
+        if args:
+            main_argv = args[0]
+        else:
+            main_argv = kwargs.get(args_name)
+        if not isinstance(main_argv, (list, tuple)):
+            main_argv = None
+
+        try:
+            modes, profile_file, argv = profile_args(
+                sys.argv[1:] if main_argv is None else main_argv)
+        except ValueError as err:
+            sys.exit('ERROR: {}'.format(err))
+        if main_argv is None:
+            sys.argv[1:] = argv
+        elif args:
+            args[0] = argv
+        else:
+            kwargs[args_name] = argv
+        if not modes:
+            return main(*args, **kwargs)
+
+        if profile_file is None:
+            prog = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+            profile_file = '{}.profile.txt'.format(prog or 'main')
+
+        prof = None
+        if 'tracemalloc' in modes:
+            import tracemalloc
+            tracemalloc.start()
+        if 'cprofile' in modes:
+            import cProfile
+            prof = cProfile.Profile()
+
+        wall0 = time.time()
+        if prof:
+            prof.enable()
+        try:
+            return main(*args, **kwargs)
+        finally:
+            if prof:
+                prof.disable()
+            write_profile_report(profile_file, modes, time.time() - wall0,
+                                 prof, argv=sys.argv[:1] + argv)
+
+    return wrapper
+
+
+def write_profile_report(profile_file, modes, wall, prof=None, argv=None):
+    """
+    Write the profile report for a run to ``profile_file``.  If tracemalloc is
+    tracing it is stopped after taking the memory snapshot.
+
+    :param profile_file: report file name
+    :param modes: list of profile modes
+    :param wall: wall clock time of the run (sec)
+    :param prof: cProfile.Profile object (optional)
+    :param argv: command line of the run (default=sys.argv)
+    """
+    if argv is None:
+        argv = sys.argv
+    with open(profile_file, 'w') as fh:
+        fh.write('# Profile of {} ({})\n'.format(' '.join(argv),
+                                                 ','.join(modes)))
+        fh.write('# Run at {}, wall time {:.3f} sec\n'
+                 .format(time.ctime(), wall))
+
+        if prof is not None:
+            import pstats
+            for sort in ('cumulative', 'tottime'):
+                fh.write('\n## Hot functions sorted by {}\n'.format(sort))
+                stats = pstats.Stats(prof, stream=fh)
+                stats.sort_stats(sort).print_stats(N_REPORT)
+            prof.dump_stats(profile_file + '.pstats')
+
+        import tracemalloc
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            fh.write('\n## Memory: current {:.1f} MB, peak {:.1f} MB\n'
+                     .format(current / 1e6, peak / 1e6))
+            fh.write('\n## Top {} allocation sites at end of run\n'
+                     .format(N_REPORT))
+            for stat in snapshot.statistics('lineno')[:N_REPORT]:
+                fh.write('{}\n'.format(stat))
+
+    logging.info('Wrote profile report to {}'.format(profile_file))
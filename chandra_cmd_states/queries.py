@@ -0,0 +1,198 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+SQL query builders for the commanded states database tables.
+
+Date range selections on ``cmd_states`` and ``cmds`` are done on the indexed
+numeric time columns (``tstart``, ``tstop`` and ``time``) instead of the
+``varchar(21)`` date columns.  The numeric bound is padded by ``TIME_PAD``
+seconds and the original date string comparison is kept as an exact filter,
+so the selected rows are identical to a pure date string query while the
+database can use a numeric index range scan.
+
+Databases made before these indexes existed can be migrated with
+:func:`chandra_cmd_states.migrations.add_time_indexes`.
+"""
+
+from Chandra.Time import DateTime
+
+# Padding (sec) of numeric time bounds.  Dates have 1 msec resolution so a
+# numeric bound padded by this much always includes the exact date match.
+TIME_PAD = 0.001
+
+# Numeric time column corresponding to each date column by table
+TIME_COLS = {'cmd_states': {'datestart': 'tstart',
+                            'datestop': 'tstop'},
+             'cmds': {'date': 'time'}}
+
+
+def date_where(table, date_col, op, date):
+    """
+    Make a WHERE clause term selecting ``date_col`` ``op`` ``date``.
+
+    If ``date_col`` has a numeric time column in ``table`` (see ``TIME_COLS``)
+    then the term also includes a padded comparison on that column that can
+    use its index.
+
+    :param table: table name
+    :param date_col: date column name (e.g. datestart, datestop, date)
+    :param op: comparison operator (<, <=, >, >=)
+    :param date: Chandra.Time compatible date
+
+    :returns: SQL clause string
+    """
+    date = DateTime(date)
+    term = "{} {} '{}'".format(date_col, op, date.date)
+    time_col = TIME_COLS.get(table, {}).get(date_col)
+    if time_col:
+        pad = -TIME_PAD if op.startswith('>') else TIME_PAD
+        term = '{} {} {:.4f} AND {}'.format(time_col, op, date.secs + pad,
+                                             term)
+    return term
+
+
+def _select(table, where, order_by=None, limit=None, dbi='sqlite'):
+    top = ''
+    if limit and dbi == 'sybase':
+        top = 'TOP {:d} '.format(limit)
+    query = 'SELECT {}* FROM {}'.format(top, table)
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+    if order_by:
+        query += ' ORDER BY ' + order_by
+    if limit and dbi != 'sybase':
+        query += ' LIMIT {:d}'.format(limit)
+    return query
+
+
+def cmd_states_overlap(start=None, stop=None):
+    """
+    Select cmd_states that overlap the interval from ``start`` to ``stop``,
+    i.e. datestop > start and datestart < stop, in time order.  States are
+    contiguous so ordering by tstop is the same as by datestart, and lets the
+    tstop index serve both the ``start`` bound and the ordering.
+
+    :param start: start date (default=no limit)
+    :param stop: stop date (default=no limit)
+
+    :returns: SQL query string
+    """
+    where = []
+    if start is not None:
+        where.append(date_where('cmd_states', 'datestop', '>', start))
+    if stop is not None:
+        where.append(date_where('cmd_states', 'datestart', '<', stop))
+    return _select('cmd_states', where, 'tstop')
+
+
+def state0(date, datepar='datestop', limit=1, dbi='sqlite'):
+    """
+    Select NPNT cmd_states with ``datepar`` before ``date``, most recent first.
+    With the default ``limit=1`` only the most recent state is returned and
+    the (pcad_mode, tstart|tstop) index makes this a single index seek.
+
+    :param date: date cutoff (None for no cutoff)
+    :param datepar: table parameter for select (datestop|datestart)
+    :param limit: maximum number of states (None for no limit)
+    :param dbi: database interface (sqlite|sybase)
+
+    :returns: SQL query string
+    """
+    where = ["pcad_mode = 'NPNT'"]
+    if date is not None:
+        where.append(date_where('cmd_states', datepar, '<', date))
+    order_by = TIME_COLS['cmd_states'][datepar] + ' DESC'
+    return _select('cmd_states', where, order_by, limit, dbi)
+
+
+def npnt_states(start, stop=None, datepar='datestop'):
+    """
+    Select NPNT cmd_states with ``start`` <= ``datepar`` < ``stop`` in time
+    order.
+
+    :param start: start date
+    :param stop: stop date (None for no limit)
+    :param datepar: table parameter for select (datestop|datestart)
+
+    :returns: SQL query string
+    """
+    where = ["pcad_mode = 'NPNT'",
+             date_where('cmd_states', datepar, '>=', start)]
+    if stop is not None:
+        where.append(date_where('cmd_states', datepar, '<', stop))
+    return _select('cmd_states', where, TIME_COLS['cmd_states'][datepar])
+
+
+def delete_cmd_states(datestart):
+    """
+    Delete cmd_states with datestart at or after ``datestart``.
+
+    :param datestart: date
+
+    :returns: SQL statement string
+    """
+    return ('DELETE FROM cmd_states WHERE '
+            + date_where('cmd_states', 'datestart', '>=', datestart))
+
+
+def nonload_cmds(start=None, stop=None):
+    """
+    Select non-load commands with ``start`` <= date <= ``stop``.
+
+    :param start: start date (default=no limit)
+    :param stop: stop date (default=no limit)
+
+    :returns: SQL query string
+    """
+    where = ['timeline_id IS NULL']
+    if start is not None:
+        where.append(date_where('cmds', 'date', '>=', start))
+    if stop is not None:
+        where.append(date_where('cmds', 'date', '<=', stop))
+    return _select('cmds', where)
+
+
+def recent_nonload_cmds(n_cmds=None, start=None, dbi='sqlite'):
+    """
+    Select the most recent non-load commands, newest first.
+
+    :param n_cmds: maximum number of commands (None or 0 for no limit)
+    :param start: only select commands at or after this date (default=None)
+    :param dbi: database interface (sqlite|sybase)
+
+    :returns: SQL query string
+    """
+    where = ['timeline_id IS NULL']
+    if start is not None:
+        where.append(date_where('cmds', 'date', '>=', start))
+    return _select('cmds', where, 'time DESC', n_cmds, dbi)
+
+
+def timeline_cmds(timeline_id):
+    """
+    Select the commands for timeline ``timeline_id``.
+
+    :param timeline_id: timeline id
+
+    :returns: SQL query string
+    """
+    return _select('cmds', ['timeline_id = {:d}'.format(timeline_id)])
+
+
+def timeline_loads(datestop, datestart=None, observing_only=False):
+    """
+    Select timeline_loads with datestop > ``datestop``.  The timelines table
+    has indexes on the datestart and datestop date columns.
+
+    :param datestop: date
+    :param datestart: also require datestart <= this date (default=None)
+    :param observing_only: only select 'observing' slots (scs > 130)
+
+    :returns: SQL query string
+    """
+    where = [date_where('timeline_loads', 'datestop', '>', datestop)]
+    if datestart is not None:
+        where.append(date_where('timeline_loads', 'datestart', '<=',
+                                datestart))
+    if observing_only:
+        where.append('scs > 130')
+    return _select('timeline_loads', where)
@@ -0,0 +1,456 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Frozen reference implementations of the state generation engine.
+
+The functions here are copies of :func:`~chandra_cmd_states.get_states`,
+:func:`~chandra_cmd_states.reduce_states` and
+:func:`~chandra_cmd_states.update_cmd_states.get_states_i_diff` (and the
+helpers they rely on) as they were before the state generation was
+optimized, without the debug logging.  They define the expected output for
+the equivalence harness (:mod:`chandra_cmd_states.equivalence`).
+
+This module is self-contained on purpose: it does not import anything from
+:mod:`chandra_cmd_states.cmd_states`, so a change to the engine, its command
+table or its constants cannot change the reference too.  Like the original
+code, :func:`get_states` takes a list of command dicts (which it extends and
+sorts in place); use :func:`chandra_cmd_states.equivalence.reference_states`
+to run it on a command table.
+
+Do not optimize or otherwise change these functions.  A change in the
+behavior of the state generation engine must be made in the engine and then
+deliberately copied here once the new output has been validated.
+"""
+
+import re
+from itertools import count
+
+import numpy as np
+from six.moves import range
+
+from Chandra.Time import DateTime
+
+
+def decode_power(mnem):
+    """
+    Decode number of chips and feps from a ACIS power command
+    Return a dictionary with the number of chips and their identifiers
+
+    Example:
+
+    >>> decode_power("WSPOW08F3E")
+    {'ccd_count': 5,
+     'ccds': 'I0 I1 I2 I3 S3 ',
+     'clocking': 0,
+     'fep_count': 5,
+     'feps': '1 2 3 4 5 ',
+     'vid_board': 1}
+
+    :param mnem: power command string
+
+    """
+    fep_info = {'fep_count': 0,
+                'ccd_count': 0,
+                'feps': '',
+                'ccds': '',
+                'vid_board': 1,
+                'clocking': 0}
+
+    # Special case WSPOW000XX to turn off vid_board
+    if mnem.startswith('WSPOW000'):
+        fep_info['vid_board'] = 0
+
+    # the hex for the commanding is after the WSPOW
+    powstr = mnem[5:]
+    if (len(powstr) != 5):
+        raise ValueError("%s in unexpected format" % mnem)
+
+    # convert the hex to decimal and "&" it with 63 (binary 111111)
+    fepkey = int(powstr, 16) & 63
+    # count the true binary bits
+    for bit in range(0, 6):
+        if (fepkey & (1 << bit)):
+            fep_info['fep_count'] = fep_info['fep_count'] + 1
+            fep_info['feps'] = fep_info['feps'] + str(bit) + ' '
+
+    # convert the hex to decimal and right shift by 8 places
+    vidkey = int(powstr, 16) >> 8
+
+    # count the true bits
+    for bit in range(0, 10):
+        if (vidkey & (1 << bit)):
+            fep_info['ccd_count'] = fep_info['ccd_count'] + 1
+            # position indicates I or S chip
+            if (bit < 4):
+                fep_info['ccds'] = fep_info['ccds'] + 'I' + str(bit) + ' '
+            else:
+                fep_info['ccds'] = fep_info['ccds'] + 'S' + str(bit - 4) + ' '
+
+    return fep_info
+
+
+def _make_add_trans(transitions, date, exclude):
+    def add_trans(date=date, **kwargs):
+        # If no key in kwargs is in the exclude set then update transition
+        # And, when doing any update, update a bookkeeping key 'last_date'
+        # that stores the latest date of any processed cmd/transition.
+        # This is used to prevent overlap between the GET_PITCH mocked
+        # up cmds and the inserted/mock maneuver cmds.  If any one of the
+        # equally-spaced GET_PITCH cmds occurs during a maneuver, the GET_PITCH
+        # will be ignored in processing because the maneuver cmd insertion
+        # through the maneuver time range will have updated last_date to
+        # a time later than that GET_PITCH command.
+        if not (exclude and set(exclude).intersection(kwargs)):
+            transitions.setdefault(date, {}).update(kwargs)
+            # Only update 'last_date' if the supplied date to _make_add_trans
+            # is actually later than the stored 'last_date' in the structure
+            if date > transitions['last_date']:
+                transitions['last_date'] = date
+    return add_trans
+
+
+def _make_pitch_cmds(datestart, datestop, sample_time=10000.):
+    """
+    Make cmds to break states into smaller states to sample pitch
+
+    """
+    # np.floor is used here to get 'times' at even increments of "sample_time"
+    # so that the commands will be at the same times in an interval even
+    # if a different time range is being updated.
+    tstart = np.floor(DateTime(datestart).secs / sample_time) * sample_time
+    tstop = DateTime(datestop).secs
+    times = np.arange(tstart, tstop, sample_time)
+    out = [{'cmd': 'GET_PITCH',
+            'tlmsid': 'GET_PITCH',
+            'date': DateTime(t).date}
+            for t in times]
+    return out
+
+
+def get_states(state0, cmds, exclude=None):
+    """Get states resulting from the spacecraft commands ``cmds`` starting
+    from an initial ``state0``.
+
+    State keys in the ``exclude`` list or set will be excluded from causing a
+    transition.  This is useful if a state parameter (e.g. simfa_pos) is not of
+    interest.  An excluding parameter will have incorrect values in the
+    returned states.
+
+    A state is a dict with key values corresponding to the following database
+    schema:
+
+    ============   =========   ====
+    Name           Type        Size
+    ============   =========   ====
+     datestart     varchar      21
+     datestop      varchar      21
+     obsid         int           4
+     power_cmd     varchar      11
+     si_mode       varchar       8
+     pcad_mode     varchar       6
+     vid_board     bit           1
+     clocking      bit           1
+     fep_count     int           4
+     ccd_count     int           4
+     simpos        int           4
+     simfa_pos     int           4
+     pitch         float         8
+     ra            float         8
+     dec           float         8
+     roll          float         8
+     q1            float         8
+     q2            float         8
+     q3            float         8
+     q4            float         8
+     trans_keys    varchar      60
+     letg          varchar       4
+     hetg          varchar       4
+     dither        varchar       4
+    ============   =========   ====
+
+    The input commands must be a list of dicts including keys ``date, vcdu,
+    cmd, params, time``.  See also Ska.ParseCM.read_backstop().
+
+    :param state0: initial state.
+    :param cmds: list of commands
+    :param ignore: list or set of state keys to ignore
+
+    :returns: recarray of states starting with state0 (which might be modified)
+    """
+    import Chandra.Maneuver
+    from Quaternion import Quat
+    import Ska.Sun
+
+
+    curr_att = [state0[x] for x in ('q1', 'q2', 'q3', 'q4')]
+
+    # Add extra mocked-up cmds to sample pitch
+    pitch_cmds = _make_pitch_cmds(state0['datestart'], cmds[-1]['date'])
+    cmds.extend(pitch_cmds)
+    cmds.sort(key=lambda y: y['date'])
+
+    # A transition is a dictionary of state updates occuring at one time, e.g.
+    # {'simpos': -99616, 'pcad_mode': 'NMAN'}. The transition dicts are
+    # collected 'transitions' dict and keyed by cmd date.  In this way multiple
+    # commands at the same time can easily be accumulated to a single
+    # transition.  Also use the dictionary to store a value for the
+    # last transition date.
+    transitions = {'last_date': cmds[0]['date']}
+
+    cmds_after_state0 = [x for x in cmds if x['date'] > state0['datestart']]
+
+    for cmd in cmds_after_state0:
+        params = cmd.get('params', {})
+        # Following two might not be in cmd
+        tlmsid = cmd['tlmsid'] or params.get('TLMSID', '')
+        cmd_type = cmd['cmd']
+        date = cmd['date']
+
+        # Make a convenience function to add to transitions at command date
+        add_trans = _make_add_trans(transitions, date, exclude)
+
+        # Obsid
+        if cmd_type == 'MP_OBSID':
+            add_trans(obsid=params['ID'])
+
+        # Mocked-up cmds to sample pitch
+        elif cmd_type == 'GET_PITCH':
+            # If we have made transitions with dates after
+            # this mock command (maneuver transitions),
+            # skip the 'GET_PITCH'
+            if cmd['date'] < transitions['last_date']:
+                continue
+            q_att = Quat(curr_att)
+            # add pitch/attitude commands
+            pitch = Ska.Sun.pitch(q_att.ra, q_att.dec, date)
+            add_trans(pitch=pitch)
+
+        # SIM Z
+        elif cmd_type == 'SIMTRANS':
+            add_trans(simpos=params['POS'])
+
+        # SIM focus
+        elif cmd_type == 'SIMFOCUS':
+            add_trans(simfa_pos=params['POS'])
+
+        # ACIS power command section
+        elif cmd_type == 'ACISPKT':
+            if tlmsid.startswith('WSPOW'):
+                pwr = decode_power(tlmsid)
+                add_trans(fep_count=pwr['fep_count'],
+                          ccd_count=pwr['ccd_count'],
+                          vid_board=pwr['vid_board'],
+                          clocking=pwr['clocking'],
+                          power_cmd=tlmsid)
+
+            elif re.match(r'X(T|C)Z0000005', tlmsid):
+                add_trans(clocking=1, power_cmd=tlmsid)
+
+            elif tlmsid == 'WSVIDALLDN':
+                add_trans(vid_board=0, ccd_count=0,
+                          power_cmd=tlmsid)
+
+            elif tlmsid == 'AA00000000':
+                add_trans(clocking=0, power_cmd=tlmsid)
+
+            elif tlmsid == 'WSFEPALLUP':
+                add_trans(fep_count=6, power_cmd=tlmsid)
+
+            elif tlmsid.startswith('WC'):
+                add_trans(si_mode='CC_' + tlmsid[2:7])
+
+            elif tlmsid.startswith('WT'):
+                add_trans(si_mode='TE_' + tlmsid[2:7])
+
+        # Set the target attitude
+        elif cmd_type == 'MP_TARGQUAT':
+            targ_att = [params[x] for x in ('Q1', 'Q2', 'Q3', 'Q4')]
+
+        # Specify auto transition to NPNT with star acq after maneuver
+        elif cmd_type == 'COMMAND_SW' and re.match('AONM2NP(E|D)', tlmsid):
+            auto_npnt = (tlmsid == 'AONM2NPE')
+
+        # Transition to NMM
+        elif cmd_type == 'COMMAND_SW' and tlmsid == 'AONMMODE':
+            add_trans(pcad_mode='NMAN')
+
+        # Transition to NPM
+        elif cmd_type == 'COMMAND_SW' and tlmsid == 'AONPMODE':
+            add_trans(pcad_mode='NPNT')
+
+        # Transition to HETG inserted
+        elif cmd_type == 'COMMAND_SW' and tlmsid == '4OHETGIN':
+            add_trans(hetg='INSR')
+
+        # Transition to HETG retracted
+        elif cmd_type == 'COMMAND_SW' and tlmsid == '4OHETGRE':
+            add_trans(hetg='RETR')
+
+        # Transition to LETG inserted
+        elif cmd_type == 'COMMAND_SW' and tlmsid == '4OLETGIN':
+            add_trans(letg='INSR')
+
+        # Transition to LETG retracted
+        elif cmd_type == 'COMMAND_SW' and tlmsid == '4OLETGRE':
+            add_trans(letg='RETR')
+
+        elif cmd_type == 'COMMAND_SW' and tlmsid == 'AOENDITH':
+            add_trans(dither='ENAB')
+
+        elif cmd_type == 'COMMAND_SW' and tlmsid == 'AODSDITH':
+            add_trans(dither='DISA')
+
+        # Start a maneuver to targ_att or else to normal sun pointed attitude
+        # via normal sun mode
+        elif cmd_type == 'COMMAND_SW' and tlmsid in ('AOMANUVR', 'AONSMSAF'):
+            if tlmsid == 'AONSMSAF':
+                add_trans(pcad_mode='NSUN')
+                targ_att = Chandra.Maneuver.NSM_attitude(curr_att, cmd['time'])
+                auto_npnt = False
+
+            # add pitch/attitude commands
+            atts = Chandra.Maneuver.attitudes(curr_att, targ_att,
+                                              tstart=cmd['time'])
+            pitches = np.hstack([(atts[:-1].pitch + atts[1:].pitch) / 2,
+                                 atts[-1].pitch])
+            for att, pitch in zip(atts, pitches):
+                q_att = Quat([att[x] for x in ('q1', 'q2', 'q3', 'q4')])
+                add_trans(date=DateTime(att.time).date,
+                          pitch=pitch,
+                          q1=att.q1, q2=att.q2, q3=att.q3, q4=att.q4,
+                          ra=q_att.ra, dec=q_att.dec, roll=q_att.roll)
+            # If auto-transition to NPM after manvr is enabled (this is
+            # normally the case) then back to NPNT at end of maneuver
+            if auto_npnt:
+                add_trans(date=DateTime(atts[-1].time).date, pcad_mode='NPNT')
+
+            # update the current attitude to the target attitude
+            curr_att = targ_att
+
+    # Delete the last_date bookkeeping key
+    # It is no longer needed and would break the following loop
+    # over sorted(transitions)
+    del transitions['last_date']
+
+    # Make the states from state0 and the final dict of transitions
+    states = [state0]
+    for datekey in sorted(transitions):
+        new_state = states[-1].copy()
+        new_state['datestart'] = datekey
+        new_state.update(transitions[datekey])
+        new_state['trans_keys'] = ','.join(sorted(transitions[datekey]))
+        states.append(new_state)
+
+    # Set datestop values to be the datestart of the next state.  Last state
+    # is given a datestop far in the future
+    states[-1]['datestop'] = '2099:001:00:00:00.000'
+    for state_i0, state_i1 in zip(states[:-1], states[1:]):
+        state_i0['datestop'] = state_i1['datestart']
+
+    for state in states:
+        state['tstart'] = DateTime(state['datestart']).secs
+        state['tstop'] = DateTime(state['datestop']).secs
+
+    statecols = sorted(states[0])
+    staterecs = [tuple(row[col] for col in statecols) for row in states]
+
+    return np.rec.fromrecords(staterecs, names=statecols)
+
+
+def reduce_states(states, cols, allow_identical=True):
+    """
+    Reduce the input ``states`` so that only transitions in the ``cols``
+    columns are noticed.
+
+    :param states: numpy recarray of states
+    :param cols: notice transitions in this list of columns
+    :param allow_identical: allow null transitions between apparently identical states
+
+    :returns: numpy recarray of reduced states
+    """
+    cols = set(cols)
+
+    # Boolean func for when at least one state transition key is among the
+    # supplied cols Transition keys are are the values that changed between
+    # previous and current state
+    trans_in_cols = lambda state: bool(cols.intersection(state['trans_keys']
+                                                         .split(',')))
+
+    # Generate the transition markers
+    transitions = np.array([trans_in_cols(state) for state in states])
+    transitions[0] = True
+
+    if not allow_identical:
+        i_transitions = np.flatnonzero(transitions)
+        no_trans = []
+        for i in i_transitions[1:]:  # Skip the first one which is index=0
+            state0 = states[i - 1]
+            state1 = states[i]
+            trans_keys = state1['trans_keys'].split(',')
+            if all(state0[key] == state1[key] for key in trans_keys):
+                no_trans.append(i)
+        transitions[no_trans] = False
+
+    newstates = states[transitions].copy()
+    newstates['datestop'][:-1] = newstates['datestart'][1:]
+    newstates['tstop'][:-1] = newstates['tstart'][1:]
+    newstates['datestop'][-1] = states['datestop'][-1]
+    newstates['tstop'][-1] = states['tstop'][-1]
+
+    return newstates
+
+
+def get_states_i_diff(db_states, states):
+    """Get the index position where db_states and states differ.
+
+    If the states are identical then None is returned.
+
+    :param db_states: states in database
+    :param states: new reference states
+    :returns: i_diff
+    """
+    import Ska.Sun
+
+    # Get states columns that are not float type. descr gives list of
+    # (colname, type_descr)
+    match_cols = [x[0] for x in states.dtype.descr if 'f' not in x[1]]
+
+    # Find mismatches: direct compare or where pitch or attitude differs by
+    # > 1 arcsec
+    for i_diff, db_state, state in zip(count(), db_states, states):
+        mismatches = set(x for x in match_cols if db_state[x] != state[x])
+        if abs(db_state.pitch - state.pitch) > 0.0003:
+            mismatches.add('pitch')
+        if Ska.Sun.sph_dist(db_state.ra, db_state.dec,
+                            state.ra, state.dec) > 0.0003:
+            mismatches.add('attitude')
+        if mismatches:
+            # Case 1: direct mismatch in states
+            break
+    else:
+        # At this point the for loop finished with no detected diffs.
+        # Now i_diff = min(len(db_states), len(states)) - 1.
+
+        if len(states) == len(db_states):
+            # Case 2: made it with no mismatches and the number of states
+            # match so no action is required.
+            return None  # No states changed
+
+        # Otherwise there is an indirect mismatch in states because one
+        # table has a valid state row where the other table has no row
+        # (i.e. the table ends).  There are two more cases here:
+        #
+        # Case 3. The typical case is when len(db_states) > len(states):
+        #   * Every db_state is in states but states was extended by adding
+        #     new timeline load segments due to new weekly products.
+        #
+        # Case 4. Less common case is when len(states) < len(db_states):
+        #   * db_states needs to be shortened to delete states, probably
+        #     due to a load interrupt like NSM or safemode (but not SCS107)
+        #
+        # Now increment i_diff by one to point at the position of the
+        # "mismatch", between an existing state and a null state beyond the
+        # end of available states.
+
+        i_diff += 1
+
+    return i_diff
@@ -0,0 +1,250 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Repack the HDF5 cmd_states file.
+
+Years of updates leave dead space from removed rows (or superseded rows of
+the versioned layout) in ``cmd_states.h5``, and its chunk layout and
+compression were fixed when the table was first made.  :func:`repack`
+writes a new file with only the live states, the chosen compressor, level
+and chunkshape and a completely sorted index on tstart.  It then checks the
+new file against the old one and renames it into place, so readers see
+either the old or the new file and never a partial one.  The file size and
+read throughput are measured before and after.
+
+While repacking it holds the same writer lock as ``update_cmd_states`` (see
+:class:`~chandra_cmd_states.h5store.WriterLock`), so an update waits for the
+repack to finish and vice versa.
+"""
+
+import os
+import sys
+import time
+import logging
+
+import numpy as np
+import tables
+
+from . import h5store
+from .metrics import Metrics
+from .profiling import profiled, PROFILE_HELP
+
+# Numbers of reads for the throughput measurement (best time is used)
+N_READS = 3
+
+
+def _open_file(filename, mode='r', **kwargs):
+    tables_open_file = getattr(tables, 'open_file', None) or tables.openFile
+    return tables_open_file(filename, mode=mode, **kwargs)
+
+
+def get_filters(complib='zlib', complevel=5):
+    """
+    Get the HDF5 filters for compression library ``complib`` (e.g. zlib,
+    blosc:lz4, blosc:zstd) and level ``complevel``.
+
+    :param complib: compression library
+    :param complevel: compression level (0-9)
+    :returns: tables.Filters object
+    """
+    if tables.which_lib_version(complib.split(':')[0]) is None:
+        raise ValueError('compression library {} is not available'
+                         .format(complib))
+    return tables.Filters(complevel=complevel, complib=complib, shuffle=True)
+
+
+def measure_h5(filename, n_reads=N_READS):
+    """
+    Get the size, layout and read throughput of the HDF5 cmd_states file
+    ``filename``.  Throughput is for reading the whole table and the tstart
+    column, best of ``n_reads`` (so mostly from the OS page cache).
+
+    :param filename: HDF5 cmd_states file name
+    :param n_reads: number of reads to time
+    :returns: dict of measurements
+    """
+    with _open_file(filename) as h5:
+        h5d = h5.root.data
+        filters = h5d.filters
+        out = {'size_mb': os.path.getsize(filename) / 1e6,
+               'rows': h5d.nrows,
+               'live_rows': len(h5store.live_rows(h5)),
+               'chunkshape': h5d.chunkshape[0],
+               'compression': '{}({})'.format(filters.complib,
+                                              filters.complevel),
+               'tstart_index': h5store.is_indexed(h5d)}
+        data_mb = h5d.nrows * h5d.rowsize / 1e6
+        for name, read in (('table', h5d.read),
+                           ('tstart', lambda: h5d.col('tstart'))):
+            times = []
+            for _ in range(n_reads):
+                t0 = time.time()
+                read()
+                times.append(time.time() - t0)
+            out['read_{}_sec'.format(name)] = min(times)
+        out['read_table_mb_per_sec'] = data_mb / max(out['read_table_sec'],
+                                                     1e-9)
+    return out
+
+
+def repack(filename, output=None, complib='zlib', complevel=5,
+           chunkshape=None, index=True, versioned=None):
+    """
+    Repack the HDF5 cmd_states file ``filename``.
+
+    :param filename: HDF5 cmd_states file name
+    :param output: write the repacked file here instead of replacing
+                   ``filename`` (default=None)
+    :param complib: compression library (e.g. zlib, blosc:lz4)
+    :param complevel: compression level (0-9)
+    :param chunkshape: rows per HDF5 chunk (default=PyTables choice)
+    :param index: create a completely sorted index on tstart
+    :param versioned: layout of the new file (default=current layout)
+    :returns: (measurements before, measurements after)
+    """
+    filters = get_filters(complib, complevel)
+    with h5store.WriterLock(filename):
+        before = measure_h5(filename)
+        new_filename = output or filename + '.repack'
+
+        with _open_file(filename) as h5:
+            if versioned is None:
+                versioned = h5store.is_versioned(h5)
+            rows = h5store.read_rows(h5.root.data, h5store.live_rows(h5))
+        logging.info('Writing {} states to {} with {}({}) compression'
+                     .format(len(rows), new_filename, complib, complevel))
+        with _open_file(new_filename, mode='w') as h5:
+            h5store.create_tables(h5, rows, versioned=versioned,
+                                  expectedrows=max(2 * len(rows), 5e5),
+                                  filters=filters, chunkshape=chunkshape,
+                                  index=index)
+
+        # Check the new file before it replaces the old one
+        with _open_file(new_filename) as h5:
+            new_rows = h5store.read_rows(h5.root.data, h5store.live_rows(h5))
+        if not np.array_equal(new_rows, rows):
+            os.remove(new_filename)
+            raise ValueError('repacked states in {} do not match {}'
+                             .format(new_filename, filename))
+
+        with open(new_filename, 'rb') as fh:
+            os.fsync(fh.fileno())
+        after = measure_h5(new_filename)
+        if output is None:
+            os.replace(new_filename, filename)
+            logging.info('Replaced {} with repacked file'.format(filename))
+
+    return before, after
+
+
+def format_report(before, after):
+    """
+    Format the measurements ``before`` and ``after`` repacking as a table.
+
+    :returns: list of lines
+    """
+    rows = (('size (MB)', 'size_mb', '{:.2f}'),
+            ('rows', 'rows', '{}'),
+            ('live rows', 'live_rows', '{}'),
+            ('chunkshape', 'chunkshape', '{}'),
+            ('compression', 'compression', '{}'),
+            ('tstart index', 'tstart_index', '{}'),
+            ('read table (s)', 'read_table_sec', '{:.4f}'),
+            ('read table (MB/s)', 'read_table_mb_per_sec', '{:.1f}'),
+            ('read tstart (s)', 'read_tstart_sec', '{:.4f}'))
+    lines = ['{:20s} {:>14s} {:>14s}'.format('', 'before', 'after')]
+    for label, key, fmt in rows:
+        lines.append('{:20s} {:>14s} {:>14s}'.format(
+            label, fmt.format(before[key]), fmt.format(after[key])))
+    return lines
+
+
+def get_options(args=None):
+    """Get options for the repack_cmd_states command line interface.
+
+    :param args: list of command line arguments (default=sys.argv[1:])
+    """
+    from optparse import OptionParser
+    parser = OptionParser(epilog=PROFILE_HELP)
+    parser.add_option("--h5file",
+                      default='cmd_states.h5',
+                      help="HDF5 cmd_states file to repack")
+    parser.add_option("--output",
+                      help="Write the repacked file here instead of replacing "
+                      "h5file")
+    parser.add_option("--complib",
+                      default='zlib',
+                      help="Compression library, e.g. zlib, blosc:lz4, "
+                      "blosc:zstd (default=zlib)")
+    parser.add_option("--complevel",
+                      type='int',
+                      default=5,
+                      help="Compression level 0-9 (default=5)")
+    parser.add_option("--chunkshape",
+                      type='int',
+                      help="Rows per HDF5 chunk (default=PyTables choice)")
+    parser.add_option("--no-index",
+                      action="store_true",
+                      help="Do not create a completely sorted index on "
+                      "tstart")
+    parser.add_option("--layout",
+                      choices=['flat', 'versioned'],
+                      help="Layout of the repacked table (flat|versioned, "
+                      "default=current layout)")
+    parser.add_option("--metrics-file",
+                      help="Write the before and after measurements to this "
+                      "file, as a Prometheus textfile if the name ends with "
+                      ".prom and JSON otherwise (default=None)")
+    parser.add_option("--loglevel",
+                      type='int',
+                      default=20,
+                      help='Log level (10=debug, 20=info, 30=warnings)')
+    return parser.parse_args(args)
+
+
+@profiled
+def main():
+    """
+    Command line interface to repack the HDF5 cmd_states file.
+
+    Usage: repack_cmd_states.py [options]::
+
+      Options:
+        -h, --help            show this help message and exit
+        --h5file=H5FILE       HDF5 cmd_states file to repack
+        --output=OUTPUT       Write the repacked file here instead of
+                              replacing h5file
+        --complib=COMPLIB     Compression library, e.g. zlib, blosc:lz4,
+                              blosc:zstd (default=zlib)
+        --complevel=COMPLEVEL
+                              Compression level 0-9 (default=5)
+        --chunkshape=CHUNKSHAPE
+                              Rows per HDF5 chunk (default=PyTables choice)
+        --no-index            Do not create a completely sorted index on
+                              tstart
+        --layout=LAYOUT       Layout of the repacked table (flat|versioned,
+                              default=current layout)
+        --metrics-file=FILE   Write the before and after measurements to
+                              FILE, as a Prometheus textfile if the name
+                              ends with .prom and JSON otherwise
+        --loglevel=LOGLEVEL   Log level (10=debug, 20=info, 30=warnings)
+    """
+    opt, args = get_options()
+    logging.basicConfig(level=opt.loglevel,
+                        format='%(message)s',
+                        stream=sys.stdout)
+
+    versioned = None if opt.layout is None else opt.layout == 'versioned'
+    before, after = repack(opt.h5file, output=opt.output,
+                           complib=opt.complib, complevel=opt.complevel,
+                           chunkshape=opt.chunkshape, index=not opt.no_index,
+                           versioned=versioned)
+    for line in format_report(before, after):
+        logging.info(line)
+
+    if opt.metrics_file:
+        metrics = Metrics(prefix='cmd_states_repack')
+        for label, vals in (('before', before), ('after', after)):
+            for key, val in vals.items():
+                if not isinstance(val, str):
+                    metrics.set('{}.{}'.format(label, key), float(val))
+        metrics.write(opt.metrics_file)
@@ -0,0 +1,239 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Year-sharded layout of the HDF5 cmd_states table.
+
+Instead of a single ``cmd_states.h5`` the states are kept in a directory
+with one flat HDF5 cmd_states file per year (by state datestart) and a small
+``manifest.json`` listing the shard files with their time range, number of
+rows and size::
+
+  {"version": 1,
+   "generation": 12,
+   "updated": "2026-10-19T06:12:01",
+   "shards": [{"year": 2002, "file": "cmd_states_2002_0.h5",
+               "datestart": ..., "datestop": ..., "tstart": ..., "tstop": ...,
+               "rows": 3950, "size": 310622},
+              ...]}
+
+A shard file name includes the generation of the update that wrote it and
+is never changed afterwards.  An update writes new files only for the shards
+whose states changed (normally just the current year), then atomically
+replaces the manifest.  Files that are in neither the new nor the previous
+manifest are deleted, so a reader that has just read the previous manifest
+can still open its shards.  Backups, rsync and caches only need to handle the
+new files.
+
+Readers in ``get_cmd_states`` accept the shard directory (or its manifest)
+as the HDF5 server and only open the shards that overlap the requested time
+range.
+"""
+
+import os
+import re
+import json
+import time
+
+import numpy as np
+
+from . import h5store
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+SHARD_FILE_RE = re.compile(r'cmd_states_\d{4}_\d+\.h5$')
+
+
+def get_shard_dir(path):
+    """
+    Get the shard directory for ``path`` (a shard directory or its manifest
+    file), or None if ``path`` is not a sharded cmd_states store.
+
+    :param path: file or directory name
+    :returns: directory name or None
+    """
+    if path is None:
+        return None
+    if os.path.isdir(path):
+        return path
+    if os.path.basename(path) == MANIFEST_NAME:
+        return os.path.dirname(path) or '.'
+    return None
+
+
+def read_manifest(shard_dir):
+    """
+    Read the manifest of the shards in ``shard_dir``.
+
+    :param shard_dir: shard directory
+    :returns: manifest dict or None if there is no manifest
+    """
+    filename = os.path.join(shard_dir, MANIFEST_NAME)
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as fh:
+        manifest = json.load(fh)
+    if manifest['version'] != MANIFEST_VERSION:
+        raise ValueError('unexpected version {} of manifest {}'
+                         .format(manifest['version'], filename))
+    return manifest
+
+
+def _fsync(filename):
+    with open(filename, 'rb') as fh:
+        os.fsync(fh.fileno())
+
+
+def write_manifest(shard_dir, manifest):
+    """
+    Write ``manifest`` to ``shard_dir`` via a temporary file so readers never
+    see a partial file.
+
+    :param shard_dir: shard directory
+    :param manifest: manifest dict
+    """
+    filename = os.path.join(shard_dir, MANIFEST_NAME)
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as fh:
+        json.dump(manifest, fh, indent=1)
+        fh.write('\n')
+    _fsync(tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+def get_shards(shard_dir, datestart=None, datestop=None):
+    """
+    Get the shards in ``shard_dir`` with states overlapping ``datestart`` to
+    ``datestop``, in time order.  This is the same selection as the
+    ``datestop > datestart & datestart < datestop`` query of the readers.
+
+    :param shard_dir: shard directory
+    :param datestart: start date (default=first state)
+    :param datestop: stop date (default=last state)
+    :returns: list of manifest shard dicts with the full ``filename`` added
+    """
+    manifest = read_manifest(shard_dir)
+    if manifest is None:
+        raise IOError('no cmd_states shard manifest in {}'.format(shard_dir))
+    shards = []
+    for shard in manifest['shards']:
+        if ((datestart is None or shard['datestop'] > datestart)
+                and (datestop is None or shard['datestart'] < datestop)):
+            shard = dict(shard)
+            shard['filename'] = os.path.join(shard_dir, shard['file'])
+            shards.append(shard)
+    return shards
+
+
+def _open_file(filename, mode='r', **kwargs):
+    import tables
+
+    tables_open_file = getattr(tables, 'open_file', None) or tables.openFile
+    return tables_open_file(filename, mode=mode, **kwargs)
+
+
+def _read_shard(filename):
+    with _open_file(filename) as h5:
+        return h5store.read_rows(h5.root.data, h5store.live_rows(h5))
+
+
+def read_states(shard_dir, manifest, year0=0):
+    """
+    Read the states of the shards for ``year0`` and later.
+
+    :param shard_dir: shard directory
+    :param manifest: manifest dict
+    :param year0: first year
+    :returns: dict of states structured arrays by year
+    """
+    return dict((shard['year'],
+                 _read_shard(os.path.join(shard_dir, shard['file'])))
+                for shard in manifest['shards'] if shard['year'] >= year0)
+
+
+def _write_shard(filename, rows, filters=None):
+    tmp_filename = filename + '.tmp'
+    with _open_file(tmp_filename, mode='w') as h5:
+        h5store.create_tables(h5, rows, expectedrows=max(len(rows), 1000),
+                              filters=filters)
+    _fsync(tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+def write_shards(shard_dir, rows, year0=0, manifest=None, filters=None):
+    """
+    Replace the shards for ``year0`` and later in ``shard_dir`` with the
+    states ``rows``, writing new files only for years whose states changed,
+    and publish them in a new manifest.
+
+    If ``rows`` start before ``year0`` (e.g. an update that reaches back
+    before the shards it was given) the rewrite starts at the shard of the
+    first row instead, keeping the states of that shard before the first
+    row.
+
+    :param shard_dir: shard directory
+    :param rows: states with the HDF5 table dtype, in time order
+    :param year0: first replaced year
+    :param manifest: current manifest (default=None for a new store)
+    :param filters: tables.Filters for new shard files (default=zlib 5)
+    :returns: new manifest dict
+    """
+    if filters is None:
+        import tables
+        filters = tables.Filters(complevel=5, complib='zlib')
+    if manifest is None:
+        manifest = {'version': MANIFEST_VERSION, 'generation': -1,
+                    'shards': []}
+    years = np.array([int(date[:4]) for date in rows['datestart']],
+                     dtype=int)
+    if np.any(np.diff(years) < 0):
+        raise ValueError('states for shards must be in time order')
+    clamped = len(years) > 0 and years[0] < year0
+    if clamped:
+        year0 = int(years[0])
+
+    old_states = read_states(shard_dir, manifest, year0)
+    old_shards = dict((shard['year'], shard) for shard in manifest['shards'])
+    generation = manifest['generation'] + 1
+
+    if clamped and year0 in old_states:
+        old_rows = old_states[year0]
+        old_rows = old_rows[old_rows['datestart'] < rows['datestart'][0]]
+        rows = np.concatenate([old_rows, rows])
+        years = np.concatenate([np.full(len(old_rows), year0, dtype=int),
+                                years])
+
+    shards = [shard for shard in manifest['shards'] if shard['year'] < year0]
+    for year in np.unique(years).tolist():
+        year_rows = rows[years == year]
+        old_rows = old_states.get(year)
+        if old_rows is not None and np.array_equal(old_rows, year_rows):
+            shards.append(old_shards[year])
+            continue
+        name = 'cmd_states_{}_{}.h5'.format(year, generation)
+        filename = os.path.join(shard_dir, name)
+        _write_shard(filename, year_rows, filters)
+        shards.append({'year': year,
+                       'file': name,
+                       'datestart': _as_str(year_rows['datestart'][0]),
+                       'datestop': _as_str(year_rows['datestop'][-1]),
+                       'tstart': float(year_rows['tstart'][0]),
+                       'tstop': float(year_rows['tstop'][-1]),
+                       'rows': len(year_rows),
+                       'size': os.path.getsize(filename)})
+
+    new_manifest = {'version': MANIFEST_VERSION,
+                    'generation': generation,
+                    'updated': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'shards': shards}
+    write_manifest(shard_dir, new_manifest)
+
+    # Keep the files of the previous manifest for readers that just read it
+    keep = set(shard['file'] for shard in manifest['shards'] + shards)
+    for name in os.listdir(shard_dir):
+        if SHARD_FILE_RE.match(name) and name not in keep:
+            os.remove(os.path.join(shard_dir, name))
+
+    return new_manifest
+
+
+def _as_str(val):
+    return val.decode('ascii') if isinstance(val, bytes) else str(val)
@@ -0,0 +1,32 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import os
+import sqlite3
+
+import pytest
+
+# Table definitions are in the top level of the source repository
+SQL_DIR = os.path.join(os.path.dirname(__file__), '..', '..')
+SQL_TABLES = ('cmd_states', 'cmds', 'cmd_intpars', 'cmd_fltpars',
+              'load_segments', 'timelines', 'timeline_loads')
+HAS_SQL_DEFS = all(os.path.exists(os.path.join(SQL_DIR, table + '_def.sql'))
+                   for table in SQL_TABLES)
+
+
+@pytest.fixture
+def cmd_db(tmpdir):
+    """Empty sqlite commanded states database made from the *_def.sql files.
+    """
+    if not HAS_SQL_DEFS:
+        pytest.skip('Needs table definition files from source repository')
+    import Ska.DBI
+
+    server = str(tmpdir.join('cmd_states.db3'))
+    conn = sqlite3.connect(server)
+    for table in SQL_TABLES:
+        with open(os.path.join(SQL_DIR, table + '_def.sql')) as fh:
+            conn.executescript(fh.read())
+    conn.close()
+
+    db = Ska.DBI.DBI(dbi='sqlite', server=server)
+    yield db
+    db.conn.close()
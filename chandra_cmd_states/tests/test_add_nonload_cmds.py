@@ -0,0 +1,171 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import json
+
+import pytest
+
+import chandra_cmd_states
+from chandra_cmd_states import generate_cmds, cmd_set, insert_cmds_db
+from chandra_cmd_states.cmd_states import _tl_to_bs_cmds
+from chandra_cmd_states.add_nonload_cmds import (make_archive_record, append_archive,
+                                                 get_recent_nonload_cmds,
+                                                 read_archive, load_archive,
+                                                 convert_archive,
+                                                 write_archive)
+
+
+def test_archive_load(tmpdir, cmd_db, monkeypatch):
+    """Test writing command sets to the structured archive and bulk loading.
+    """
+    archive = str(tmpdir.join('nonload_cmds_archive.jsonl'))
+    for date, name, args in (('2012:072:20:52:00.000', 'manvr', [0, 0, 0, 1]),
+                             ('2012:080:00:00:00.000', 'obsid', [30000])):
+        cmds = generate_cmds(date, cmd_set(name, *args))
+        append_archive(make_archive_record(date, name, args, cmds), archive)
+
+    # An existing non-load command that is not in the archive stops the load
+    old_cmds = generate_cmds('2010:001:00:00:00.000', cmd_set('obsid', 1))
+    insert_cmds_db(old_cmds, None, cmd_db)
+    with pytest.raises(ValueError, match='1 non-load commands in the database '
+                       'are not in the archive'):
+        load_archive(archive, cmd_db, dry_run=True)
+
+    # Commands are matched by date, type and TLMSID, so this one is replaced
+    # by the archived command with the new obsid
+    append_archive(make_archive_record('2010:001:00:00:00.000', 'obsid', [2],
+                                       generate_cmds('2010:001:00:00:00.000',
+                                                     cmd_set('obsid', 2))),
+                   archive)
+
+    # A dry run only validates the archive
+    assert len(load_archive(archive, cmd_db, dry_run=True)) == 3
+    db_cmds = cmd_db.fetchall('SELECT * FROM cmds WHERE timeline_id IS NULL')
+    assert db_cmds['date'].tolist() == ['2010:001:00:00:00.000']
+
+    # A failed interrupt replay rolls back the whole load
+    records = read_archive(archive)
+    records[1]['interrupt'] = {'observing_only': False, 'current_only': True}
+    with open(archive, 'w') as fh:
+        fh.writelines(json.dumps(record) + '\n' for record in records)
+
+    def bad_interrupt_loads(*args, **kwargs):
+        raise RuntimeError('interrupt failed')
+
+    monkeypatch.setattr(chandra_cmd_states, 'interrupt_loads',
+                        bad_interrupt_loads)
+    with pytest.raises(RuntimeError):
+        load_archive(archive, cmd_db)
+    db_cmds = cmd_db.fetchall('SELECT * FROM cmds WHERE timeline_id IS NULL')
+    assert db_cmds['date'].tolist() == ['2010:001:00:00:00.000']
+    monkeypatch.undo()
+
+    records = load_archive(archive, cmd_db)
+    assert [record['cmd_set'] for record in records] == ['manvr', 'obsid',
+                                                         'obsid']
+
+    db_cmds = cmd_db.fetchall('SELECT * FROM cmds WHERE timeline_id IS NULL '
+                              'ORDER BY date')
+    cmds = _tl_to_bs_cmds(db_cmds, None, cmd_db)
+    assert [cmd['date'] for cmd in cmds] == ['2010:001:00:00:00.000',
+                                             '2012:072:20:52:00.000',
+                                             '2012:072:20:52:00.256',
+                                             '2012:072:20:52:04.356',
+                                             '2012:072:20:52:10.250',
+                                             '2012:080:00:00:00.000']
+    assert cmds[0]['params'] == {'ID': 2}
+    assert cmds[3]['params'] == {'Q1': 0.0, 'Q2': 0.0, 'Q3': 0.0, 'Q4': 1.0}
+    assert cmds[5]['params'] == {'ID': 30000}
+
+
+def test_read_archive_invalid(tmpdir):
+    """Test that a bad record anywhere in the archive is found.
+    """
+    archive = str(tmpdir.join('nonload_cmds_archive.jsonl'))
+    cmds = generate_cmds('2012:080:00:00:00.000', cmd_set('obsid', 30000))
+    record = make_archive_record('2012:080:00:00:00.000', 'obsid', [30000], cmds)
+    append_archive(record, archive)
+    record['cmds'][0]['date'] = '2012:080'
+    append_archive(record, archive)
+
+    with pytest.raises(ValueError, match=r'jsonl:2: invalid archive record'):
+        read_archive(archive)
+
+    record['cmds'][0]['date'] = '2012:081:00:00:00.000'
+    with open(archive, 'w') as fh:
+        fh.write(json.dumps(record) + '\n')
+    with pytest.raises(ValueError, match=r'does not match date'):
+        read_archive(archive)
+
+
+ARCHIVE_PY = """
+import Ska.DBI
+from chandra_cmd_states import generate_cmds, cmd_set, interrupt_loads
+
+db = Ska.DBI.DBI(dbi='sqlite', server='db_base.db3')
+for table in ('cmd_intpars', 'cmd_fltpars', 'cmds'):
+    db.execute('DELETE FROM %s WHERE timeline_id is NULL' % table)
+
+cmds = []
+cmds += generate_cmds('2012:010:00:00:00', cmd_set('nsm'))
+cmds += generate_cmds('2012:020:00:00:00', (dict(cmd='ACISPKT',
+                                                 tlmsid='AA00000000'),))
+cmds += generate_cmds('2012:030:00:00:00', cmd_set('scs107'))
+for date in ['2012:010:00:00:00']:
+    print date
+    interrupt_loads(date, db, current_only=True)
+cmd_states.insert_cmds_db(cmds, None, db)
+
+# date=2012:040:00:00:00.000 cmd_set=obsid args=30000
+cmds = generate_cmds('2012:040:00:00:00.000', cmd_set('obsid', 30000))
+cmd_states.insert_cmds_db(cmds, None, db)
+cmd_states.interrupt_loads('2012:040:00:00:00.000', db, observing_only=True,
+                           current_only=True)
+"""
+
+
+def test_convert_archive(tmpdir, cmd_db):
+    """The Python archive is converted to structured records that cover the
+    commands it inserted.
+    """
+    archive_py = str(tmpdir.join('nonload_cmds_archive.py'))
+    with open(archive_py, 'w') as fh:
+        fh.write(ARCHIVE_PY)
+    records = convert_archive(archive_py)
+    assert [(record['date'], record['cmd_set'], record['args'])
+            for record in records] == [
+                ('2012:010:00:00:00.000', 'nsm', []),
+                ('2012:020:00:00:00.000', None, []),
+                ('2012:030:00:00:00.000', 'scs107', []),
+                ('2012:040:00:00:00.000', 'obsid', [30000])]
+    assert [record['interrupt'] for record in records] == [
+        {'observing_only': False, 'current_only': True}, None, None,
+        {'observing_only': True, 'current_only': True}]
+    assert records[1]['cmds'][0]['tlmsid'] == 'AA00000000'
+
+    # The commands inserted by the Python archive are covered by the records
+    for date, cmds in (('2012:010:00:00:00', cmd_set('nsm')),
+                       ('2012:040:00:00:00', cmd_set('obsid', 30000))):
+        insert_cmds_db(generate_cmds(date, cmds), None, cmd_db)
+    archive = str(tmpdir.join('nonload_cmds_archive.jsonl'))
+    write_archive(records, archive)
+    with pytest.raises(IOError):
+        write_archive(records, archive)
+    assert load_archive(archive, cmd_db) == records
+    n_cmds = cmd_db.fetchone('SELECT count(*) AS n FROM cmds')['n']
+    assert n_cmds == sum(len(record['cmds']) for record in records)
+
+
+def test_get_recent_nonload_cmds(cmd_db):
+    """Test that the LIMITed recent commands match the full non-load history.
+    """
+    for date, name, args in (('2012:072:20:52:00.000', 'manvr', [0, 0, 0, 1]),
+                             ('2012:080:00:00:00.000', 'obsid', [30000]),
+                             ('2012:090:00:00:00.000', 'obsid', [30001])):
+        insert_cmds_db(generate_cmds(date, cmd_set(name, *args)), None, cmd_db)
+    db_cmds = cmd_db.fetchall('SELECT * FROM cmds WHERE timeline_id IS NULL '
+                              'ORDER BY date DESC')
+    all_cmds = _tl_to_bs_cmds(db_cmds, None, cmd_db)
+
+    assert get_recent_nonload_cmds(cmd_db, 3) == all_cmds[:3]
+    assert get_recent_nonload_cmds(cmd_db, 0) == all_cmds
+    assert get_recent_nonload_cmds(cmd_db, None, '2012:080') == all_cmds[:2]
+    assert get_recent_nonload_cmds(cmd_db, 10, '2013:001') == []
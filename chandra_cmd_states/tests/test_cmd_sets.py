@@ -1,6 +1,10 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 
-from chandra_cmd_states import cmd_set
+import pytest
+
+from Chandra.Time import DateTime
+from chandra_cmd_states import (cmd_set, generate_cmds, generate_cmds_many, cmds_as_dicts,
+                                cmds_as_table, insert_cmds_db, get_cmds, get_cmds_table)
 
 # COMMAND_HW       | TLMSID= AFIDP, HEX= 6480005, MSID= AFLCRSET
 
@@ -69,3 +73,63 @@ def test_cmd_sets7():
     cmds = cmd_set('dith_off')
     exp = ({'dur': 1.025}, {'cmd': 'COMMAND_SW', 'tlmsid': 'AODSDITH'})
     assert cmds == exp
+
+
+def test_generate_cmds_many():
+    time_cmd_sets = [('2015:001:00:00:00.000', cmd_set('scs107')),
+                     ('2015:001:00:01:00.000', cmd_set('obsid', 30000)),
+                     (DateTime('2015:002').secs, cmd_set('nsm')),
+                     ('2015:003', cmd_set('manvr', 0, 0, 0, 1)),
+                     ('2015:004', cmd_set('dith_off'))]
+    cmds = generate_cmds_many(time_cmd_sets)
+
+    exp = [cmd for time, cmd_set_ in time_cmd_sets
+           for cmd in generate_cmds(time, cmd_set_)]
+    assert cmds_as_dicts(cmds) == exp
+    assert len(generate_cmds_many([])) == 0
+
+
+def test_cmds_as_table():
+    cmds = generate_cmds('2015:001', cmd_set('nsm') + cmd_set('manvr', 0, 0, 0, 1))
+    cmds_table = cmds_as_table(cmds)
+    assert len(cmds_table) == len(cmds)
+    assert cmds_as_dicts(cmds_table) == cmds
+    assert cmds_as_table(cmds_table) is cmds_table
+
+    # Commands that cannot change state are dropped if not strict and the
+    # tlmsid is taken from the TLMSID param if needed.
+    bs_cmds = [{'date': '2015:001:00:00:00.000', 'time': 0.0, 'cmd': 'ORBPOINT',
+                'tlmsid': None, 'params': {}},
+               {'date': '2015:001:00:00:01.000', 'time': 1.0, 'cmd': 'COMMAND_SW',
+                'tlmsid': None, 'params': {'TLMSID': 'AONMMODE', 'HEX': '8030402'}}]
+    cmds_table = cmds_as_table(bs_cmds, strict=False)
+    assert cmds_table['tlmsid'].tolist() == ['AONMMODE']
+    assert cmds_as_dicts(cmds_table) == [{'date': '2015:001:00:00:01.000', 'time': 1.0,
+                                          'cmd': 'COMMAND_SW', 'tlmsid': 'AONMMODE',
+                                          'msid': None}]
+    with pytest.raises(ValueError, match='ORBPOINT'):
+        cmds_as_table(bs_cmds)
+
+    # Missing state parameters and strings too long for the table are errors
+    with pytest.raises(KeyError, match='MP_TARGQUAT command at 2015:001 has no Q4'):
+        cmds_as_table([{'date': '2015:001', 'cmd': 'MP_TARGQUAT',
+                        'params': {'Q1': 0.0, 'Q2': 0.0, 'Q3': 0.0}}])
+    with pytest.raises(ValueError, match='longer than 10 characters'):
+        cmds_as_table([{'date': '2015:001', 'cmd': 'COMMAND_SW',
+                        'tlmsid': 'AONMMODE_LONG'}])
+
+
+def test_insert_cmds_db_dicts(cmd_db):
+    """Only command dicts are inserted and a command without a state
+    parameter in the database cannot be read as a command table.
+    """
+    cmds = generate_cmds_many([('2015:001', cmd_set('obsid', 30000))])
+    with pytest.raises(TypeError, match='needs command dicts'):
+        insert_cmds_db(cmds, None, cmd_db)
+
+    insert_cmds_db(generate_cmds('2015:002', [dict(cmd='MP_OBSID',
+                                                   tlmsid='COAOSQID')]),
+                   None, cmd_db)
+    assert get_cmds('2015:001', db=cmd_db, timeline_loads=[])[0]['cmd'] == 'MP_OBSID'
+    with pytest.raises(KeyError, match='MP_OBSID command at 2015:002:00:00:00.000 has no ID'):
+        get_cmds_table('2015:001', db=cmd_db, timeline_loads=[])
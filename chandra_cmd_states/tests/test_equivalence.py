@@ -0,0 +1,69 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+from chandra_cmd_states import cmd_states, equivalence, reference
+
+
+def test_diff_states():
+    """Float columns match within tolerance, other columns exactly, and the
+    first differing row is reported.
+    """
+    cmds = equivalence.random_cmds(30, seed=1)
+    states = equivalence.reference_states(equivalence.random_state0(cmds),
+                                          cmds)
+    new = states.copy()
+    new['pitch'][3] += 1e-8
+    assert equivalence.diff_states(states, new) is None
+
+    new['pitch'][5] += 0.01
+    new['obsid'][4] += 1
+    divergence = equivalence.diff_states(states, new, 'get_states')
+    assert (divergence.row, divergence.col) == (4, 'obsid')
+    assert divergence.datestart == states['datestart'][4]
+    assert 'get_states: values at row 4' in str(divergence)
+
+    divergence = equivalence.diff_states(states, states[:-1])
+    assert (divergence.reason, divergence.row) == ('length', len(states) - 1)
+
+
+def test_check_random():
+    """The engine matches the reference on random command streams"""
+    assert equivalence.check_random(2, n_sets=50) is None
+
+
+def test_check_stream_divergence(monkeypatch):
+    """A change in the engine output is detected"""
+    cmds = equivalence.random_cmds(30, seed=2)
+    state0 = equivalence.random_state0(cmds)
+    get_states = cmd_states.get_states
+
+    def bad_get_states(*args, **kwargs):
+        states = get_states(*args, **kwargs)
+        states['pitch'][7] += 1e-5
+        return states
+
+    monkeypatch.setattr(cmd_states, 'get_states', bad_get_states)
+    divergence = equivalence.check_stream(state0, cmds)
+    assert (divergence.check, divergence.row, divergence.col) == ('get_states',
+                                                                  7, 'pitch')
+    monkeypatch.undo()
+
+    monkeypatch.setattr(cmd_states, 'reduce_states',
+                        lambda states, cols, allow_identical: states[:1])
+    divergence = equivalence.check_stream(state0, cmds)
+    assert divergence.check == 'reduce_states'
+    assert divergence.context == 'cols=obsid allow_identical=True'
+
+
+def test_reference_self_contained():
+    """The reference engine uses nothing from the engine module, and its
+    original list of command dicts input is not changed by the harness.
+    """
+    assert not [name for name, val in vars(reference).items()
+                if getattr(val, '__module__', None) == cmd_states.__name__
+                or val is cmd_states]
+    cmds_table = equivalence.random_cmds(10, seed=3)
+    cmds = cmd_states.cmds_as_dicts(cmds_table)
+    n_cmds = len(cmds)
+    states = equivalence.reference_states(
+        equivalence.random_state0(cmds_table), cmds)
+    assert len(cmds) == n_cmds
+    assert len(states) > n_cmds
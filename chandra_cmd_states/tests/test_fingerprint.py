@@ -0,0 +1,55 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+from chandra_cmd_states import fingerprint, generate_cmds, cmd_set, insert_cmds_db
+
+from .test_migrations import insert_test_cmds
+
+
+def insert_timeline(db, tl_id, datestart, datestop, mp_dir):
+    db.execute("INSERT INTO load_segments VALUES ({0}, 'JAN0112A', 2012, "
+               "'{1}', '{2}', 131, 0)".format(tl_id, datestart, datestop))
+    db.execute("INSERT INTO timelines VALUES ({0}, {0}, '{1}', '{2}', '{3}', "
+               "0, 0, 0)".format(tl_id, mp_dir, datestart, datestop))
+
+
+def test_earliest_change(cmd_db, tmpdir):
+    """The earliest change date is found for new non-load commands, new and
+    interrupted timelines and updated backstop files.
+    """
+    mp_dir = str(tmpdir)
+    window = '2012:001:00:00:00.000'
+    insert_test_cmds(cmd_db)
+    insert_timeline(cmd_db, 1, '2012:050:00:00:00.000',
+                    '2012:060:00:00:00.000', '/2012/FEB1912/oflsa/')
+    fp0 = fingerprint.get_fingerprint(cmd_db, window, mp_dir)
+    assert fingerprint.earliest_change(fp0, fp0) is None
+    assert fingerprint.earliest_change(None, fp0) == window
+
+    filename = str(tmpdir.join('fp.json'))
+    fingerprint.write_fingerprint(filename, fp0)
+    fp0 = fingerprint.read_fingerprint(filename)
+    fp1 = fingerprint.get_fingerprint(cmd_db, window, mp_dir)
+    assert fingerprint.earliest_change(fp0, fp1) is None
+
+    # Non-load command
+    insert_cmds_db(generate_cmds('2012:085:00:00:00.000',
+                                 cmd_set('obsid', 40000)), None, cmd_db)
+    fp2 = fingerprint.get_fingerprint(cmd_db, window, mp_dir)
+    assert fingerprint.earliest_change(fp1, fp2) == '2012:085:00:00:00.000'
+
+    # Interrupted timeline
+    cmd_db.execute("UPDATE timelines SET datestop='2012:055:00:00:00.000' "
+                   "WHERE id=1")
+    fp3 = fingerprint.get_fingerprint(cmd_db, window, mp_dir)
+    assert fingerprint.earliest_change(fp2, fp3) == '2012:055:00:00:00.000'
+
+    # New backstop file for the timeline and a new timeline
+    tmpdir.mkdir('2012').mkdir('FEB1912').mkdir('oflsa').join(
+        'CR050_0000.backstop').write('')
+    insert_timeline(cmd_db, 2, '2012:070:00:00:00.000',
+                    '2012:080:00:00:00.000', '/2012/MAR1012/oflsa/')
+    fp4 = fingerprint.get_fingerprint(cmd_db, window, mp_dir)
+    assert fingerprint.earliest_change(fp3, fp4) == '2012:050:00:00:00.000'
+
+    # Changes before the window start are ignored
+    fp5 = fingerprint.get_fingerprint(cmd_db, '2012:086:00:00:00.000', mp_dir)
+    assert fingerprint.earliest_change(fp1, fp5) is None
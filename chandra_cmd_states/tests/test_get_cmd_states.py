@@ -6,9 +6,15 @@ from io import StringIO
 import pytest
 import numpy as np
 from astropy.io import ascii
+import Ska.Numpy
 
-from chandra_cmd_states.get_cmd_states import main, fetch_states
-from chandra_cmd_states.cmd_states import decode_power, get_state0, get_cmds, get_states
+from Chandra.Time import DateTime
+
+from chandra_cmd_states.get_cmd_states import (main, fetch_states, fetch_states_many,
+                                               states_at, get_h5_states, fetch_intervals,
+                                               iter_states, write_states)
+from chandra_cmd_states.cmd_states import (decode_power, get_state0, get_cmds, get_states,
+                                           interpolate_states)
 
 HAS_SOTMP_FILES = os.path.exists(f'{os.environ["SKA"]}/data/mpcrit1/mplogs/2017')
 
@@ -48,6 +54,102 @@ def test_get_states_main():
     assert out == OUT
 
 
+@pytest.mark.parametrize('vals', [None, ['obsid', 'pitch', 'trans_keys']])
+def test_write_states_text(vals):
+    """Test that the chunked text writer matches Ska.Numpy.pformat.
+    """
+    states = fetch_states('2010:100:12:00:00', '2010:110:12:00:00', vals=vals)
+    out = StringIO()
+    write_states(states, out, chunk_size=7)
+    assert out.getvalue() == Ska.Numpy.pformat(states)
+
+    out = StringIO()
+    write_states(lambda: iter_states('2010:100:12:00:00', '2010:110:12:00:00',
+                                     vals=vals, chunk_size=5), out)
+    assert out.getvalue() == Ska.Numpy.pformat(states)
+
+
+@pytest.mark.parametrize('allow_identical', [False, True])
+def test_iter_states(allow_identical):
+    """Test that streamed state chunks match fetch_states.
+    """
+    vals = ['obsid', 'simpos', 'pcad_mode']
+    exp = fetch_states('2010:100:12:00:00', '2010:110:12:00:00', vals=vals,
+                       allow_identical=allow_identical)
+    chunks = list(iter_states('2010:100:12:00:00', '2010:110:12:00:00', vals=vals,
+                              allow_identical=allow_identical, chunk_size=3))
+    states = np.concatenate(chunks)
+    assert states.dtype == exp.dtype
+    assert np.all(states == exp)
+
+
+def test_get_states_main_formats(tmpdir):
+    """Test the npy and csv output formats of the command line interface.
+    """
+    cli_string = "--start=2010:100:12:00:00 --stop=2010:101:12:00:00 --vals=obsid,simpos"
+    exp = fetch_states('2010:100:12:00:00', '2010:101:12:00:00', vals=['obsid', 'simpos'])
+
+    outfile = str(tmpdir.join('states.npy'))
+    main(cli_string.split() + ['--format=npy', '--outfile=' + outfile])
+    assert np.all(np.load(outfile) == exp)
+
+    outfile = str(tmpdir.join('states.csv'))
+    main(cli_string.split() + ['--format=csv', '--outfile=' + outfile])
+    dat = ascii.read(outfile, format='csv')
+    assert np.all(dat['obsid'] == exp['obsid'])
+    assert np.all(dat['datestart'] == exp['datestart'])
+
+
+def test_write_states_text_pformat():
+    """Test that the text writer gives the Ska.Numpy.pformat output in OUT.
+    """
+    states = VALS.as_array()
+    for chunk_size in (1, 3, 100):
+        out = StringIO()
+        write_states(states, out, chunk_size=chunk_size)
+        assert out.getvalue() == OUT
+
+
+def test_get_states_main_replaced(tmpdir, monkeypatch):
+    """Test that both passes of the npy output read the same HDF5 file even
+    if a new version is swapped in between them.
+    """
+    import tables
+    from chandra_cmd_states import equivalence, update_cmd_states
+    from chandra_cmd_states import get_cmd_states, h5store
+
+    cmds = equivalence.random_cmds(40, seed=8)
+    states = equivalence.reference_states(equivalence.random_state0(cmds),
+                                          cmds)
+    h5file = str(tmpdir.join('cmd_states.h5'))
+    old_file = str(tmpdir.join('old.h5'))
+    new_file = str(tmpdir.join('cmd_states.h5.new'))
+    for filename, rows in ((h5file, states), (old_file, states),
+                           (new_file, states[:10])):
+        with tables.open_file(filename, mode='w') as h5:
+            h5store.create_tables(h5, update_cmd_states._as_rows(rows))
+
+    iter_h5_states = get_cmd_states._iter_h5_states
+    n_passes = []
+
+    def replacing_iter_h5_states(*args, **kwargs):
+        n_passes.append(1)
+        if len(n_passes) == 2:
+            os.replace(new_file, h5file)
+        return iter_h5_states(*args, **kwargs)
+
+    monkeypatch.setattr(get_cmd_states, '_iter_h5_states',
+                        replacing_iter_h5_states)
+    start, stop = states['datestart'][2], states['datestop'][-2]
+    outfile = str(tmpdir.join('states.npy'))
+    main(['--start', start, '--stop', stop, '--vals=obsid', '--format=npy',
+          '--server', h5file, '--outfile', outfile])
+    assert len(n_passes) == 2
+    exp = fetch_states(start, stop, vals=['obsid'], server=old_file)
+    assert len(exp) > 1
+    assert np.load(outfile).tolist() == exp.tolist()
+
+
 # Set up possible backends
 dbis = ['hdf5', 'sqlite']
 
@@ -70,6 +172,58 @@ def test_get_states(dbi):
     assert names + val_names == list(states.dtype.names)
 
 
+@pytest.mark.parametrize('dbi', dbis)
+@pytest.mark.parametrize('allow_identical', [False, True])
+def test_fetch_states_many(dbi, allow_identical):
+    """Test that fetching many windows at once matches fetch_states for each.
+    """
+    val_names = ['obsid', 'simpos', 'pcad_mode']
+    windows = [('2010:100:12:00:00', '2010:101:12:00:00'),
+               ('2010:100:14:10:00', '2010:100:14:28:10'),
+               ('2010:101:00:00:00', '2010:101:00:58:00'),
+               ('2010:090:00:00:00', '2010:090:00:00:01')]
+    states_list = fetch_states_many(windows, vals=val_names, dbi=dbi,
+                                    allow_identical=allow_identical)
+    assert len(states_list) == len(windows)
+    for (start, stop), states in zip(windows, states_list):
+        exp = fetch_states(start, stop, vals=val_names, dbi=dbi,
+                           allow_identical=allow_identical)
+        assert states.dtype.names == exp.dtype.names
+        assert np.all(states == exp)
+
+
+def test_states_at():
+    """Test looking up state values at unsorted times directly from HDF5.
+    """
+    states = get_h5_states(DateTime('2010:100:12:00:00'), DateTime('2010:101:12:00:00'),
+                           None)
+    times = np.linspace(states['tstart'][0] + 1, states['tstop'][-1] - 1, 1000)[::-1]
+    times = np.concatenate([times, states['tstop'][:-1]])
+    exp = interpolate_states(states, times)
+    vals = states_at(times, vals=['obsid', 'pitch', 'pcad_mode'], chunk_size=100)
+    assert vals.dtype.names == ('obsid', 'pitch', 'pcad_mode')
+    for name in vals.dtype.names:
+        assert np.all(vals[name] == exp[name])
+
+
+def test_fetch_intervals():
+    """Test merging states where a predicate is true into intervals.
+    """
+    def npnt_hrc(states):
+        return (states['pcad_mode'] == 'NPNT') & (states['simpos'] > 0)
+
+    intervals = fetch_intervals(npnt_hrc, ['pcad_mode', 'simpos'],
+                                start='2010:100:12:00:00', stop='2010:101:12:00:00',
+                                chunk_size=3)
+    assert np.all(intervals['datestart'] == ['2010:100:14:32:26.896',
+                                             '2010:101:01:19:50.514'])
+    assert np.all(intervals['datestop'] == ['2010:101:00:54:29.675',
+                                            '2010:101:12:00:00.000'])
+    assert np.allclose(intervals['duration'],
+                       intervals['tstop'] - intervals['tstart'])
+    assert np.allclose(intervals['tstart'], [387297213.08, 387336056.698])
+
+
 @pytest.mark.skipif('not HAS_SOTMP_FILES', reason='Needs 2017 products')
 def test_acis_power_cmds():
     import Ska.DBI
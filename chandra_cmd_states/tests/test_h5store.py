@@ -0,0 +1,75 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import numpy as np
+import tables
+
+from chandra_cmd_states import (equivalence, update_cmd_states,
+                                h5store, get_cmd_states)
+
+
+def test_versioned_layout(cmd_db, tmpdir):
+    """Updates of the versioned layout only append rows, and readers get the
+    same states as from a flat table with the final states.
+    """
+    journal_file = str(tmpdir.join('journal.npz'))
+    versioned_file = str(tmpdir.join('versioned.h5'))
+    flat_file = str(tmpdir.join('flat.h5'))
+    cmds = equivalence.random_cmds(40, seed=5)
+    states = equivalence.reference_states(equivalence.random_state0(cmds),
+                                          cmds)
+    new_states = states.copy()
+    new_states['obsid'][20:] += 1
+    final_states = new_states[:-5].copy()
+    final_states['simpos'][10:] += 1
+
+    with tables.open_file(versioned_file, mode='a') as h5:
+        update_cmd_states.make_hdf5_cmd_states(cmd_db, h5, versioned=True)
+        assert h5store.is_versioned(h5)
+        update_cmd_states.update_states_db(states, cmd_db, h5)
+        update_cmd_states.update_states_db(new_states, cmd_db, h5,
+                                           journal_file=journal_file)
+        update_cmd_states.update_states_db(final_states, cmd_db, h5)
+        # Replaying the last update (e.g. from a journal) changes nothing
+        rows = update_cmd_states._as_rows(final_states[10:],
+                                          update_cmd_states.CMD_STATES_UDTYPE)
+        update_cmd_states.replace_cmd_states(final_states['datestart'][10],
+                                             rows, cmd_db, h5)
+        assert h5.root.cuts.col('generation').tolist() == [1, 2, 3]
+        n_rows = h5.root.data.nrows
+        assert n_rows == (len(states) + len(states) - 20
+                          + len(final_states) - 10 + len(final_states) - 10)
+        live = h5store.read_rows(h5.root.data, h5store.live_rows(h5))
+        assert live['obsid'].tolist() == final_states['obsid'].tolist()
+
+    with tables.open_file(flat_file, mode='w') as h5:
+        h5store.create_tables(h5, update_cmd_states._as_rows(final_states))
+        flat_colnames = h5.root.data.colnames
+
+    start = get_cmd_states.DateTime(final_states['tstart'][3] + 10)
+    stop = get_cmd_states.DateTime(final_states['tstop'][-3] - 10)
+    times = np.linspace(start.secs, stop.secs, 50)
+    outs = []
+    for filename in (versioned_file, flat_file):
+        outs.append([
+            get_cmd_states.get_h5_states(start, stop, filename),
+            np.concatenate(list(get_cmd_states.iter_states(
+                start, stop, vals=['obsid', 'simpos'], server=filename,
+                chunk_size=7))),
+            get_cmd_states.states_at(times, vals=['obsid', 'simpos'],
+                                     server=filename),
+            get_cmd_states.fetch_intervals(lambda x: x['simpos'] > 0,
+                                           ['simpos'], start, stop,
+                                           server=filename, chunk_size=7)])
+    for versioned_out, flat_out in zip(*outs):
+        assert versioned_out.dtype == flat_out.dtype
+        assert versioned_out.tolist() == flat_out.tolist()
+    assert len(outs[0][0]) > 0
+
+    with tables.open_file(versioned_file, mode='a') as h5:
+        assert h5store.compact(h5) == n_rows - len(final_states)
+        assert h5store.is_versioned(h5)
+        assert h5.root.cuts.nrows == 0
+        assert (h5.root.data.col('obsid').tolist()
+                == final_states['obsid'].tolist())
+        assert h5store.compact(h5, versioned=False) == 0
+        assert not h5store.is_versioned(h5)
+        assert h5.root.data.colnames == flat_colnames
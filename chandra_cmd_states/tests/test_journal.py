@@ -0,0 +1,192 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import os
+
+import numpy as np
+import pytest
+import tables
+
+from chandra_cmd_states import equivalence, update_cmd_states, h5store
+from chandra_cmd_states.metrics import Metrics
+
+
+def get_tables(db, h5):
+    db_rows = db.fetchall('SELECT datestart, obsid FROM cmd_states '
+                          'ORDER BY datestart')
+    h5d = h5.root.data
+    return ([(datestart, obsid) for datestart, obsid in db_rows.tolist()],
+            [(datestart.decode(), obsid) for datestart, obsid in
+             zip(h5d.col('datestart'), h5d.col('obsid').tolist())])
+
+
+@pytest.mark.parametrize('action', ['forward', 'back'])
+def test_journal_recovery(cmd_db, tmpdir, action, monkeypatch):
+    """An update that fails after the HDF5 table is changed but before the
+    database commit is rolled forward or back from the journal.
+    """
+    journal_file = str(tmpdir.join('cmd_states.journal.npz'))
+    h5 = tables.open_file(str(tmpdir.join('cmd_states.h5')), mode='a')
+    cmds = equivalence.random_cmds(40, seed=3)
+    states = equivalence.reference_states(equivalence.random_state0(cmds),
+                                          cmds)
+    try:
+        assert update_cmd_states.update_states_db(
+            states, cmd_db, h5, journal_file=journal_file) is True
+        assert not os.path.exists(journal_file)
+        old_db_rows, old_h5_rows = get_tables(cmd_db, h5)
+        assert old_db_rows == old_h5_rows
+        assert len(old_db_rows) == len(states)
+        assert update_cmd_states.update_states_db(
+            states, cmd_db, h5, journal_file=journal_file) is False
+
+        new_states = states.copy()
+        new_states['obsid'][20:] += 1
+        n_insert = [0]
+
+        def failing_insert(row, tablename, commit=True):
+            n_insert[0] += 1
+            if n_insert[0] > 3:
+                raise RuntimeError('crash')
+            cmd_db.conn.execute('INSERT INTO cmd_states VALUES ({})'
+                                .format(','.join('?' * len(row))),
+                                list(row.values()))
+
+        monkeypatch.setattr(cmd_db, 'insert', failing_insert)
+        with pytest.raises(RuntimeError):
+            update_cmd_states.update_states_db(new_states, cmd_db, h5,
+                                               journal_file=journal_file)
+        monkeypatch.undo()
+        cmd_db.conn.rollback()
+
+        # HDF5 table has the new states and the database the old ones
+        db_rows, h5_rows = get_tables(cmd_db, h5)
+        assert db_rows == old_db_rows
+        assert h5_rows[20][1] == old_h5_rows[20][1] + 1
+        cut_date, rows, old_rows = update_cmd_states.read_journal(journal_file)
+        assert cut_date == states['datestart'][20]
+        assert len(rows) == len(old_rows) == len(states) - 20
+
+        assert update_cmd_states.recover_journal(journal_file, cmd_db, h5,
+                                                 action=action) is True
+        assert not os.path.exists(journal_file)
+        assert update_cmd_states.recover_journal(journal_file, cmd_db,
+                                                 h5) is False
+        db_rows, h5_rows = get_tables(cmd_db, h5)
+        assert db_rows == h5_rows
+        exp_obsid = new_states['obsid'] if action == 'forward' else \
+            states['obsid']
+        assert np.all([obsid for datestart, obsid in db_rows] == exp_obsid)
+    finally:
+        h5.close()
+
+
+def test_snapshot_swap(cmd_db, tmpdir):
+    """Readers of the HDF5 file see the previous version until the updated
+    snapshot is swapped in, and an open reader keeps its version.
+    """
+    h5file = str(tmpdir.join('cmd_states.h5'))
+    opt, args = update_cmd_states.get_options(['--h5file=' + h5file])
+    updater = update_cmd_states.Updater(opt)
+    updater.db = cmd_db
+    cmds = equivalence.random_cmds(40, seed=4)
+    states = equivalence.reference_states(equivalence.random_state0(cmds),
+                                          cmds)
+    updater.open_h5()
+    update_cmd_states.update_states_db(states, cmd_db, updater.h5,
+                                       journal_file=updater.journal_file,
+                                       publish=updater.publish_h5)
+    updater.close_h5()
+    old_obsids = states['obsid'].tolist()
+
+    new_states = states.copy()
+    new_states['obsid'][10:] += 1
+    reader = tables.open_file(h5file, mode='r')
+    seen = []
+
+    def publish():
+        # Update is in the snapshot but not yet in h5file
+        with tables.open_file(h5file, mode='r') as h5:
+            seen.append(h5.root.data.col('obsid').tolist())
+        updater.publish_h5()
+
+    try:
+        updater.open_h5()
+        assert updater.snapshot_file == h5file + '.new'
+        update_cmd_states.update_states_db(new_states, cmd_db, updater.h5,
+                                           journal_file=updater.journal_file,
+                                           publish=publish)
+        assert seen == [old_obsids]
+        assert updater.h5.mode == 'r'
+        assert updater.snapshot_file is None
+        assert not os.path.exists(h5file + '.new')
+        assert reader.root.data.col('obsid').tolist() == old_obsids
+        with tables.open_file(h5file, mode='r') as h5:
+            assert h5.root.data.col('obsid').tolist() == \
+                new_states['obsid'].tolist()
+    finally:
+        reader.close()
+        updater.close_h5()
+
+
+@pytest.mark.parametrize('no_snapshot', [False, True])
+def test_versioned_update(cmd_db, tmpdir, monkeypatch, no_snapshot):
+    """An update of a versioned file is made in a snapshot, so a reader of the
+    file between the cut and the append still sees all the previous states,
+    and the writer lock is released afterwards (also with --no-snapshot).
+    """
+    h5file = str(tmpdir.join('cmd_states.h5'))
+    cmds = equivalence.random_cmds(40, seed=4)
+    states = equivalence.reference_states(equivalence.random_state0(cmds),
+                                          cmds)
+    update_cmd_states.update_states_db(states, cmd_db, None)
+    with tables.open_file(h5file, mode='w') as h5:
+        h5store.create_tables(h5, update_cmd_states._as_rows(states),
+                              versioned=True)
+    new_states = states.copy()
+    new_states['obsid'][10:] += 1
+
+    args = ['--h5file=' + h5file] + (['--no-snapshot'] if no_snapshot else [])
+    opt, args = update_cmd_states.get_options(args)
+    updater = update_cmd_states.Updater(opt)
+    updater.db = cmd_db
+    snapshots = []
+    seen = []
+
+    def update_states(state0, db, h5, opt, metrics, journal_file=None,
+                      publish=None):
+        snapshots.append(updater.snapshot_file)
+        return update_cmd_states.update_states_db(
+            new_states, db, h5, metrics, journal_file=journal_file,
+            publish=publish)
+
+    def append(h5, rows, append=h5store.append):
+        # Read the file between the cut and the append
+        if not no_snapshot:
+            with tables.open_file(h5file, mode='r') as reader:
+                seen.append(h5store.read_rows(
+                    reader.root.data, h5store.live_rows(reader))['obsid'])
+        append(h5, rows)
+
+    monkeypatch.setattr(update_cmd_states.cmd_states, 'get_state0',
+                        lambda date=None, db=None:
+                        dict(zip(states.dtype.names, states[0])))
+    monkeypatch.setattr(update_cmd_states, 'get_changed_state0',
+                        lambda state0, db, opt, old, checkpoint: (state0, {}))
+    monkeypatch.setattr(update_cmd_states, 'update_states', update_states)
+    monkeypatch.setattr(h5store, 'append', append)
+    assert updater.update(Metrics()) is True
+    if no_snapshot:
+        assert snapshots == [None]
+    else:
+        assert snapshots == [h5file + '.new']
+        assert [obsids.tolist() for obsids in seen] == \
+            [states['obsid'].tolist()]
+    assert not os.path.exists(h5file + '.new')
+    assert updater.h5 is None
+
+    # Another writer (e.g. repack_cmd_states) can take the lock
+    with h5store.WriterLock(h5file):
+        pass
+    with tables.open_file(h5file, mode='r') as h5:
+        assert h5store.is_versioned(h5)
+        rows = h5store.read_rows(h5.root.data, h5store.live_rows(h5))
+        assert rows['obsid'].tolist() == new_states['obsid'].tolist()
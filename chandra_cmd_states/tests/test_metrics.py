@@ -0,0 +1,81 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import json
+
+from chandra_cmd_states import (get_cmds, get_cmds_table, get_states, cmd_set,
+                                generate_cmds_many, cmds_as_dicts, STATE0)
+from chandra_cmd_states.metrics import Metrics
+
+from .test_migrations import insert_test_cmds
+
+
+def test_metrics_write(tmpdir):
+    """Stage times and counters accumulate and are written as JSON or a
+    Prometheus textfile.
+    """
+    metrics = Metrics(prefix='test')
+    for _ in range(2):
+        with metrics.stage('outer'):
+            with metrics.stage('outer.inner'):
+                pass
+    metrics.count('hits', 3)
+    metrics.count('misses')
+    metrics.hit_rate('hit_rate', 'hits', 'misses')
+    metrics.hit_rate('no_rate', 'none', 'none')
+
+    assert metrics.stages['outer']['calls'] == 2
+    assert metrics.stages['outer']['wall'] >= metrics.stages['outer.inner']['wall']
+    assert metrics.counters == {'hits': 3, 'misses': 1, 'hit_rate': 0.75}
+
+    filename = str(tmpdir.join('metrics.json'))
+    metrics.write(filename)
+    with open(filename) as fh:
+        out = json.load(fh)
+    assert out['counters'] == metrics.counters
+    assert out['stages']['outer.inner']['calls'] == 2
+
+    filename = str(tmpdir.join('metrics.prom'))
+    metrics.write(filename)
+    with open(filename) as fh:
+        lines = fh.read().splitlines()
+    assert 'test_stage_calls{stage="outer.inner"} 2' in lines
+    assert 'test_hit_rate 0.75' in lines
+    assert not tmpdir.join('metrics.prom.tmp').exists()
+
+
+def test_get_cmds_metrics(cmd_db):
+    """get_cmds records database stage time and non-load command count.
+    """
+    insert_test_cmds(cmd_db)
+    metrics = Metrics()
+    cmds = get_cmds('2012:001:00:00:00.000', db=cmd_db, timeline_loads=[],
+                    metrics=metrics)
+    assert metrics.counters['get_cmds.nonload_cmds'] == len(cmds) == 11
+    assert metrics.stages['get_cmds.db']['calls'] == 1
+    assert 'get_cmds.timelines_db_hit_rate' not in metrics.counters
+
+    # The command table has the same commands with only the state params
+    cmds_table = get_cmds_table('2012:001:00:00:00.000', db=cmd_db,
+                                timeline_loads=[])
+    assert cmds_as_dicts(cmds_table) == [
+        dict((key, val) for key, val in cmd.items()
+             if key in ('date', 'time', 'cmd', 'tlmsid', 'msid', 'params'))
+        for cmd in cmds]
+
+
+def test_get_states_metrics():
+    """get_states records the command loop as one stage with the pitch and
+    maneuver counts, and gives the same states without metrics.
+    """
+    cmds = generate_cmds_many([
+        ('2012:010:00:00:00.000', cmd_set('manvr', 0.5, 0.5, 0.5, 0.5)),
+        ('2012:010:06:00:00.000', cmd_set('obsid', 50000))])
+    state0 = dict(STATE0, datestart='2012:009:00:00:00.000')
+    metrics = Metrics()
+    states = get_states(dict(state0), cmds, metrics=metrics)
+    assert list(metrics.stages) == ['get_states.transitions']
+    assert metrics.stages['get_states.transitions']['calls'] == 1
+    assert metrics.counters['get_states.maneuvers'] == 1
+    assert metrics.counters['get_states.maneuver_steps'] > 1
+    assert metrics.counters['get_states.pitch_samples'] > 0
+    assert metrics.counters['get_states.states'] == len(states)
+    assert get_states(dict(state0), cmds).tolist() == states.tolist()
@@ -0,0 +1,61 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+from chandra_cmd_states import migrations, generate_cmds, cmd_set, insert_cmds_db
+from chandra_cmd_states.cmd_states import _tl_to_bs_cmds, STATE_PAR_COLS
+
+
+def insert_test_cmds(db):
+    for date, name, args in (('2012:072:20:52:00.000', 'manvr', [0.5, 0.5, 0.5, 0.5]),
+                             ('2012:080:00:00:00.000', 'obsid', [30000]),
+                             ('2012:090:00:00:00.000', 'scs107', [])):
+        insert_cmds_db(generate_cmds(date, cmd_set(name, *args)), None, db)
+
+
+def test_add_time_indexes(cmd_db):
+    """Time indexes are created if missing and existing ones are skipped.
+    """
+    assert migrations.add_time_indexes(cmd_db) == []
+    cmd_db.execute('DROP INDEX idx_cmd_states_tstop')
+    assert migrations.add_time_indexes(cmd_db) == ['idx_cmd_states_tstop']
+
+
+def test_add_state_par_cols(cmd_db):
+    """State parameter columns are added and filled from the parameter tables.
+    """
+    insert_test_cmds(cmd_db)
+    cols = ', '.join(col for name, col in STATE_PAR_COLS)
+    exp = cmd_db.fetchall('SELECT id, {} FROM cmds ORDER BY id'.format(cols))
+    assert migrations.add_state_par_cols(cmd_db) == 0
+
+    for name, col in STATE_PAR_COLS:
+        cmd_db.execute('ALTER TABLE cmds DROP COLUMN {}'.format(col))
+    assert migrations.add_state_par_cols(cmd_db) == 3
+    assert migrations.add_state_par_cols(cmd_db) == 0
+
+    par_cmds = cmd_db.fetchall('SELECT id, {} FROM cmds ORDER BY id'.format(cols))
+    assert par_cmds.tolist() == exp.tolist()
+
+
+def test_state_pars_only(cmd_db):
+    """Commands with state parameters from the cmds columns match the commands
+    with parameters from the parameter tables.
+    """
+    insert_test_cmds(cmd_db)
+    db_cmds = cmd_db.fetchall('SELECT * FROM cmds ORDER BY date')
+    cmds = _tl_to_bs_cmds(db_cmds, None, cmd_db)
+    par_cmds = _tl_to_bs_cmds(db_cmds, None, cmd_db, state_pars_only=True)
+    assert par_cmds == cmds
+    assert par_cmds[2]['params'] == {'Q1': 0.5, 'Q2': 0.5, 'Q3': 0.5, 'Q4': 0.5}
+    assert par_cmds[4]['params'] == {'ID': 30000}
+
+
+def test_insert_unmigrated(cmd_db):
+    """Commands are inserted into a database without the state parameter
+    columns, and migrating it afterwards fills them.
+    """
+    for name, col in STATE_PAR_COLS:
+        cmd_db.execute('ALTER TABLE cmds DROP COLUMN {}'.format(col))
+    insert_test_cmds(cmd_db)
+    assert migrations.add_state_par_cols(cmd_db) == 3
+    db_cmds = cmd_db.fetchall('SELECT * FROM cmds ORDER BY date')
+    par_cmds = _tl_to_bs_cmds(db_cmds, None, cmd_db, state_pars_only=True)
+    assert par_cmds[4]['params'] == {'ID': 30000}
@@ -0,0 +1,79 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import sys
+
+import pytest
+
+from chandra_cmd_states.profiling import profile_args, profiled
+
+
+def test_profile_args():
+    """Profile options are removed from argv and override the environment.
+    """
+    argv = ['--dbi=sqlite', '--profile', '--server', 'x.db3']
+    assert profile_args(argv, {}) == (['cprofile'], None,
+                                      ['--dbi=sqlite', '--server', 'x.db3'])
+    assert profile_args(['--profile=cprofile,tracemalloc',
+                         '--profile-file', 'prof.txt', 'arg'], {}) == (
+        ['cprofile', 'tracemalloc'], 'prof.txt', ['arg'])
+    env = {'CMD_STATES_PROFILE': 'tracemalloc',
+           'CMD_STATES_PROFILE_FILE': 'env.txt'}
+    assert profile_args(['arg'], env) == (['tracemalloc'], 'env.txt', ['arg'])
+    assert profile_args(['--profile'], env) == (['cprofile'], 'env.txt', [])
+    assert profile_args(['--', '--profile'], {}) == ([], None, ['--', '--profile'])
+    assert profile_args([], {'CMD_STATES_PROFILE': '0'}) == ([], None, [])
+    with pytest.raises(ValueError):
+        profile_args(['--profile=gprof'], {})
+
+
+def test_profiled(tmpdir, monkeypatch):
+    """A profiled main writes the report, also when exiting with sys.exit().
+    """
+    monkeypatch.delenv('CMD_STATES_PROFILE', raising=False)
+    monkeypatch.delenv('CMD_STATES_PROFILE_FILE', raising=False)
+    seen_argv = []
+
+    @profiled
+    def main(exit=False):
+        seen_argv.append(sys.argv[1:])
+        [x * 2 for x in range(1000)]
+        if exit:
+            sys.exit(0)
+        return 'done'
+
+    monkeypatch.setattr(sys, 'argv', ['prog', '--opt'])
+    assert main() == 'done'
+    assert seen_argv[-1] == ['--opt']
+    assert tmpdir.listdir() == []
+
+    report = tmpdir.join('report.txt')
+    monkeypatch.setattr(sys, 'argv', ['prog', '--opt', '--profile=cprofile,tracemalloc',
+                                      '--profile-file={}'.format(report)])
+    with pytest.raises(SystemExit):
+        main(exit=True)
+    assert seen_argv[-1] == ['--opt']
+    text = report.read()
+    assert 'Hot functions sorted by cumulative' in text
+    assert 'Memory: current' in text
+    assert tmpdir.join('report.txt.pstats').exists()
+
+
+def test_profiled_args(tmpdir, monkeypatch):
+    """Profile options are taken from an argument list passed to main, which
+    leaves sys.argv alone.
+    """
+    monkeypatch.delenv('CMD_STATES_PROFILE', raising=False)
+    monkeypatch.delenv('CMD_STATES_PROFILE_FILE', raising=False)
+    monkeypatch.setattr(sys, 'argv', ['prog', '--profile', '--other'])
+
+    @profiled
+    def main(main_args=None):
+        return main_args
+
+    report = tmpdir.join('report.txt')
+    args = ['--opt', '--profile', '--profile-file={}'.format(report)]
+    assert main(args) == ['--opt']
+    assert main(main_args=args) == ['--opt']
+    assert args == ['--opt', '--profile', '--profile-file={}'.format(report)]
+    assert sys.argv == ['prog', '--profile', '--other']
+    assert report.read().startswith('# Profile of prog --opt (cprofile)')
+    assert main(['--opt']) == ['--opt']
@@ -0,0 +1,136 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import operator
+
+import numpy as np
+
+import pytest
+
+from chandra_cmd_states import queries
+
+DATE = '2012:080:00:00:00.000'
+
+STOP = '2012:090:00:00:00.000'
+
+# Query and the index that it is expected to use
+HOT_QUERIES = {
+    'get_state0': (queries.state0(DATE), 'idx_cmd_states_pcad_mode_tstop'),
+    'get_state0_datestart': (queries.state0(DATE, 'datestart'),
+                             'idx_cmd_states_pcad_mode_tstart'),
+    'get_state0_many': (queries.npnt_states(DATE, STOP),
+                        'idx_cmd_states_pcad_mode_tstop'),
+    'get_recent_nonload_cmds': (queries.recent_nonload_cmds(10, DATE),
+                                'idx_cmds_timeline_id_time'),
+    'get_cmds_nonload': (queries.nonload_cmds(DATE, STOP),
+                         'idx_cmds_timeline_id_time'),
+    'get_cmds_timeline': (queries.timeline_cmds(1), 'idx_cmds_timeline_id'),
+    'get_sql_states': (queries.cmd_states_overlap(DATE, STOP),
+                       'idx_cmd_states_tstop'),
+    'update_states_db': (queries.cmd_states_overlap(DATE),
+                         'idx_cmd_states_tstop'),
+    'delete_cmd_states': (queries.delete_cmd_states(DATE),
+                          'idx_cmd_states_tstart'),
+    'interrupt_loads': (queries.timeline_loads(DATE, DATE, observing_only=True),
+                        'idx_timelines_datestop'),
+}
+
+
+@pytest.mark.parametrize('name', sorted(HOT_QUERIES))
+def test_query_uses_index(cmd_db, name):
+    """Check with EXPLAIN that each hot query searches using the expected
+    index instead of scanning a whole table.
+    """
+    query, index = HOT_QUERIES[name]
+    plan = cmd_db.conn.execute('EXPLAIN QUERY PLAN ' + query).fetchall()
+    details = [row[-1] for row in plan]
+    assert any('USING INDEX ' + index in detail for detail in details)
+    assert not any(detail.startswith('SCAN') for detail in details)
+
+
+def test_date_where_matches_dates(cmd_db):
+    """Numeric time selections give the same rows as date string selections.
+    """
+    from Chandra.Time import DateTime
+
+    dates = ['2012:079:23:59:59.999', DATE, '2012:080:00:00:00.001']
+    for i, date in enumerate(dates):
+        cmd_db.execute("INSERT INTO cmds (id, date, time, cmd) VALUES "
+                       "({}, '{}', {!r}, 'ACISPKT')"
+                       .format(i, date, float(DateTime(date).secs)))
+    for op, func in (('<', operator.lt), ('<=', operator.le),
+                     ('>', operator.gt), ('>=', operator.ge)):
+        rows = cmd_db.fetchall('SELECT * FROM cmds WHERE '
+                               + queries.date_where('cmds', 'date', op, DATE))
+        exp = [date for date in dates if func(date, DATE)]
+        assert sorted(rows['date'].tolist()) == exp
+
+
+def insert_npnt_states(cmd_db):
+    """Insert 10 states from 2012:080 on, with every third one not NPNT.
+    """
+    from Chandra.Time import DateTime
+    from chandra_cmd_states import STATE0
+
+    tstarts = DateTime('2012:080').secs + np.arange(10) * 10000.0
+    for i, tstart in enumerate(tstarts):
+        state = dict(STATE0, obsid=i, pcad_mode='NPNT' if i % 3 else 'NMAN',
+                     tstart=tstart, tstop=tstart + 10000.0,
+                     datestart=DateTime(tstart).date,
+                     datestop=DateTime(tstart + 10000.0).date)
+        cmd_db.insert(state, 'cmd_states')
+    return ['2012:079', '2012:081', '2012:080:05:00:00', '2012:081',
+            DateTime(tstarts[4]).date, DateTime(tstarts[5]).date, '2013:001']
+
+
+def test_get_state0_many(cmd_db):
+    """get_state0_many gives the same states as get_state0 for each date.
+    """
+    from chandra_cmd_states import get_state0, get_state0_many
+
+    dates = insert_npnt_states(cmd_db)
+    for datepar in ('datestop', 'datestart'):
+        states0 = get_state0_many(dates, cmd_db, date_margin=None,
+                                  datepar=datepar)
+        exp = [get_state0(date, cmd_db, date_margin=None, datepar=datepar)
+               for date in dates]
+        assert [state['obsid'] for state in states0] == [state['obsid']
+                                                          for state in exp]
+        assert states0 == exp
+    assert get_state0_many([], cmd_db) == []
+
+
+def test_get_state0_anchor_cache(cmd_db, tmpdir):
+    """The anchor cache gives the same state0 as the database queries, fills
+    only the requested definitive days and is invalidated by the updater.
+    """
+    from chandra_cmd_states import (get_state0, get_state0_many, anchors,
+                                    update_cmd_states)
+
+    dates = insert_npnt_states(cmd_db) + ['2012:080:23:59:59.999']
+    filename = str(tmpdir.join('anchors.json'))
+    anchor_cache = anchors.AnchorCache(filename)
+    for datepar in ('datestop', 'datestart'):
+        exp = [get_state0(date, cmd_db, datepar=datepar) for date in dates]
+        assert get_state0_many(dates, cmd_db, datepar=datepar,
+                               anchor_cache=anchor_cache) == exp
+        assert sorted(anchor_cache.days[datepar]) == ['2012:079', '2012:080',
+                                                      '2012:081', '2013:001']
+
+        # Cached days need no query, also from the cache file
+        cmd_db.execute('DELETE FROM cmd_states')
+        anchor_cache = anchors.AnchorCache(filename)
+        assert get_state0_many(dates, cmd_db, datepar=datepar,
+                               anchor_cache=anchor_cache) == exp
+        assert [get_state0(date, cmd_db, datepar=datepar,
+                           anchor_cache=anchor_cache)
+                for date in dates] == exp
+        insert_npnt_states(cmd_db)
+
+    # Days that are not definitive are not cached
+    get_state0_many(['2099:001'], cmd_db, anchor_cache=anchor_cache)
+    assert not anchor_cache.has_day('2099:001')
+
+    opt, args = update_cmd_states.get_options(['--anchor-cache=' + filename])
+    update_cmd_states.Updater(opt).invalidate_anchors('2012:080:12:00:00.000')
+    anchor_cache = anchors.AnchorCache(filename)
+    for datepar in ('datestop', 'datestart'):
+        assert sorted(anchor_cache.days[datepar]) == ['2012:079']
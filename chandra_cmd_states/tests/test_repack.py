@@ -0,0 +1,38 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import tables
+
+from chandra_cmd_states import equivalence, update_cmd_states, h5store, repack
+
+
+def test_repack(tmpdir):
+    """Repacking keeps the live states, applies the new settings and swaps
+    the file in place.
+    """
+    h5file = str(tmpdir.join('cmd_states.h5'))
+    cmds = equivalence.random_cmds(40, seed=6)
+    states = equivalence.reference_states(equivalence.random_state0(cmds),
+                                          cmds)
+    rows = update_cmd_states._as_rows(states)
+    with tables.open_file(h5file, mode='w') as h5:
+        h5store.create_tables(h5, rows, versioned=True)
+        h5store.cut(h5, states['datestart'][30], states['tstart'][30])
+        h5store.append(h5, rows[30:])
+
+    complib = ('blosc:lz4' if tables.which_lib_version('blosc') else 'zlib')
+    output = str(tmpdir.join('out.h5'))
+    before, after = repack.repack(h5file, output=output, complib=complib,
+                                  chunkshape=64)
+    assert before['rows'] == len(states) + len(states) - 30
+    assert after['rows'] == after['live_rows'] == len(states)
+    assert (before['tstart_index'], after['tstart_index']) == (False, True)
+    assert after['chunkshape'] == 64
+    assert after['compression'] == '{}(5)'.format(complib)
+    assert len(repack.format_report(before, after)) == 10
+
+    inode = tmpdir.join('cmd_states.h5').stat().ino
+    repack.repack(h5file, versioned=False, index=False)
+    assert tmpdir.join('cmd_states.h5').stat().ino != inode
+    assert not tmpdir.join('cmd_states.h5.repack').exists()
+    with tables.open_file(h5file) as h5:
+        assert not h5store.is_versioned(h5)
+        assert h5.root.data.read().tolist() == rows.tolist()
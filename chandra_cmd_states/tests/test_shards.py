@@ -0,0 +1,148 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import os
+import sys
+import subprocess
+
+import numpy as np
+import pytest
+import tables
+
+from chandra_cmd_states import (equivalence, update_cmd_states,
+                                h5store, shards, get_cmd_states)
+
+
+def test_sharded_layout(cmd_db, tmpdir, caplog):
+    """An update of the sharded layout only writes new files for the years
+    that changed, and readers of the shard directory get the same states as
+    from a single file with all the states.
+    """
+    shard_dir = str(tmpdir.join('shards'))
+    flat_file = str(tmpdir.join('flat.h5'))
+    opt, args = update_cmd_states.get_options(['--shard-dir=' + shard_dir])
+    updater = update_cmd_states.Updater(opt)
+    updater.db = cmd_db
+    cmds = equivalence.random_cmds(60, start='2012:300:00:00:00.000', seed=6,
+                                   mean_gap=1e6)
+    states = equivalence.reference_states(equivalence.random_state0(cmds),
+                                          cmds)
+
+    def update(states, i_start):
+        updater.open_h5(datestart=states['datestart'][i_start])
+        try:
+            update_cmd_states.update_states_db(
+                states[i_start:], cmd_db, updater.h5,
+                journal_file=updater.journal_file, publish=updater.publish_h5)
+            update_cmd_states.check_consistency(
+                cmd_db, updater.h5,
+                datestart=updater.h5.root.data[0]['datestart'].decode())
+        finally:
+            updater.close_h5()
+        assert not os.path.exists(updater.snapshot_file or '')
+        return shards.read_manifest(shard_dir)
+
+    manifest = update(states, 0)
+    years = [int(date[:4]) for date in states['datestart']]
+    assert [shard['year'] for shard in manifest['shards']] == \
+        sorted(set(years))
+    assert len(manifest['shards']) >= 3
+    assert sum(shard['rows'] for shard in manifest['shards']) == len(states)
+
+    # Change states in the last year only
+    new_states = states.copy()
+    i_last = years.index(years[-1])
+    new_states['obsid'][i_last + 1:] += 1
+    new_manifest = update(new_states, i_last)
+    assert new_manifest['generation'] == manifest['generation'] + 1
+    old_files = [shard['file'] for shard in manifest['shards']]
+    new_files = [shard['file'] for shard in new_manifest['shards']]
+    assert new_files[:-1] == old_files[:-1]
+    assert new_files[-1] != old_files[-1]
+    # Files of the previous manifest are kept for readers that just read it
+    assert os.path.exists(os.path.join(shard_dir, old_files[-1]))
+    assert 'mismatch' not in caplog.text
+    assert 'different length' not in caplog.text
+
+    with tables.open_file(flat_file, mode='w') as h5:
+        h5store.create_tables(h5, update_cmd_states._as_rows(new_states))
+
+    start = get_cmd_states.DateTime(new_states['tstart'][3] + 10)
+    stop = get_cmd_states.DateTime(new_states['tstop'][-3] - 10)
+    times = np.linspace(new_states['tstart'][0] - 100,
+                        new_states['tstop'][-1] + 100, 200)
+    outs = []
+    for server in (shard_dir, flat_file):
+        outs.append([
+            get_cmd_states.get_h5_states(start, stop, server),
+            get_cmd_states.fetch_states(start, stop, vals=['simpos'],
+                                        server=server),
+            np.concatenate(list(get_cmd_states.iter_states(
+                start, stop, vals=['simpos'], server=server,
+                chunk_size=7))),
+            get_cmd_states.states_at(times, vals=['obsid', 'simpos'],
+                                     server=server),
+            get_cmd_states.fetch_intervals(lambda x: x['simpos'] > -50000,
+                                           ['simpos'], start, stop,
+                                           server=server, chunk_size=7)])
+    for sharded_out, flat_out in zip(*outs):
+        assert sharded_out.dtype == flat_out.dtype
+        assert sharded_out.tolist() == flat_out.tolist()
+    assert len(outs[0][0]) > 0
+
+    # No times give an empty array, as from a single file
+    sharded_out, flat_out = [
+        get_cmd_states.states_at([], vals=['obsid', 'simpos'], server=server)
+        for server in (shard_dir, flat_file)]
+    assert sharded_out.dtype == flat_out.dtype
+    assert sharded_out.shape == flat_out.shape == (0,)
+
+    # A query within one year only opens that shard
+    year_shards = get_cmd_states._get_h5_files(
+        shard_dir, get_cmd_states.DateTime(new_states['tstart'][i_last] + 1),
+        stop)
+    assert [shard['year'] for shard in year_shards] == [years[-1]]
+
+
+def test_write_shards_before_year0(tmpdir):
+    """Rows that start before ``year0`` rewrite from the shard of the first
+    row, keeping the states of that shard before it.
+    """
+    shard_dir = str(tmpdir.join('shards'))
+    os.makedirs(shard_dir)
+    cmds = equivalence.random_cmds(60, start='2012:300:00:00:00.000', seed=6,
+                                   mean_gap=1e6)
+    states = equivalence.reference_states(equivalence.random_state0(cmds),
+                                          cmds)
+    rows = update_cmd_states._as_rows(states)
+    years = [int(date[:4]) for date in states['datestart']]
+    manifest = shards.write_shards(shard_dir, rows)
+    assert len(manifest['shards']) >= 3
+
+    # Change the states from the middle of the second year on, but claim
+    # only the last year is replaced
+    year1 = sorted(set(years))[1]
+    i_cut = years.index(year1) + years.count(year1) // 2
+    new_rows = rows.copy()
+    new_rows['obsid'][i_cut:] += 1
+    new_manifest = shards.write_shards(shard_dir, new_rows[i_cut:],
+                                       year0=years[-1], manifest=manifest)
+    assert [shard['year'] for shard in new_manifest['shards']] == \
+        sorted(set(years))
+    assert new_manifest['shards'][0] == manifest['shards'][0]
+    new_states = shards.read_states(shard_dir, new_manifest)
+    assert np.concatenate([new_states[year] for year in sorted(new_states)]
+                          ).tolist() == new_rows.tolist()
+
+    # States out of time order are still refused
+    with pytest.raises(ValueError, match='time order'):
+        shards.write_shards(shard_dir, new_rows[::-1], manifest=new_manifest)
+
+
+def test_import_without_tables():
+    """Importing the package (and the shard readers) does not load PyTables.
+    """
+    code = ('import sys, chandra_cmd_states, chandra_cmd_states.shards; '
+            'print("tables" in sys.modules)')
+    env = dict(os.environ, SKA_ALLOW_DISCONTINUED_PACKAGES='1')
+    out = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', code],
+                                  env=env)
+    assert out.decode().split()[-1] == 'False'
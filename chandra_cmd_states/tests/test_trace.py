@@ -0,0 +1,43 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import logging
+
+from chandra_cmd_states import trace, cmd_set, generate_cmds_many, get_states, STATE0
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super(ListHandler, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def test_get_states_trace():
+    """Maneuver step trace events match the states and are only made when
+    the subsystem is enabled.
+    """
+    cmds = generate_cmds_many([
+        ('2012:010:00:00:00.000', cmd_set('manvr', 0.5, 0.5, 0.5, 0.5)),
+        ('2012:010:06:00:00.000', cmd_set('obsid', 50000))])
+    state0 = dict(STATE0, datestart='2012:009:00:00:00.000')
+
+    handler = ListHandler()
+    try:
+        trace.enable('maneuver_step', handler=handler)
+        assert trace.enabled('maneuver_step')
+        states = get_states(dict(state0), cmds)
+    finally:
+        trace.get_logger('maneuver_step').removeHandler(handler)
+        trace.get_logger('maneuver_step').propagate = True
+        trace.disable('all')
+    assert not trace.enabled('maneuver_step')
+
+    steps = [rec.trace_fields for rec in handler.records]
+    assert all(rec.trace_event == 'maneuver_step' for rec in handler.records)
+    assert len(steps) > 1
+    for step in steps:
+        state = states[states['datestart'] == step['date']][0]
+        assert state['q1'] == step['q1']
+        assert state['pitch'] == step['pitch']
+    assert str(handler.records[0].msg).startswith('maneuver_step: date=')
@@ -0,0 +1,93 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+import json
+import time
+import threading
+
+from chandra_cmd_states import cmd_states, update_cmd_states
+from chandra_cmd_states.metrics import Metrics
+from chandra_cmd_states.watch import Watcher, write_health
+
+from .test_queries import insert_npnt_states
+
+
+def test_watcher(tmpdir):
+    """Watcher returns at the poll interval, on a change (with inotify) or
+    when told to stop.
+    """
+    watcher = Watcher([str(tmpdir), str(tmpdir.join('missing'))], interval=0.2,
+                      settle=0.05)
+    assert watcher.mode in ('inotify', 'poll')
+    try:
+        t0 = time.time()
+        assert watcher.wait() is False
+        assert 0.2 <= time.time() - t0 < 2
+
+        watcher.interval = 10
+        t0 = time.time()
+        assert watcher.wait(should_stop=lambda: True) is False
+        assert time.time() - t0 < 1
+
+        if watcher.mode == 'inotify':
+            timer = threading.Timer(0.1, tmpdir.join('new.backstop').write,
+                                    args=('',))
+            timer.start()
+            t0 = time.time()
+            assert watcher.wait() is True
+            assert time.time() - t0 < 5
+            timer.join()
+    finally:
+        watcher.close()
+
+    filename = str(tmpdir.join('health.json'))
+    write_health(filename, {'status': 'ok', 'n_checks': 1})
+    with open(filename) as fh:
+        assert json.load(fh) == {'status': 'ok', 'n_checks': 1}
+
+
+def test_watcher_mark(tmpdir):
+    """Events that leave the watched paths as they were at the mark are
+    ignored, later changes are not.
+    """
+    watcher = Watcher([str(tmpdir)], interval=0.5, settle=0.05)
+    try:
+        tmpdir.join('cmd_states.db3').write('own write')
+        watcher.mark()
+        assert watcher.wait() is False
+
+        if watcher.mode == 'inotify':
+            timer = threading.Timer(0.1, tmpdir.join('cmd_states.db3').write,
+                                    args=('other write',))
+            timer.start()
+            watcher.interval = 10
+            assert watcher.wait() is True
+            timer.join()
+    finally:
+        watcher.close()
+
+
+def test_state0_checkpoint(cmd_db, monkeypatch):
+    """In watch mode the definitive state0 and the state before a change come
+    from the checkpoint without a query until the states change.
+    """
+    insert_npnt_states(cmd_db)
+    monkeypatch.setattr(cmd_states, '_get_definitive_date',
+                        lambda date_margin: '2012:080:06:00:00.000')
+    exp = cmd_states.get_state0(db=cmd_db)
+    exp_change = cmd_states.get_state0('2012:080:15:00:00.000', db=cmd_db,
+                                       date_margin=None)
+
+    opt, args = update_cmd_states.get_options(['--watch'])
+    updater = update_cmd_states.Updater(opt)
+    updater.db = cmd_db
+    metrics = Metrics()
+    assert updater.get_state0(metrics) == exp
+    assert metrics.counters['get_state0.checkpoint_hit'] == 0
+
+    cmd_db.execute('DELETE FROM cmd_states')
+    assert updater.get_state0(metrics) == exp
+    assert metrics.counters['get_state0.checkpoint_hit'] == 1
+    assert updater.checkpoint.get_state0('2012:080:15:00:00.000') == exp_change
+    assert updater.checkpoint.get_state0('2012:001:00:00:00.000') is None
+
+    updater.checkpoint = None
+    assert updater.get_state0(metrics) == cmd_states.STATE0
@@ -0,0 +1,130 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Structured, lazily formatted trace events for the commanded states engine.
+
+Each subsystem has a logger named ``chandra_cmd_states.trace.<subsystem>``:
+
+=============  ==========================================================
+Subsystem      Events
+=============  ==========================================================
+maneuver       start of each maneuver with the table of attitude steps
+maneuver_step  each attitude step of a maneuver
+pitch          each pitch sample outside of maneuvers
+=============  ==========================================================
+
+Events are emitted at DEBUG level, so running a tool with ``--loglevel=10``
+shows all of them as before.  A single subsystem can be enabled with
+:func:`enable` (or the ``CMD_STATES_TRACE`` environment variable, a
+comma-separated list of subsystems or ``all``) while leaving the rest of the
+logging at INFO.
+
+Code in a hot loop checks :func:`enabled` once before the loop and only then
+calls :func:`event`.  The event fields are passed as-is and only formatted if
+a handler actually emits the record.  Each record also carries the event name
+and fields as the ``trace_event`` and ``trace_fields`` attributes for use by
+structured (e.g. JSON) log handlers.
+"""
+
+import os
+import logging
+
+TRACE_LOGGER = 'chandra_cmd_states.trace'
+TRACE_ENV = 'CMD_STATES_TRACE'
+SUBSYSTEMS = ('maneuver', 'maneuver_step', 'pitch')
+
+
+class TraceEvent(object):
+    """
+    Log message for a trace event that is formatted only when emitted.
+
+    :param name: event name
+    :param fields: dict of event fields
+    """
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __str__(self):
+        lines = [self.name + ':']
+        tables = []
+        for key, val in self.fields.items():
+            if getattr(getattr(val, 'dtype', None), 'names', None):
+                tables.append((key, val))
+            else:
+                lines.append('{}={}'.format(key, val))
+        out = ' '.join(lines)
+        for key, val in tables:
+            import Ska.Numpy
+            out += '\n{}:\n{}'.format(key, Ska.Numpy.pformat(val))
+        return out
+
+
+def get_logger(subsystem):
+    """
+    Get the trace logger for ``subsystem``.
+
+    :param subsystem: subsystem name
+    :returns: logging.Logger
+    """
+    return logging.getLogger(TRACE_LOGGER + '.' + subsystem)
+
+
+def enabled(subsystem):
+    """
+    Return True if trace events for ``subsystem`` will be processed.
+
+    :param subsystem: subsystem name
+    """
+    return get_logger(subsystem).isEnabledFor(logging.DEBUG)
+
+
+def event(subsystem, name, **fields):
+    """
+    Emit trace event ``name`` for ``subsystem`` with ``fields``.
+
+    :param subsystem: subsystem name
+    :param name: event name
+    :param **fields: event fields
+    """
+    get_logger(subsystem).debug(TraceEvent(name, fields),
+                                extra={'trace_event': name,
+                                       'trace_fields': fields})
+
+
+def enable(subsystems='all', handler=None):
+    """
+    Enable trace events for ``subsystems``.  Events propagate to the root
+    logger handlers unless ``handler`` is given, in which case they go only to
+    ``handler``.
+
+    :param subsystems: list of subsystem names or comma-separated string of
+                       names, or 'all' (default)
+    :param handler: logging.Handler for the trace events (optional)
+    """
+    for subsystem in _subsystems(subsystems):
+        logger = get_logger(subsystem)
+        logger.setLevel(logging.DEBUG)
+        if handler is not None:
+            logger.addHandler(handler)
+            logger.propagate = False
+
+
+def disable(subsystems='all'):
+    """
+    Disable trace events for ``subsystems`` regardless of the root log level.
+
+    :param subsystems: list of subsystem names or comma-separated string of
+                       names, or 'all' (default)
+    """
+    for subsystem in _subsystems(subsystems):
+        get_logger(subsystem).setLevel(logging.INFO)
+
+
+def _subsystems(subsystems):
+    if isinstance(subsystems, str):
+        subsystems = [x.strip() for x in subsystems.split(',')]
+    return SUBSYSTEMS if 'all' in subsystems else subsystems
+
+
+if os.environ.get(TRACE_ENV):
+    enable(os.environ[TRACE_ENV])
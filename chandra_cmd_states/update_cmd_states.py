@@ -1,8 +1,11 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 import sys
 import os
+import json
 import logging
 import time
+import bisect
+import shutil
 from itertools import count
 from six.moves import zip
 
@@ -10,9 +13,20 @@ from six.moves import zip
 import numpy as np
 import tables
 import Ska.DBI
+import Ska.Numpy
+import Ska.Sun
+from Chandra.Time import DateTime
 
 
 from . import cmd_states
+from . import queries
+from . import fingerprint
+from . import h5store
+from . import anchors
+from . import shards
+from .metrics import Metrics
+from .watch import Watcher, StopFlag, write_health
+from .profiling import profiled, PROFILE_HELP
 
 CMD_STATES_DTYPE = [('datestart', '|S21'),
                     ('datestop', '|S21'),
@@ -41,6 +55,13 @@ CMD_STATES_DTYPE = [('datestart', '|S21'),
                     ('letg', '|S4'),
                     ('dither', '|S4')]
 
+# Same as CMD_STATES_DTYPE with unicode strings, for database inserts and the
+# update journal
+CMD_STATES_UDTYPE = [(name, fmt.replace('|S', '<U'))
+                     for name, fmt in CMD_STATES_DTYPE]
+
+JOURNAL_VERSION = 1
+
 
 def log_mismatch(mismatches, db_states, states, i_diff):
     """Log the states and state differences leading to a diff between the
@@ -135,17 +156,31 @@ def get_states_i_diff(db_states, states):
     return i_diff
 
 
-def update_states_db(states, db, h5):
+def update_states_db(states, db, h5, metrics=None, journal_file=None,
+                     publish=None):
     """Make the ``db`` database cmd_states table consistent with the supplied
     ``states``.  Match ``states`` to corresponding values in cmd_states
     tables, then delete from table at the point of a mismatch (if any).
 
+    If ``journal_file`` is given the update is first recorded there (see
+    :func:`write_journal`), then applied to the HDF5 table and to the database
+    in one transaction, and the journal is removed once both are done.  If
+    the update fails midway :func:`recover_journal` can finish or undo it.
+
     :param states: input states (numpy recarray)
     :param db: Ska.DBI.DBI object
     :param h5: HDF5 object holding commanded states table (as h5.root.data)
+    :param metrics: Metrics object for stage timing and counters (optional)
+    :param journal_file: update journal file name (optional)
+    :param publish: function called once both tables are updated and before
+                    the journal is removed, e.g. to swap a new HDF5 snapshot
+                    into place (optional)
 
     :rtype: None
     """
+    if metrics is None:
+        metrics = Metrics()
+
     # If input states list is empty then no update needed
     if len(states) == 0:
         raise ValueError('Unexpected input of an empty states table in '
@@ -156,27 +191,53 @@ def update_states_db(states, db, h5):
         make_hdf5_cmd_states(db, h5)
 
     # Get existing cmd_states from the database that overlap with states
-    db_states = db.fetchall("""SELECT * from cmd_states
-                               WHERE datestop > '%s'
-                               AND datestart < '%s'""" %
-                               (states[0].datestart, states[-1].datestop))
+    with metrics.stage('update_states_db.compare'):
+        db_states = db.fetchall(queries.cmd_states_overlap(
+            states[0].datestart, states[-1].datestop))
+        i_diff = get_states_i_diff(db_states, states) if len(db_states) else 0
+    metrics.count('update_states_db.db_states', len(db_states))
+
+    if len(db_states) > 0 and i_diff is None:
+        logging.debug('update_states_db: No database update required')
+        return False
+
+    if journal_file:
+        # Replace the states from the first mismatch (or the end of the
+        # existing states) onward.
+        if i_diff < len(db_states):
+            cut_date = db_states['datestart'][i_diff]
+        else:
+            cut_date = states['datestart'][i_diff]
+        rows = _as_rows(states[i_diff:], CMD_STATES_UDTYPE)
+        old_rows = _as_rows(db_states[i_diff:], CMD_STATES_UDTYPE)
+        with metrics.stage('update_states_db.journal'):
+            write_journal(journal_file, cut_date, rows, old_rows)
+        with metrics.stage('update_states_db.apply'):
+            replace_cmd_states(cut_date, rows, db, h5)
+            if publish:
+                publish()
+        os.remove(journal_file)
+        metrics.count('update_states_db.deleted_states', len(old_rows))
+        metrics.count('update_states_db.inserted_states', len(rows))
+        return True
 
     if len(db_states) > 0:
-        i_diff = get_states_i_diff(db_states, states)
-        if i_diff is None:
-            logging.debug('update_states_db: No database update required')
-            return False
 
         # Mismatch occurred at i_diff.  If that index is within db_states
         # (cases 1 and 4 in get_states_i_diff) drop db_states after
         # db_states['datesstart'][i_diff]
         if i_diff < len(db_states):
-            delete_cmd_states(db_states['datestart'][i_diff], db, h5)
-    else:
-        # No cmd_states in database so just insert all new states
-        i_diff = 0
-
-    insert_cmd_states(states, i_diff, db, h5)
+            with metrics.stage('update_states_db.delete'):
+                delete_cmd_states(db_states['datestart'][i_diff], db, h5)
+            metrics.count('update_states_db.deleted_states',
+                          len(db_states) - i_diff)
+    # else: no cmd_states in database so just insert all new states
+
+    with metrics.stage('update_states_db.insert'):
+        insert_cmd_states(states, i_diff, db, h5)
+    metrics.count('update_states_db.inserted_states', len(states) - i_diff)
+    if publish:
+        publish()
 
     return True  # States were changed
 
@@ -189,9 +250,15 @@ def delete_cmd_states(datestart, db, h5):
     # Delete rows from HDF5 table.  It can happen (mostly during testing) that
     # the h5 file doesn't yet have the data attribute yet, meaning it hasn't
     # been initialized with cmd_states data.
-    if h5 and hasattr(h5.root, 'data'):
+    if h5 and h5store.is_versioned(h5):
+        h5store.cut(h5, datestart, DateTime(datestart).secs)
+        logging.info('update_states_db: superseded HDF5 cmd_states from {}'
+                     .format(datestart))
+    elif h5 and hasattr(h5.root, 'data'):
         h5d = h5.root.data
-        idxs = h5d.getWhereList("datestart >= '{}'".format(datestart))
+        get_where_list = (getattr(h5d, 'get_where_list', None)
+                          or h5d.getWhereList)
+        idxs = get_where_list("datestart >= b'{}'".format(datestart))
 
         # Be paranoid and do a couple of consistency checks here because we
         # are always deleting from a row index to the end of the table.
@@ -218,7 +285,8 @@ def delete_cmd_states(datestart, db, h5):
             logging.info('update_states_db: '
                          'removed HDF5 cmd_states rows from {} to {}'
                          .format(idxs[0], h5d.nrows - 1))
-            h5d.removeRows(idxs[0], h5d.nrows)
+            remove_rows = getattr(h5d, 'remove_rows', None) or h5d.removeRows
+            remove_rows(idxs[0], h5d.nrows)
         else:
             # Remove all rows from file.  HDF5 cannot support this so just
             # issue a non-fatal error that will generate a warning email.
@@ -227,8 +295,7 @@ def delete_cmd_states(datestart, db, h5):
         h5d.flush()
 
     # Delete rows from database table
-    cmd = ("DELETE FROM cmd_states WHERE datestart >= '{}'"
-           .format(datestart))
+    cmd = queries.delete_cmd_states(datestart)
     logging.info('update_states_db: ' + cmd)
     db.execute(cmd)
 
@@ -240,18 +307,12 @@ def insert_cmd_states(states, i_diff, db, h5):
     # goes wrong then it is more likely the two tables will remain
     # consistent.
     if h5 and hasattr(h5.root, 'data'):
-        h5d = h5.root.data
         logging.info('update_states_db: '
                      'inserting states[{}:{}] to HDF5 cmd_states'
                      .format(i_diff, len(states)))
         # Create new struct array from states which is in the column
         # order required to append to h5d.
-        sdiff = states[i_diff:]
-        rows = np.empty(len(sdiff), dtype=CMD_STATES_DTYPE)
-        for name in rows.dtype.names:
-            rows[name][:] = sdiff[name]
-        h5d.append(rows)
-        h5d.flush()
+        h5store.append(h5, _as_rows(states[i_diff:]))
 
     logging.info('update_states_db: '
                  'inserting states[{}:{}] to database cmd_states'
@@ -267,45 +328,202 @@ def insert_cmd_states(states, i_diff, db, h5):
         make_hdf5_cmd_states(db, h5)
 
 
-def make_hdf5_cmd_states(db, h5):
+def _as_rows(states, dtype=CMD_STATES_DTYPE):
+    """Convert ``states`` to a structured array of cmd_states table rows"""
+    rows = np.empty(len(states), dtype=dtype)
+    for name in rows.dtype.names:
+        rows[name][:] = states[name]
+    return rows
+
+
+def write_journal(journal_file, cut_date, rows, old_rows):
+    """Record an update of the cmd_states tables in ``journal_file``: delete
+    the states with datestart >= ``cut_date`` and insert ``rows``.  The
+    ``old_rows`` being replaced are kept so the update can also be undone.
+
+    The journal is a single numpy .npz file that is written to a temporary
+    file, synced to disk and then renamed, so it either exists complete or
+    not at all.
+
+    :param journal_file: journal file name
+    :param cut_date: datestart of the first replaced state
+    :param rows: new cmd_states rows
+    :param old_rows: cmd_states rows being replaced
+    """
+    meta = json.dumps({'version': JOURNAL_VERSION,
+                       'cut_date': str(cut_date),
+                       'created': time.strftime('%Y-%m-%dT%H:%M:%S')})
+    tmp_file = journal_file + '.tmp'
+    with open(tmp_file, 'wb') as fh:
+        np.savez(fh, meta=np.array(meta), rows=rows, old_rows=old_rows)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp_file, journal_file)
+    logging.debug('update_states_db: wrote journal {} for {} states from {}'
+                  .format(journal_file, len(rows), cut_date))
+
+
+def read_journal(journal_file):
+    """Read the cmd_states update recorded in ``journal_file``.
+
+    :param journal_file: journal file name
+    :returns: (cut_date, rows, old_rows) or None if there is no journal
+    """
+    if not os.path.exists(journal_file):
+        return None
+    with np.load(journal_file, allow_pickle=False) as journal:
+        meta = json.loads(str(journal['meta']))
+        if meta['version'] != JOURNAL_VERSION:
+            raise ValueError('unexpected version {} of journal {}'
+                             .format(meta['version'], journal_file))
+        return meta['cut_date'], journal['rows'], journal['old_rows']
+
+
+def replace_cmd_states(cut_date, rows, db, h5):
+    """Replace the cmd_states with datestart >= ``cut_date`` by ``rows`` in
+    the HDF5 table ``h5.root.data`` and in the ``db`` table.  This gives the
+    same result when repeated, so an update that failed partway can simply
+    be applied again.
+
+    :param cut_date: datestart of the first replaced state
+    :param rows: new cmd_states rows
+    :param db: Ska.DBI.DBI object
+    :param h5: HDF5 object holding commanded states table (or None)
+    """
+    if h5 and h5store.is_versioned(h5):
+        # Append-only: supersede the replaced states and append the new ones
+        h5store.cut(h5, cut_date, DateTime(cut_date).secs)
+        h5store.append(h5, _as_rows(rows))
+        logging.info('update_states_db: superseded HDF5 cmd_states from {} '
+                     'with {} states'.format(cut_date, len(rows)))
+    elif h5 and hasattr(h5.root, 'data'):
+        h5d = h5.root.data
+        get_where_list = (getattr(h5d, 'get_where_list', None)
+                          or h5d.getWhereList)
+        idxs = np.sort(get_where_list("datestart >= b'{}'".format(cut_date)))
+        if len(idxs) > 0:
+            # States are always replaced from a row to the end of the table.
+            # Anything else means the table is out of order so stop before
+            # touching either table.
+            if (idxs[-1] != h5d.nrows - 1
+                    or np.any(np.diff(idxs) != 1)):
+                raise ValueError('HDF5 cmd_states table is not ordered by '
+                                 'datestart after {}'.format(cut_date))
+            if idxs[0] > 0:
+                remove_rows = (getattr(h5d, 'remove_rows', None)
+                               or h5d.removeRows)
+                remove_rows(idxs[0], h5d.nrows)
+                h5d.append(_as_rows(rows))
+                h5d.flush()
+            else:
+                # HDF5 cannot delete all rows of a table so make a new one
+                h5store.remove_tables(h5)
+                h5store.create_tables(h5, _as_rows(rows))
+        elif len(rows) > 0:
+            h5d.append(_as_rows(rows))
+            h5d.flush()
+        logging.info('update_states_db: replaced HDF5 cmd_states from {} '
+                     'with {} states'.format(cut_date, len(rows)))
+
+    # Database delete and inserts in one transaction.  Sybase needs a commit
+    # for each insert (very large transactions fail) but the journal still
+    # allows the update to be finished or undone.
+    cmd = queries.delete_cmd_states(cut_date)
+    logging.info('update_states_db: ' + cmd)
+    db.execute(cmd, commit=False)
+    names = rows.dtype.names
+    for row in rows.tolist():
+        db.insert(dict(zip(names, row)), 'cmd_states',
+                  commit=(db.dbi == 'sybase'))
+    db.commit()
+    logging.info('update_states_db: inserted {} states to database cmd_states'
+                 .format(len(rows)))
+
+    if h5 and not hasattr(h5.root, 'data'):
+        make_hdf5_cmd_states(db, h5)
+
+
+def recover_journal(journal_file, db, h5, action='forward', publish=None):
+    """Finish (``action='forward'``) or undo (``action='back'``) a cmd_states
+    update that was recorded in ``journal_file`` but not completed, then
+    remove the journal.
+
+    :param journal_file: journal file name
+    :param db: Ska.DBI.DBI object
+    :param h5: HDF5 object holding commanded states table (or None)
+    :param action: forward|back
+    :param publish: function called before the journal is removed (optional)
+    :returns: True if an update was recovered
+    """
+    if action not in ('forward', 'back'):
+        raise ValueError("action must be 'forward' or 'back'")
+    journal = read_journal(journal_file)
+    if journal is None:
+        return False
+
+    cut_date, rows, old_rows = journal
+    logging.warning('WARNING: found unfinished cmd_states update {} from {}, '
+                    'rolling {}'.format(journal_file, cut_date, action))
+    replace_cmd_states(cut_date, rows if action == 'forward' else old_rows,
+                       db, h5)
+    if publish:
+        publish()
+    os.remove(journal_file)
+    return True
+
+
+def make_hdf5_cmd_states(db, h5, versioned=False):
     """Make a new HDF5 command states table in ``h5`` from the existing
     database version.
+
+    :param db: Ska.DBI.DBI object
+    :param h5: HDF5 file object
+    :param versioned: use the versioned (append-only) layout (see
+                      :mod:`chandra_cmd_states.h5store`)
     """
     # This takes a little while...
     logging.info('Reading cmd_states table from {}, stand by ..'.format(db.server))
     db_rows = db.fetchall('select * from cmd_states')
-    if len(db_rows) == 0:
+    if len(db_rows) == 0 and not versioned:
         # Need some initial data in SQL version so just return
         logging.info('No values in SQL db so doing nothing')
         return
 
     logging.info('Creating HDF5 cmd_states table ..')
-    rows = np.empty(len(db_rows), dtype=CMD_STATES_DTYPE)
-    for name in rows.dtype.names:
-        rows[name][:] = db_rows[name]
-    h5.createTable(h5.root, 'data', rows,
-                   "Cmd_states", expectedrows=5e5)
-    h5.flush()
+    h5store.create_tables(h5, _as_rows(db_rows), versioned=versioned)
     logging.info('HDF5 cmd_states table successfully created')
 
 
-def check_consistency(db, h5, n_check=3000):
+def check_consistency(db, h5, n_check=3000, datestart=None):
     """Check that the cmd_states table in ``db`` has the same length and
     final datestart.
+
+    :param db: Ska.DBI.DBI object
+    :param h5: HDF5 object holding commanded states table
+    :param n_check: number of final states to compare
+    :param datestart: compare only the database states from this date, for
+                      an HDF5 table holding only the later states (e.g. the
+                      latest shards)
     """
     h5d = h5.root.data
+    rows = h5store.live_rows(h5)
+    where = (" where datestart >= '{}'".format(datestart) if datestart
+             else '')
 
     # Check that lengths match
-    db_len = db.fetchone('select count(*) as cnt from cmd_states')['cnt']
-    h5d_len = h5d.nrows
+    db_len = db.fetchone('select count(*) as cnt from cmd_states'
+                         + where)['cnt']
+    h5d_len = len(rows)
     if db_len != h5d_len:
         logging.error('ERROR: database and HDF5 commands '
                       'states have different length {} vs {}'
                       .format(db_len, h5d_len))
 
     # check that the last n_check rows are the same
-    db_rows = db.fetch('select * from cmd_states order by datestart desc')
-    h5_rows = h5d[-n_check:][::-1]
+    db_rows = db.fetch('select * from cmd_states' + where
+                       + ' order by datestart desc')
+    h5_rows = h5store.read_rows(h5d, rows[-n_check:])[::-1]
+    h5_rows = h5_rows.astype(CMD_STATES_UDTYPE)
     all_ok = True
     for db_row, h5_row in zip(db_rows, h5_rows):
         row_ok = True
@@ -326,11 +544,551 @@ def check_consistency(db, h5, n_check=3000):
                       'mismatch starting at {}'.format(datestart_mismatch))
 
 
-def get_options():
+class State0Checkpoint(object):
+    """
+    The NPNT states from the definitive ``date`` on, plus the last one
+    before it, read from the cmd_states table of ``db``.  In watch mode this
+    is kept between updates, so that the definitive state0 and the state
+    before an input change (see :func:`get_changed_state0`) are found without
+    a query until an update changes the states.
+
+    :param db: Ska.DBI.DBI object
+    :param date: definitive date
+    """
+    def __init__(self, db, date):
+        self.state0 = db.fetchone(queries.state0(date, dbi=db.dbi))
+        npnt_states = db.fetchall(queries.npnt_states(date))
+        names = npnt_states.dtype.names
+        self.states = [dict(zip(names, row)) for row in npnt_states.tolist()]
+        self.dates = [state['datestop'] for state in self.states]
+
+    def get_state0(self, date):
+        """Get the last NPNT state with datestop before ``date``, like
+        ``cmd_states.get_state0(date, date_margin=None)``.
+
+        :param date: date string
+        :returns: state0 dict or None if ``date`` is before the checkpoint
+        """
+        if self.state0 is not None and date <= self.state0['datestop']:
+            return None
+        idx = bisect.bisect_left(self.dates, date)
+        if idx > 0:
+            return dict(self.states[idx - 1])
+        return dict(self.state0 or cmd_states.STATE0)
+
+
+def get_changed_state0(state0, db, opt, old_fingerprint, checkpoint=None):
+    """Get the state0 for an update starting at the earliest change in the
+    update inputs (timeline loads, non-load commands and backstop files) since
+    the last update with fingerprint ``old_fingerprint``.  The update window
+    starts at the definitive ``state0``.
+
+    :param state0: definitive state0 at the start of the update window
+    :param db: Ska.DBI.DBI object
+    :param opt: command line options
+    :param old_fingerprint: fingerprint of the last update (None to update
+                            the whole window)
+    :param checkpoint: State0Checkpoint for finding the state before the
+                       change without a query (optional)
+    :returns: (state0 or None if nothing changed, current fingerprint)
+    """
+    import chandra_cmd_states
+
+    meta = {'dbi': opt.dbi, 'server': opt.server, 'database': opt.database,
+            'mp_dir': opt.mp_dir, 'h5file': opt.h5file,
+            'version': chandra_cmd_states.__version__}
+    new_fingerprint = fingerprint.get_fingerprint(db, state0['datestart'],
+                                                  opt.mp_dir, meta)
+    date_change = fingerprint.earliest_change(old_fingerprint, new_fingerprint)
+    if date_change is None:
+        return None, new_fingerprint
+
+    # Anchor on the last NPNT state before the change, if that is later than
+    # the definitive state0.
+    anchor = checkpoint and checkpoint.get_state0(date_change)
+    if anchor is None:
+        anchor = cmd_states.get_state0(date=date_change, db=db,
+                                       date_margin=None)
+    if anchor['datestart'] > state0['datestart']:
+        state0 = anchor
+    logging.info('Earliest input change at {}, updating from state at {}'
+                 .format(date_change, state0['datestart']))
+
+    return state0, new_fingerprint
+
+
+def update_states(state0, db, h5, opt, metrics, journal_file=None,
+                  publish=None):
+    """Update the cmd_states table in ``db`` and ``h5`` with the states from
+    the commands after ``state0``.
+
+    :param state0: initial state
+    :param db: Ska.DBI.DBI object
+    :param h5: HDF5 object holding commanded states table (or None)
+    :param opt: command line options
+    :param metrics: Metrics object for stage timing and counters
+    :param journal_file: update journal file name (optional)
+    :param publish: function called once the tables are updated (optional)
+    :returns: True if states were changed
+    """
+    # Sync up datestart to state0 and get timeline load segments including
+    # state0 and beyond.
+    datestart = state0['datestart']
+    logging.debug('Getting timeline_loads after %s' % datestart)
+    with metrics.stage('timeline_loads'):
+        timeline_loads = db.fetchall(queries.timeline_loads(datestart))
+    logging.debug('Found %s timeline_loads' % len(timeline_loads))
+    metrics.set('timeline_loads', len(timeline_loads))
+
+    # Get cmds since datestart.  If needed add cmds to database
+    logging.debug('Getting cmds after %s' % datestart)
+    with metrics.stage('get_cmds'):
+        cmds = cmd_states.get_cmds_table(datestart, db=db, update_db=True,
+                                         timeline_loads=timeline_loads,
+                                         mp_dir=opt.mp_dir, metrics=metrics)
+    logging.debug('Found %s cmds after %s' % (len(cmds), datestart))
+    metrics.set('get_cmds.cmds', len(cmds))
+
+    # Get the states generated by cmds starting from state0
+    logging.debug('Generating cmd_states after %s' % datestart)
+    with metrics.stage('get_states'):
+        states = cmd_states.get_states(state0, cmds, metrics=metrics)
+    logging.debug('Found %s states after %s' % (len(states), datestart))
+
+    # Update cmd_states in database
+    logging.debug('Updating database cmd_states table')
+    with metrics.stage('update_states_db'):
+        states_changed = update_states_db(states, db, h5, metrics=metrics,
+                                          journal_file=journal_file,
+                                          publish=publish)
+    metrics.set('states_changed', int(states_changed))
+
+    return states_changed
+
+
+class Updater(object):
+    """
+    Commanded states updater for the command line options ``opt``.  The
+    database connection and fingerprint of the last update are kept between
+    calls of :meth:`update`, and in watch mode also a
+    :class:`State0Checkpoint` until an update changes the states, so each
+    check only costs the queries and processing for what changed.  The HDF5
+    file is closed and the writer lock released after each update, since
+    each update is made to a new snapshot of the file.
+
+    Each update of the tables is journaled (see :func:`update_states_db`) and
+    an update left unfinished by a crash is rolled forward (or back, with
+    ``--recover=back``) before the next one.
+
+    Unless ``--no-snapshot`` is given the HDF5 file is never changed in
+    place, whatever its layout.  Each update is made to a copy (the snapshot,
+    ``<h5file>.new``), which is then renamed over ``h5file``.  Readers that
+    already have the file open keep reading the previous version and new
+    readers get the new one, so none of them sees a partly updated table or
+    a write lock.
+
+    With ``--shard-dir`` the HDF5 states are kept as one file per year (see
+    :mod:`chandra_cmd_states.shards`).  Each update is made to a working file
+    with the states of the shards from the year of the update start on
+    (normally just the current year), which is then split back into new
+    shard files for the years that changed and published with a new
+    manifest.
+
+    :param opt: command line options
+    """
+    def __init__(self, opt):
+        self.opt = opt
+        self.db = None
+        self.h5 = None
+        self.snapshot_file = None
+        self.manifest = None
+        self.shard_year0 = 0
+        self.checkpoint = None
+        # Base name of the lock, fingerprint and journal files
+        h5file = (os.path.join(opt.shard_dir, 'cmd_states.h5')
+                  if opt.shard_dir else opt.h5file)
+        self.lock = h5store.WriterLock(h5file) if h5file else None
+        self.datestart = opt.datestart
+        self.fingerprint_file = opt.fingerprint_file
+        if self.fingerprint_file is None and h5file:
+            self.fingerprint_file = (os.path.splitext(h5file)[0]
+                                     + '.fingerprint.json')
+        self.journal_file = opt.journal_file
+        if self.journal_file is None and h5file:
+            self.journal_file = (os.path.splitext(h5file)[0]
+                                 + '.journal.npz')
+        self.fingerprint = None
+        if self.fingerprint_file and not (opt.full or opt.datestart):
+            self.fingerprint = fingerprint.read_fingerprint(
+                self.fingerprint_file)
+
+    def invalidate_anchors(self, datestart):
+        """Drop the days from ``datestart`` on from the ``--anchor-cache``
+        file, if any, since the states there may have changed.
+
+        :param datestart: start date of the changed states
+        """
+        if self.opt.anchor_cache:
+            anchor_cache = anchors.AnchorCache(self.opt.anchor_cache)
+            n_dropped = anchor_cache.invalidate(datestart)
+            anchor_cache.save()
+            logging.debug('Dropped {} days from {} in {}'
+                          .format(n_dropped, datestart, self.opt.anchor_cache))
+
+    def get_state0(self, metrics):
+        """Get the state0 at the start of the update window: the state
+        containing ``--datestart``, or else the definitive state0.  In watch
+        mode the definitive state0 is taken from the checkpoint, which is
+        read from the database when needed.
+
+        :param metrics: Metrics object for stage timing and counters
+        :returns: state0 dict
+        """
+        if self.datestart is not None or not self.opt.watch:
+            return cmd_states.get_state0(date=self.datestart, db=self.db)
+
+        date = cmd_states._get_definitive_date(10)
+        state0 = self.checkpoint and self.checkpoint.get_state0(date)
+        metrics.set('get_state0.checkpoint_hit', int(state0 is not None))
+        if state0 is None:
+            self.checkpoint = State0Checkpoint(self.db, date)
+            state0 = self.checkpoint.get_state0(date)
+        return state0
+
+    def connect(self):
+        """Connect to the database if not already connected"""
+        if self.db is None:
+            opt = self.opt
+            logging.debug('Connecting to db: dbi=%s server=%s user=%s '
+                          'database=%s'
+                          % (opt.dbi, opt.server, opt.user, opt.database))
+            self.db = Ska.DBI.DBI(dbi=opt.dbi, server=opt.server,
+                                  user=opt.user, database=opt.database,
+                                  verbose=False)
+            if opt.dbi == 'sqlite':
+                self.db.conn.text_factory = str
+
+    def open_h5(self, mode='a', datestart=None):
+        """Open the HDF5 cmd_states file if needed and not already open.  For
+        writing (``mode='a'``) take the writer lock (waiting for e.g. a
+        running ``repack_cmd_states``) and open a new snapshot copy of the
+        file unless ``--no-snapshot`` was given.
+
+        :param mode: 'a' to update the file or 'r' to read it
+        :param datestart: start of the update, which selects the shards
+                          copied to the working file with ``--shard-dir``
+        """
+        tables_open_file = (getattr(tables, 'open_file', None)
+                            or tables.openFile)
+        if self.h5 is None and self.opt.shard_dir:
+            if mode == 'a':
+                if not os.path.exists(self.opt.shard_dir):
+                    os.makedirs(self.opt.shard_dir)
+                self.lock.acquire()
+                self.open_shards(datestart)
+            else:
+                self.h5 = tables_open_file(self.snapshot_file, mode='r')
+        elif self.h5 is None and self.opt.h5file:
+            filename = self.opt.h5file
+            if mode == 'a':
+                self.lock.acquire()
+            if mode == 'a' and not self.opt.no_snapshot:
+                self.snapshot_file = filename + '.new'
+                if os.path.exists(filename):
+                    shutil.copyfile(filename, self.snapshot_file)
+                elif os.path.exists(self.snapshot_file):
+                    os.remove(self.snapshot_file)
+                filename = self.snapshot_file
+            filters = tables.Filters(complevel=5, complib='zlib')
+            self.h5 = tables_open_file(filename, mode=mode, filters=filters)
+
+    def open_shards(self, datestart=None):
+        """Open a new working file with the states of the shards for the year
+        of ``datestart`` and later (all shards for None).  If there are no
+        shards yet the working file is left empty and filled from the
+        database by the update.
+
+        :param datestart: start of the update
+        """
+        shard_dir = self.opt.shard_dir
+        self.manifest = shards.read_manifest(shard_dir)
+        self.shard_year0 = (int(datestart[:4])
+                            if datestart and self.manifest else 0)
+        self.snapshot_file = os.path.join(shard_dir, 'cmd_states_work.h5')
+        filters = tables.Filters(complevel=5, complib='zlib')
+        tables_open_file = (getattr(tables, 'open_file', None)
+                            or tables.openFile)
+        self.h5 = tables_open_file(self.snapshot_file, mode='w',
+                                   filters=filters)
+        if self.manifest is not None:
+            states = shards.read_states(shard_dir, self.manifest,
+                                        self.shard_year0)
+            rows = (np.concatenate([states[year] for year in sorted(states)])
+                    if states else np.zeros(0, dtype=CMD_STATES_DTYPE))
+            h5store.create_tables(self.h5, rows)
+            logging.info('Updating {} states of the shards from {} on'
+                         .format(len(rows), self.shard_year0))
+
+    def publish_shards(self):
+        """Split the updated working file into new shard files for the years
+        that changed and publish them in a new manifest.  The working file is
+        reopened read-only and removed by :meth:`close_h5`.
+        """
+        if self.h5.mode == 'r' or not hasattr(self.h5.root, 'data'):
+            return
+        rows = self.h5.root.data.read()
+        self.h5.close()
+        self.h5 = None
+        self.manifest = shards.write_shards(self.opt.shard_dir, rows,
+                                            self.shard_year0, self.manifest)
+        logging.info('Published generation {} of the shards in {}'
+                     .format(self.manifest['generation'], self.opt.shard_dir))
+        self.open_h5(mode='r')
+
+    def publish_h5(self):
+        """Swap the updated HDF5 snapshot in place of the HDF5 cmd_states file
+        and reopen the file read-only.  Does nothing without a snapshot.
+        """
+        if self.opt.shard_dir:
+            self.publish_shards()
+            return
+        if self.snapshot_file is None:
+            return
+        self.h5.close()
+        self.h5 = None
+        with open(self.snapshot_file, 'rb') as fh:
+            os.fsync(fh.fileno())
+        os.replace(self.snapshot_file, self.opt.h5file)
+        self.snapshot_file = None
+        logging.info('Published new version of {}'.format(self.opt.h5file))
+        self.open_h5(mode='r')
+
+    def close_h5(self):
+        """Close the HDF5 file, discard an unpublished snapshot and release
+        the writer lock"""
+        if self.h5 is not None:
+            self.h5.close()
+            self.h5 = None
+        if self.snapshot_file is not None:
+            if os.path.exists(self.snapshot_file):
+                os.remove(self.snapshot_file)
+            self.snapshot_file = None
+        if self.lock is not None:
+            self.lock.release()
+
+    def close(self):
+        """Close the database connection and HDF5 file"""
+        self.checkpoint = None
+        if self.db is not None:
+            self.db.conn.close()
+            self.db = None
+        self.close_h5()
+
+    def make_versioned(self):
+        """Convert the open HDF5 file to the versioned (append-only) layout,
+        or create it from the database if it has no cmd_states table.
+
+        :returns: True if the file was changed
+        """
+        if self.h5 is None or h5store.is_versioned(self.h5):
+            return False
+        if hasattr(self.h5.root, 'data'):
+            logging.info('Converting {} to the versioned layout'
+                         .format(self.opt.h5file))
+            h5store.compact(self.h5, versioned=True)
+        else:
+            make_hdf5_cmd_states(self.db, self.h5, versioned=True)
+        return True
+
+    def compact(self, metrics):
+        """Rewrite the HDF5 cmd_states table with only the live states,
+        dropping the states superseded by updates of the versioned layout.
+
+        :param metrics: Metrics object for stage timing and counters
+        """
+        self.open_h5()
+        try:
+            if self.h5 is None or not hasattr(self.h5.root, 'data'):
+                return
+            with metrics.stage('compact'):
+                n_dropped = h5store.compact(
+                    self.h5, versioned=self.opt.append_only or None)
+            metrics.set('compact.dropped_rows', n_dropped)
+            logging.info('Compacted {}: dropped {} superseded states'
+                         .format(self.opt.h5file, n_dropped))
+            self.publish_h5()
+        finally:
+            self.close_h5()
+
+    def update(self, metrics):
+        """
+        Update cmd_states from the earliest change in the inputs since the
+        last update.
+
+        :param metrics: Metrics object for stage timing and counters
+        :returns: None if the inputs did not change, else True if states
+                  were changed
+        """
+        self.connect()
+
+        # Finish or undo an update that was interrupted.  The fingerprint
+        # was not written for it so the inputs are still seen as changed.
+        if self.journal_file and os.path.exists(self.journal_file):
+            datestart = read_journal(self.journal_file)[0]
+            self.open_h5(datestart=datestart)
+            with metrics.stage('recover_journal'):
+                recover_journal(self.journal_file, self.db, self.h5,
+                                action=self.opt.recover,
+                                publish=self.publish_h5)
+            metrics.set('recovered_journal', 1)
+            self.close_h5()
+            self.invalidate_anchors(datestart)
+            self.checkpoint = None
+
+        # Get initial state containing the specified datestart
+        logging.debug('Getting initial state0')
+        with metrics.stage('get_state0'):
+            state0 = self.get_state0(metrics)
+        logging.debug('Initial state0: datestart=%s datestop=%s obsid=%d' %
+                      (state0['datestart'], state0['datestop'],
+                       state0['obsid']))
+
+        # Compare the inputs in the update window to those of the last update
+        # and start from the state before the earliest change, or stop right
+        # here if nothing changed.
+        if self.fingerprint_file:
+            with metrics.stage('fingerprint'):
+                state0, new_fingerprint = get_changed_state0(
+                    state0, self.db, self.opt, self.fingerprint,
+                    self.checkpoint)
+            metrics.set('inputs_changed', int(state0 is not None))
+            if state0 is None:
+                logging.info('No change in timelines, non-load commands or '
+                             'backstop files since last update')
+                return None
+
+        self.open_h5(datestart=state0['datestart'])
+        try:
+            converted = ((self.opt.append_only and self.make_versioned())
+                         or (self.opt.shard_dir and self.manifest is None))
+            states_changed = update_states(state0, self.db, self.h5, self.opt,
+                                           metrics,
+                                           journal_file=self.journal_file,
+                                           publish=self.publish_h5)
+            if converted:
+                self.publish_h5()
+            if self.h5 and hasattr(self.h5.root, 'data'):
+                # Check for consistency between HDF5 and SQL.  The working
+                # file of a sharded update has only the latest shards.
+                n_check = 3000 if states_changed else 100
+                datestart = None
+                if self.opt.shard_dir and self.h5.root.data.nrows:
+                    datestart = self.h5.root.data[0]['datestart'].decode()
+                with metrics.stage('check_consistency'):
+                    check_consistency(self.db, self.h5, n_check,
+                                      datestart=datestart)
+        finally:
+            # A new snapshot is made for each update, and the writer lock is
+            # not held between updates in watch mode
+            self.close_h5()
+        if states_changed:
+            self.invalidate_anchors(state0['datestart'])
+            self.checkpoint = None
+
+        # Record the inputs only now that the update succeeded.  Later
+        # updates start from the default (definitive) state0.
+        if self.fingerprint_file:
+            fingerprint.write_fingerprint(self.fingerprint_file,
+                                          new_fingerprint)
+            self.fingerprint = new_fingerprint
+        self.datestart = None
+
+        return states_changed
+
+
+def get_watch_paths(opt):
+    """Get the paths to watch for changes in the update inputs: the sqlite
+    database file, the MP directory and its directories for this year and
+    next year (where new load directories appear).
+    """
+    year = int(time.strftime('%Y'))
+    paths = [os.path.join(opt.mp_dir, str(year + i)) for i in (0, 1)]
+    paths.append(opt.mp_dir)
+    if opt.dbi == 'sqlite':
+        paths.append(opt.server)
+    return paths
+
+
+def watch(updater, opt):
+    """Run ``updater`` whenever the inputs change, or at least every
+    ``opt.poll_interval`` seconds, until SIGTERM or SIGINT.  A failed update
+    is logged and retried with a new database connection at the next check.
+    Changes to the watched paths made by the update itself are ignored.
+
+    :param updater: Updater object
+    :param opt: command line options
+    """
+    stop = StopFlag()
+    watcher = Watcher(get_watch_paths(opt), opt.poll_interval)
+    health = {'pid': os.getpid(),
+              'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'status': 'starting',
+              'watch_mode': watcher.mode,
+              'n_checks': 0,
+              'n_updates': 0,
+              'n_errors': 0,
+              'last_check': None,
+              'last_update': None,
+              'last_error': None,
+              'last_duration': None}
+    logging.info('Watching for changes ({}, poll interval {} sec)'
+                 .format(watcher.mode, opt.poll_interval))
+
+    while not stop():
+        metrics = Metrics(prefix='cmd_states_update')
+        t0 = time.time()
+        try:
+            states_changed = updater.update(metrics)
+        except Exception as err:
+            logging.exception('ERROR: update failed: {}'.format(err))
+            health['status'] = 'error'
+            health['n_errors'] += 1
+            health['last_error'] = '{}: {}'.format(time.ctime(), err)
+            updater.close()
+        else:
+            health['status'] = 'ok'
+            if states_changed is not None:
+                health['n_updates'] += 1
+                health['last_update'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        health['n_checks'] += 1
+        health['last_check'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        health['last_duration'] = time.time() - t0
+
+        if opt.health_file:
+            write_health(opt.health_file, health)
+        if opt.metrics_file:
+            metrics.write(opt.metrics_file)
+
+        # Do not wake up for the writes of this update to the database
+        watcher.mark()
+        watcher.wait(stop)
+
+    watcher.close()
+    updater.close()
+    health['status'] = 'stopped'
+    if opt.health_file:
+        write_health(opt.health_file, health)
+    logging.info('Stopped watching after {} checks and {} updates'
+                 .format(health['n_checks'], health['n_updates']))
+
+
+def get_options(args=None):
     """Get options for command line interface to update_cmd_states.
+
+    :param args: list of command line arguments (default=sys.argv[1:])
     """
     from optparse import OptionParser
-    parser = OptionParser()
+    parser = OptionParser(epilog=PROFILE_HELP)
     parser.set_defaults()
     parser.add_option("--dbi",
                       default='sqlite',
@@ -348,17 +1106,73 @@ def get_options():
     parser.add_option("--h5file",
                       default='cmd_states.h5',
                       help="filename for HDF5 version of cmd_states")
+    parser.add_option("--shard-dir",
+                      help="Keep the HDF5 states in this directory as one "
+                      "file per year with a manifest instead of in h5file")
     parser.add_option("--datestart",
                       help="Starting date for update (default=Now-10 days)")
     parser.add_option("--loglevel",
                       type='int',
                       default=20,
                       help='Log level (10=debug, 20=info, 30=warnings)')
-
-    (opt, args) = parser.parse_args()
+    parser.add_option("--metrics-file",
+                      help="Write run metrics (stage timing and counters) to "
+                      "this file, as a Prometheus textfile if the name ends "
+                      "with .prom and JSON otherwise (default=None)")
+    parser.add_option("--fingerprint-file",
+                      help="File recording the update inputs of the last run "
+                      "(default=<h5file base>.fingerprint.json)")
+    parser.add_option("--full",
+                      action="store_true",
+                      help="Regenerate all states in the update window even "
+                      "if the inputs have not changed")
+    parser.add_option("--journal-file",
+                      help="Journal of the update in progress, used to "
+                      "recover from an interrupted update "
+                      "(default=<h5file base>.journal.npz)")
+    parser.add_option("--recover",
+                      choices=['forward', 'back'],
+                      default='forward',
+                      help="Roll an interrupted update forward or back "
+                      "(forward|back, default=forward)")
+    parser.add_option("--no-snapshot",
+                      action="store_true",
+                      help="Update the HDF5 file in place instead of swapping "
+                      "in an updated copy")
+    parser.add_option("--append-only",
+                      action="store_true",
+                      help="Use (and convert the HDF5 file to) the versioned "
+                      "layout where updates only append rows")
+    parser.add_option("--compact",
+                      action="store_true",
+                      help="After the update rewrite the HDF5 table without "
+                      "superseded states (run periodically with "
+                      "--append-only)")
+    parser.add_option("--watch",
+                      action="store_true",
+                      help="Keep running and update whenever the timelines "
+                      "tables or MP directory change")
+    parser.add_option("--poll-interval",
+                      type='float',
+                      default=60.0,
+                      help="Maximum time between input checks in watch mode "
+                      "(sec, default=60)")
+    parser.add_option("--health-file",
+                      help="Health status JSON file written after each check "
+                      "in watch mode (default=None)")
+    parser.add_option("--anchor-cache",
+                      help="NPNT anchor state cache file (see "
+                      "chandra_cmd_states.anchors) from which the days "
+                      "changed by each update are dropped (default=None)")
+
+    (opt, args) = parser.parse_args(args)
+    if opt.shard_dir and (opt.no_snapshot or opt.append_only or opt.compact):
+        parser.error('--shard-dir cannot be used with --no-snapshot, '
+                     '--append-only or --compact')
     return (opt, args)
 
 
+@profiled
 def main():
     """
     Command line interface to update the cmd_states table to reflect current
@@ -373,12 +1187,43 @@ def main():
         --user=USER           database user (default=Ska.DBI default)
         --database=DATABASE   database name (default=Ska.DBI default)
         --h5file=H5FILE       filename for HDF5 version of cmd_states
+        --shard-dir=DIR       Keep the HDF5 states in DIR as one file per
+                              year with a manifest instead of in h5file
         --datestart=DATESTART
                               Starting date for update (default=Now-10 days)
         --mp_dir=DIR          MP directory. (default=/data/mpcrit1/mplogs)
         --loglevel=LOGLEVEL   Log level (10=debug, 20=info, 30=warnings)
+        --metrics-file=FILE   Write run metrics (stage timing and counters)
+                              to FILE, as a Prometheus textfile if the name
+                              ends with .prom and JSON otherwise
+        --fingerprint-file=FILE
+                              File recording the update inputs of the last
+                              run (default=<h5file base>.fingerprint.json)
+        --full                Regenerate all states in the update window
+                              even if the inputs have not changed
+        --journal-file=FILE   Journal of the update in progress, used to
+                              recover from an interrupted update
+                              (default=<h5file base>.journal.npz)
+        --recover=RECOVER     Roll an interrupted update forward or back
+                              (forward|back, default=forward)
+        --no-snapshot         Update the HDF5 file in place instead of
+                              swapping in an updated copy
+        --append-only         Use (and convert the HDF5 file to) the
+                              versioned layout where updates only append
+                              rows
+        --compact             After the update rewrite the HDF5 table
+                              without superseded states
+        --watch               Keep running and update whenever the timelines
+                              tables or MP directory change
+        --poll-interval=SEC   Maximum time between input checks in watch
+                              mode (default=60)
+        --health-file=FILE    Health status JSON file written after each
+                              check in watch mode
+        --anchor-cache=FILE   NPNT anchor state cache file from which the
+                              days changed by each update are dropped
     """
     opt, args = get_options()
+    metrics = Metrics(prefix='cmd_states_update')
 
     # Configure logging to emit msgs to stdout
     logging.basicConfig(level=opt.loglevel,
@@ -388,64 +1233,28 @@ def main():
     logging.info('Running {0} at {1}'
                  .format(os.path.basename(sys.argv[0]), time.ctime()))
 
-    logging.debug('Connecting to db: dbi=%s server=%s user=%s database=%s'
-                  % (opt.dbi, opt.server, opt.user, opt.database))
+    updater = Updater(opt)
     try:
-        db = Ska.DBI.DBI(dbi=opt.dbi, server=opt.server, user=opt.user,
-                         database=opt.database, verbose=False)
-        if opt.dbi == 'sqlite':
-            db.conn.text_factory = str
+        updater.connect()
     except Exception as msg:
         logging.error('ERROR: failed to connect to {0}:{1} server: {2}'
                       .format(opt.dbi, opt.server, msg))
         sys.exit(0)
 
-    if opt.h5file:
-        filters = tables.Filters(complevel=5, complib='zlib')
-        tables_open_file = getattr(tables, 'open_file', None) or tables.openFile
-        h5 = tables_open_file(opt.h5file, mode='a', filters=filters)
-    else:
-        h5 = None
-
-    # Get initial state containing the specified datestart
-    logging.debug('Getting initial state0')
-    state0 = cmd_states.get_state0(date=opt.datestart, db=db)
-    logging.debug('Initial state0: datestart=%s datestop=%s obsid=%d' %
-                  (state0['datestart'], state0['datestop'], state0['obsid']))
-
-    # Sync up datestart to state0 and get timeline load segments including
-    # state0 and beyond.
-    datestart = state0['datestart']
-    logging.debug('Getting timeline_loads after %s' % datestart)
-    timeline_loads = db.fetchall("""SELECT * from timeline_loads
-                                    WHERE datestop > '%s'""" % datestart)
-    logging.debug('Found %s timeline_loads' % len(timeline_loads))
-
-    # Get cmds since datestart.  If needed add cmds to database
-    logging.debug('Getting cmds after %s' % datestart)
-    cmds = cmd_states.get_cmds(datestart, db=db, update_db=True,
-                               timeline_loads=timeline_loads,
-                               mp_dir=opt.mp_dir)
-    logging.debug('Found %s cmds after %s' % (len(cmds), datestart))
-
-    # Get the states generated by cmds starting from state0
-    logging.debug('Generating cmd_states after %s' % datestart)
-    states = cmd_states.get_states(state0, cmds)
-    logging.debug('Found %s states after %s' % (len(states), datestart))
-
-    # Update cmd_states in database
-    logging.debug('Updating database cmd_states table')
-    states_changed = update_states_db(states, db, h5)
+    if opt.watch:
+        watch(updater, opt)
+        return
 
-    if h5:
-        # Check for consistency between HDF5 and SQL
-        n_check = 3000 if states_changed else 100
-        check_consistency(db, h5, n_check)
+    updater.update(metrics)
+    if opt.compact:
+        updater.compact(metrics)
 
     # Close down for good measure.
-    db.conn.close()
-    if h5:
-        h5.close()
+    updater.close()
+
+    if opt.metrics_file:
+        metrics.write(opt.metrics_file)
+        logging.info('Wrote run metrics to {}'.format(opt.metrics_file))
 
 
 if __name__ == '__main__':
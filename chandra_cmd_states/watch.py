@@ -0,0 +1,218 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Support for running a tool as a long-running watcher: waiting for changes in
+files and directories, graceful shutdown on signals and a health file.
+
+On Linux :class:`Watcher` uses inotify (through ctypes, so no extra package is
+needed) to wake up as soon as a watched path changes.  Elsewhere, or if
+inotify fails, it falls back to polling at the configured interval.  Either
+way the caller re-checks its inputs at least once per interval, so a change
+that inotify cannot see (e.g. a Sybase table) is still picked up.
+
+A caller that writes to a watched path itself (e.g. the sqlite database)
+calls :meth:`Watcher.mark` after its writes.  Events that leave the watched
+paths as they were at the mark are then ignored, so the caller is not woken
+up by its own writes.
+"""
+
+import os
+import time
+import json
+import errno
+import select
+import signal
+import logging
+import ctypes
+import ctypes.util
+
+# inotify event masks and flags from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE)
+
+
+class Inotify(object):
+    """
+    Minimal Linux inotify interface.  Raises OSError if inotify is not
+    available.
+    """
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """
+        Watch ``path`` (a file or directory) for the events in ``mask``.
+
+        :param path: path name
+        :param mask: inotify event mask
+        """
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, '{}: {}'.format(path, os.strerror(err)))
+        return wd
+
+    def wait(self, timeout):
+        """
+        Wait up to ``timeout`` seconds for events and discard them.
+
+        :param timeout: timeout (sec)
+        :returns: True if there were events
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher(object):
+    """
+    Wait for a change in any of ``paths`` or for ``interval`` seconds,
+    whichever comes first.  Paths that do not exist are skipped.
+
+    :param paths: list of files or directories to watch
+    :param interval: maximum time between checks (sec)
+    :param settle: time to wait after a change for related changes (sec)
+    :param use_inotify: use inotify if available (default=True)
+    """
+    def __init__(self, paths, interval, settle=1.0, use_inotify=True):
+        self.paths = paths
+        self.interval = interval
+        self.settle = settle
+        self.inotify = None
+        self.marked_stats = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+                for path in paths:
+                    if os.path.exists(path):
+                        self.inotify.add_watch(path)
+                        logging.debug('Watching {} with inotify'.format(path))
+            except (OSError, AttributeError, TypeError) as err:
+                logging.info('inotify not available ({}), polling instead'
+                             .format(err))
+                self.close()
+        self.mode = 'inotify' if self.inotify else 'poll'
+
+    def get_stats(self):
+        """
+        Get the (mtime, size) of each watched path and, for a directory, of
+        each of its entries.  Missing paths are None.
+
+        :returns: dict of path: stats
+        """
+        stats = {}
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+                stats[path] = [(st.st_mtime_ns, st.st_size)]
+                if os.path.isdir(path):
+                    for entry in sorted(os.scandir(path),
+                                        key=lambda entry: entry.name):
+                        st = entry.stat()
+                        stats[path].append((entry.name, st.st_mtime_ns,
+                                            st.st_size))
+            except OSError:
+                stats[path] = None
+        return stats
+
+    def mark(self):
+        """
+        Record the state of the watched paths after the caller's own writes,
+        so that :meth:`wait` ignores the events from those writes.
+        """
+        self.marked_stats = self.get_stats()
+
+    def wait(self, should_stop=lambda: False):
+        """
+        Wait for a change or the poll interval.  Returns early if
+        ``should_stop()`` becomes True (checked at least once per second).
+
+        :param should_stop: function returning True to stop waiting
+        :returns: True if a change was seen
+        """
+        deadline = time.time() + self.interval
+        while not should_stop():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            step = min(remaining, 1.0)
+            if self.inotify is None:
+                time.sleep(step)
+            elif self.inotify.wait(step):
+                # Let a burst of related changes (e.g. a database commit and
+                # its journal) finish before returning.
+                while self.inotify.wait(self.settle):
+                    pass
+                if (self.marked_stats is not None
+                        and self.get_stats() == self.marked_stats):
+                    logging.debug('Ignoring events that left the watched '
+                                  'paths unchanged since the last mark')
+                    continue
+                return True
+        return False
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+
+class StopFlag(object):
+    """
+    Flag that is set when one of ``signals`` (default SIGTERM and SIGINT) is
+    received, so a loop can finish its current cycle and shut down cleanly.
+    Calling the object returns the flag.
+
+    :param signals: list of signal numbers
+    """
+    def __init__(self, signals=(signal.SIGTERM, signal.SIGINT)):
+        self.stop = False
+        self.signum = None
+        for signum in signals:
+            signal.signal(signum, self._handler)
+
+    def _handler(self, signum, frame):
+        logging.info('Received signal {}, shutting down'.format(signum))
+        self.stop = True
+        self.signum = signum
+
+    def __call__(self):
+        return self.stop
+
+
+def write_health(filename, health):
+    """
+    Write the ``health`` dict as JSON to ``filename`` via a temporary file so
+    readers never see a partial file.
+
+    :param filename: health file name
+    :param health: dict of health values
+    """
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as fh:
+        json.dump(health, fh, indent=2)
+        fh.write('\n')
+    os.replace(tmp_filename, filename)
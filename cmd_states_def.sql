@@ -33,4 +33,12 @@ CREATE INDEX idx_cmd_states_obsid ON cmd_states (obsid)
 CREATE INDEX idx_cmd_states_datestart ON cmd_states (datestart)
 ;
 CREATE INDEX idx_cmd_states_datestop ON cmd_states (datestop)
+;
+CREATE INDEX idx_cmd_states_tstart ON cmd_states (tstart)
+;
+CREATE INDEX idx_cmd_states_tstop ON cmd_states (tstop)
+;
+CREATE INDEX idx_cmd_states_pcad_mode_tstart ON cmd_states (pcad_mode, tstart)
+;
+CREATE INDEX idx_cmd_states_pcad_mode_tstop ON cmd_states (pcad_mode, tstop)
 
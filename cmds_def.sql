@@ -9,7 +9,17 @@ CREATE TABLE cmds (
  vcdu              int,
  step              int,
  scs               int,
+ par_id            int,
+ par_pos           int,
+ par_q1            float(16),
+ par_q2            float(16),
+ par_q3            float(16),
+ par_q4            float(16),
  CONSTRAINT pk_cmds_id PRIMARY KEY (id)
 )
 ;
 CREATE INDEX idx_cmds_timeline_id ON cmds (timeline_id)
+;
+CREATE INDEX idx_cmds_time ON cmds (time)
+;
+CREATE INDEX idx_cmds_timeline_id_time ON cmds (timeline_id, time)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Migrate an existing commanded states database to the current table
+definitions.  This adds:
+
+- Indexes on the numeric time columns of the cmds and cmd_states tables
+- State parameter columns (par_id, par_pos, par_q1 .. par_q4) to the cmds
+  table, filled from the cmd_intpars and cmd_fltpars tables
+
+Migrations that are already in place are skipped, so this is safe to run more
+than once.
+
+Usage: migrate_cmd_tables.py [options]::
+
+  Options:
+    -h, --help       show this help message and exit
+    --dbi=DBI        Database interface (sqlite|sybase)
+    --server=SERVER  DBI server (<filename>|sybase)
+"""
+
+import logging
+
+import Ska.DBI
+from chandra_cmd_states import migrations
+from chandra_cmd_states.profiling import profiled, PROFILE_HELP
+
+
+def get_options():
+    from optparse import OptionParser
+    parser = OptionParser(epilog=PROFILE_HELP)
+    parser.set_defaults()
+    parser.add_option("--dbi",
+                      default='sqlite',
+                      help="Database interface (sqlite|sybase)")
+    parser.add_option("--server",
+                      default='db_base.db3',
+                      help="DBI server (<filename>|sybase)")
+    parser.add_option("--user",
+                      help="sybase user (default=Ska.DBI default)")
+    parser.add_option("--database",
+                      help="sybase database (default=Ska.DBI default)")
+    opt, args = parser.parse_args()
+    return opt, args
+
+
+@profiled
+def main():
+    opt, args = get_options()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    db = Ska.DBI.DBI(dbi=opt.dbi, server=opt.server,
+                     user=opt.user, database=opt.database,
+                     numpy=False, verbose=True)
+    migrations.migrate_db(db)
+
+
+if __name__ == '__main__':
+    main()
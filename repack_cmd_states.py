@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+# Licensed under a 3-clause BSD style license - see LICENSE.rst
+"""
+Repack the HDF5 cmd_states file with only the live states, a chosen
+compressor and chunkshape and an index on tstart.  This is normally run
+occasionally as a maintenance job.
+"""
+
+if __name__ == '__main__':
+    from chandra_cmd_states import repack
+    repack.main()
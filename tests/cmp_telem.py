@@ -8,9 +8,10 @@ fetch --start 2008:001 --stop 2008:365 --dt 300 --outfile tlm2008.dat \
 fetch --start 2003:001 --stop 2003:365 --dt 300 --outfile tlm2003.dat \
       --time-format secs aopcadmd cobsrqid tscpos aosares1 point_suncentang
 """
+import sys
 import logging
+import numpy as np
 import Ska.Table
-import Ska.DBI
 import chandra_cmd_states as cmd_states
 from Ska.Matplotlib import plot_cxctime, pointpair
 from Chandra.Time import DateTime
@@ -27,18 +28,10 @@ if 'tlm' not in globals():
     print 'Reading telemetry'
     tlm = Ska.Table.read_ascii_table('t/tlm%d.dat' % year)  # or ','
 
-# db = Ska.DBI.DBI(dbi='sqlite', server='db_base.db3')
-db = Ska.DBI.DBI(dbi='sybase')
-
-datestart = '%d:365' % (year-1)
-datestop = '%d:001' % (year+1)
-
-if 'states' not in globals():
+if 'state_vals' not in globals():
     print 'Getting states'
-    states = db.fetchall("""SELECT * from cmd_states
-                            WHERE datestop > '%s'
-                            AND datestart < '%s'""" % (datestart, datestop))
-    state_vals = cmd_states.interpolate_states(states, tlm.date)
+    state_vals = cmd_states.states_at(tlm.date, vals=['pitch', 'simpos', 'obsid'])
+    state_vals = state_vals.view(np.recarray)
 
 
 diff = medfilt(tlm.aosares1 - state_vals.pitch, 9)